@@ -0,0 +1,321 @@
+"""
+Module for mapping batches of recorded rover camera frames.
+
+Offline map building does not need the per-frame rover state computed by
+perception_step, only the worldmap. Here a whole batch of frames is
+warped, classified and projected to the world frame with a handful of
+array operations, and all its ROI pixels are counted into the worldmap
+with a single bincount.
+
+Example:
+$ python batch_perception.py ../test_dataset_2 --batch-size 64
+
+NOTE:
+
+Short Forms:
+pixpts -- pixel points
+nav -- navigable terrain pixels
+obs -- obstacle pixels
+rock -- rock pixels
+
+Abbreviations:
+ROI -- Regions of interest
+rf -- rover frame
+wf -- world frame
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import argparse
+
+import numpy as np
+import cv2
+import matplotlib.image as mpimg
+
+import perception
+from perception import (
+    PixPoints, ColorClassifier, perspect_calibration, get_polar_lookup,
+    world_affine, is_stable_pose, PERCEPTION_MODES,
+    NAV_LABEL, OBS_LABEL, ROCK_LABEL,
+    NAV_MAX_DIST, OBS_MAX_DIST, ROCK_MAX_DIST
+)
+from replay import iter_robot_log
+from rover_telemetry import RoverTelemetry
+from worldmap import OBS_CHANNEL, ROCK_CHANNEL, NAV_CHANNEL
+
+
+# Label, max distance mapped and worldmap channel of each ROI
+BATCH_ROIS = (
+    (OBS_LABEL, OBS_MAX_DIST, OBS_CHANNEL),
+    (ROCK_LABEL, ROCK_MAX_DIST, ROCK_CHANNEL),
+    (NAV_LABEL, NAV_MAX_DIST, NAV_CHANNEL),
+)
+
+# OpenCV images hold at most 512 channels, so at most this many RGB
+# frames are stacked into the channels of one image for remapping
+MAX_REMAP_FRAMES = 170
+
+
+class BatchPerception():
+    """
+    Create a class to map ROIs of a batch of frames onto a worldmap.
+
+    For mode 'warp_image' the frames of a batch are interleaved into the
+    channels of one image and warped by a single remap. For mode
+    'warp_labels' the frames are classified in one lookup and every
+    perspective frame pixel gathers the label of the camera pixel that
+    cv2.remap with INTER_NEAREST would sample. Either way the labels,
+    and so the worldmap, equal those of perception_step frame by frame.
+
+    """
+
+    def __init__(self, mode='warp_image', world_size=200, scale_factor=10):
+        """
+        Initialize a BatchPerception instance.
+
+        Keyword arguments:
+        mode -- one of perception.PERCEPTION_MODES
+        world_size -- integer length of square world map of 200 x 200 pixels
+        scale_factor -- between world and rover frame pixels
+
+        """
+        if mode not in PERCEPTION_MODES:
+            raise ValueError('Unknown perception mode: {}'.format(mode))
+        self.mode = mode
+        self.world_size = world_size
+        self.scale_factor = scale_factor
+        self.classifier = ColorClassifier()
+        self.frame_stacks = {}  # Shape -> frames interleaved in channels
+        self.src_idxs = {}  # Calibration key -> camera pixel of each pixel
+
+    def label_frames(self, imgs):
+        """
+        Label ROI pixels of a batch of camera images in perspective frame.
+
+        Keyword arguments:
+        imgs -- uint8 numpy array of N x height x width x 3 camera images
+
+        Return value:
+        label_imgs -- uint8 N x (height*width) array of ROI bit flags
+
+        """
+        num_frames, height, width = imgs.shape[:3]
+        if self.mode == 'warp_labels':
+            cam_label_imgs = self.classifier.classify(
+                imgs.reshape(num_frames*height, width, 3)
+            ).reshape(num_frames, height*width)
+            # Pixels sampled from outside the image take the zero label
+            # appended after the last camera pixel
+            cam_label_imgs = np.pad(cam_label_imgs, ((0, 0), (0, 1)))
+            return np.take(cam_label_imgs, self.get_src_idxs(height, width),
+                           axis=1)
+
+        map_x, map_y = perspect_calibration.get_warp(height, width)[1:]
+        label_imgs = np.empty((height*width, num_frames), dtype=np.uint8)
+        for start in range(0, num_frames, MAX_REMAP_FRAMES):
+            chunk = imgs[start:start+MAX_REMAP_FRAMES]
+            stack_shape = height, width, 3*len(chunk)
+            if stack_shape not in self.frame_stacks:
+                self.frame_stacks[stack_shape] = np.empty(stack_shape,
+                                                          dtype=np.uint8)
+            frame_stack = self.frame_stacks[stack_shape]
+            cv2.merge(list(chunk), frame_stack)
+            warped_stack = cv2.remap(frame_stack, map_x, map_y,
+                                     cv2.INTER_LINEAR)
+            # Channels of each pixel hold R,G,B of every frame in turn
+            label_imgs[:, start:start+len(chunk)] = self.classifier.classify(
+                warped_stack.reshape(height*width, len(chunk), 3)
+            )
+        return label_imgs.T
+
+    def get_src_idxs(self, height, width):
+        """
+        Get flat index of the camera pixel each perspective pixel samples.
+
+        Pixels sampling outside the camera image get index height*width.
+
+        """
+        key = perspect_calibration.key(height, width, 10, 6)
+        if key not in self.src_idxs:
+            map_x, map_y = perspect_calibration.get_warp(height, width)[1:]
+            cam_pix_idxs = np.arange(height*width, dtype=np.float32)
+            src_idxs = cv2.remap(cam_pix_idxs.reshape(height, width),
+                                 map_x, map_y, cv2.INTER_NEAREST,
+                                 borderMode=cv2.BORDER_CONSTANT,
+                                 borderValue=-1)
+            src_idxs = src_idxs.astype(np.int_).ravel()
+            src_idxs[src_idxs < 0] = height*width
+            self.src_idxs[key] = src_idxs
+        return self.src_idxs[key]
+
+    def rover_to_world(self, frame_idxs, pixpts_rf, affines):
+        """
+        Transform pixel points of many frames from rover to world frame.
+
+        Keyword arguments:
+        frame_idxs -- numpy array of frame index of each pixel point
+        pixpts_rf -- tuple of numpy arrays of x,y pixel points in rover frame
+        affines -- 2x3xN array of world_affine() of every frame
+
+        Return value:
+        pixpts_wf -- namedtuple of numpy arrays of pixel x,y points in world
+                     frame, computed like WorldTransform.rover_to_world()
+
+        """
+        xpix_pts_rf, ypix_pts_rf = pixpts_rf
+        pixpts_wf = []
+        for affine_row in affines:
+            pix_pts = (xpix_pts_rf*affine_row[0][frame_idxs]
+                       + ypix_pts_rf*affine_row[1][frame_idxs]
+                       + affine_row[2][frame_idxs])
+            # Truncate like np.int_ and clip pixels to be within world size
+            pixpts_wf.append(np.clip(pix_pts.astype(np.int_),
+                                     0, self.world_size-1))
+        return PixPoints(*pixpts_wf)
+
+    def map_frames(self, imgs, rover_pos, rover_yaw, rover_pitch,
+                   rover_roll, worldmap):
+        """
+        Count ROIs of a batch of camera frames into a worldmap.
+
+        Frames taken in an unstable pose are skipped, as in
+        perception_step.
+
+        Keyword arguments:
+        imgs -- uint8 numpy array of N x height x width x 3 camera images
+        rover_pos -- N x 2 numpy array of rover x,y positions in world frame
+        rover_yaw, rover_pitch, rover_roll -- numpy arrays of N rover angles
+        worldmap -- worldmap.WorldMap instance to update
+
+        Return value:
+        new_pixs -- list of numpy arrays of flat indexes of pixels mapped for
+                    the first time, per channel in order obs, rock, nav
+
+        """
+        rover_pos = np.asarray(rover_pos, dtype=np.float64)
+        stable = is_stable_pose(np.asarray(rover_pitch),
+                                np.asarray(rover_roll))
+        imgs = np.asarray(imgs)[stable]
+        if not len(imgs):
+            return [np.array([], dtype=np.int_) for _ in BATCH_ROIS]
+        affines = world_affine((rover_pos[stable, 0], rover_pos[stable, 1]),
+                               np.asarray(rover_yaw)[stable],
+                               self.scale_factor)
+
+        label_imgs = self.label_frames(imgs)
+        polar_lookup = get_polar_lookup(*imgs.shape[1:3])
+
+        rois_pixpts_wf = []
+        for label, max_dist, channel in BATCH_ROIS:
+            roi_pixs = (label_imgs & label).astype(bool)
+            roi_pixs &= polar_lookup.within(max_dist)
+            frame_idxs, pix_idxs = np.nonzero(roi_pixs)
+            rois_pixpts_wf.append(self.rover_to_world(
+                frame_idxs, polar_lookup.rover_pixpts(pix_idxs), affines
+            ))
+
+        return worldmap.update(rois_pixpts_wf,
+                               [channel for _, _, channel in BATCH_ROIS])
+
+
+def read_poses(rows):
+    """
+    Read rover poses of robot_log.csv rows into numpy arrays.
+
+    Return value:
+    rover_pos -- N x 2 array of rover x,y positions in world frame
+    rover_yaw, rover_pitch, rover_roll -- arrays of N rover angles
+
+    """
+    rover_pos = np.array([(float(row['X_Position']), float(row['Y_Position']))
+                          for row in rows]).reshape(-1, 2)
+    rover_yaw, rover_pitch, rover_roll = (
+        np.array([float(row[name]) for row in rows])
+        for name in ('Yaw', 'Pitch', 'Roll')
+    )
+    return rover_pos, rover_yaw, rover_pitch, rover_roll
+
+
+def map_dataset(dataset_dir, mode='warp_image', batch_size=64):
+    """
+    Build the worldmap of a recorded dataset batch by batch.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+    mode -- one of perception.PERCEPTION_MODES
+    batch_size -- number of frames mapped per batch, 0 to map frame by
+                  frame through perception_step for comparison
+
+    Return value:
+    Rover, map_time -- RoverTelemetry holding the worldmap and map
+                       statistics, and seconds spent mapping
+
+    """
+    Rover = RoverTelemetry()
+    rows = list(iter_robot_log(dataset_dir))
+    imgs = np.stack([mpimg.imread(row['Path']) for row in rows])
+    rover_pos, rover_yaw, rover_pitch, rover_roll = read_poses(rows)
+
+    batch_perception = BatchPerception(mode=mode)
+    # Build lookup tables and buffers before timing anything
+    batch_perception.label_frames(imgs[:1])
+    perception.perspect_label_img(imgs[0], mode)
+
+    start = time.perf_counter()
+    if batch_size:
+        for first in range(0, len(imgs), batch_size):
+            batch = slice(first, first+batch_size)
+            new_pixs = batch_perception.map_frames(
+                imgs[batch], rover_pos[batch], rover_yaw[batch],
+                rover_pitch[batch], rover_roll[batch], Rover.worldmap
+            )
+            Rover.map_stats.add_nav_pixs(new_pixs[2])
+    else:
+        for frame in range(len(imgs)):
+            Rover.img = imgs[frame]
+            Rover.pos = rover_pos[frame]
+            Rover.yaw = rover_yaw[frame]
+            Rover.pitch = rover_pitch[frame]
+            Rover.roll = rover_roll[frame]
+            perception.perception_step(Rover, mode=mode)
+    map_time = time.perf_counter() - start
+
+    return Rover, map_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map dataset in batches')
+    parser.add_argument(
+        'dataset',
+        type=str,
+        nargs='?',
+        default='../test_dataset',
+        help='Path to dataset folder holding robot_log.csv and IMG.'
+    )
+    parser.add_argument(
+        '--mode',
+        type=str,
+        default='warp_image',
+        choices=PERCEPTION_MODES,
+        help='Perception mode to map with.'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=64,
+        help='Number of frames mapped per batch.'
+    )
+    args = parser.parse_args()
+
+    for batch_size in (0, args.batch_size):
+        Rover, map_time = map_dataset(args.dataset, args.mode, batch_size)
+        num_frames = len(list(iter_robot_log(args.dataset)))
+        print('{:>14}: {:.1f} fps, {:.1f}% mapped, {:.1f}% fidelity'.format(
+            'batch of {}'.format(batch_size) if batch_size else 'per frame',
+            num_frames / map_time,
+            Rover.map_stats.perc_mapped, Rover.map_stats.fidelity
+        ))
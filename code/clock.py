@@ -0,0 +1,68 @@
+"""
+Module for clocks timing the rover's mission and decisions.
+
+The rover's total time, its mission time limit and the stuck timers of
+the decision supervisor all read the clock of the rover. Driving the
+simulator uses a monotonic real time clock, unaffected by changes of
+the system time. Offline replay uses a frame clock advanced by a fixed
+period on every telemetry frame, so decisions depend only on the frames
+and run the same at any replay speed.
+
+NOTE:
+time -- seconds
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+
+
+# Names of the clocks selectable on the command line
+CLOCKS = ('monotonic', 'frame')
+
+
+class MonotonicClock():
+    """Create a class for a clock of real elapsed time."""
+
+    def now(self):
+        """Return the current time."""
+        return time.monotonic()
+
+    def tick(self):
+        """Mark a new telemetry frame, real time passes by itself."""
+
+
+class FrameClock():
+    """Create a class for a clock advancing a fixed period every frame."""
+
+    def __init__(self, fps=25.0):
+        """
+        Initialize a FrameClock instance.
+
+        Keyword arguments:
+        fps -- telemetry frames per second simulated, that of the
+               simulator by default
+
+        """
+        self.period = 1/fps
+        self.frames = 0  # Number of frames ticked
+
+    def now(self):
+        """Return the time of the current frame."""
+        return self.frames*self.period
+
+    def tick(self):
+        """Advance to the next telemetry frame."""
+        self.frames += 1
+
+
+def make_clock(name, fps=25.0):
+    """Create a clock of one of CLOCKS by name."""
+    if name == 'monotonic':
+        return MonotonicClock()
+    elif name == 'frame':
+        return FrameClock(fps)
+    raise ValueError('Unknown clock: {}'.format(name))
@@ -0,0 +1,113 @@
+"""
+Compare accuracy of perception modes on recorded rover camera images.
+
+Each mode in perception.PERCEPTION_MODES is run on the same images and
+its ROI label images are compared with those of a reference mode.
+
+Example:
+$ python compare_perception.py ../test_dataset/IMG --mode warp_labels
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import os
+import glob
+import time
+import argparse
+
+import numpy as np
+import matplotlib.image as mpimg
+
+import perception
+from perception import NAV_LABEL, OBS_LABEL, ROCK_LABEL
+
+
+def compare_modes(img_paths, mode, ref_mode='warp_image'):
+    """
+    Compare ROI label images of mode against those of ref_mode.
+
+    Keyword arguments:
+    img_paths -- list of paths to rover camera images
+    mode -- perception mode under test
+    ref_mode -- perception mode used as reference
+
+    Return value:
+    results -- dict of mean per-frame metrics:
+        <roi>_count_ratio -- ROI pixel count relative to reference
+        <roi>_iou -- intersection over union of ROI pixels with reference
+        nav_heading_error -- abs difference of mean nav angles (degrees)
+        <mode>_ms -- time spent labelling a frame in each mode
+
+    """
+    rois = {'nav': NAV_LABEL, 'obs': OBS_LABEL, 'rock': ROCK_LABEL}
+    metrics = {}
+    times = {mode: 0.0, ref_mode: 0.0}
+
+    # Build lookup tables and buffers before timing anything
+    for perception_mode in times:
+        perception.perspect_label_img(mpimg.imread(img_paths[0]),
+                                      perception_mode)
+
+    for img_path in img_paths:
+        img = mpimg.imread(img_path)
+
+        start = time.perf_counter()
+        ref_label_img = perception.perspect_label_img(img, ref_mode).copy()
+        times[ref_mode] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        label_img = perception.perspect_label_img(img, mode)
+        times[mode] += time.perf_counter() - start
+
+        for roi, label in rois.items():
+            ref_pixs = (ref_label_img & label) > 0
+            pixs = (label_img & label) > 0
+            union = np.count_nonzero(ref_pixs | pixs)
+            # Frames without the ROI in either mode agree perfectly
+            count_ratio = (np.count_nonzero(pixs) / np.count_nonzero(ref_pixs)
+                           if ref_pixs.any() else float(not pixs.any()))
+            iou = np.count_nonzero(ref_pixs & pixs) / union if union else 1.0
+            metrics.setdefault(roi + '_count_ratio', []).append(count_ratio)
+            metrics.setdefault(roi + '_iou', []).append(iou)
+
+        polar_lookup = perception.get_polar_lookup(*label_img.shape)
+        ref_nav_idxs = polar_lookup.pixel_idxs(ref_label_img & NAV_LABEL)
+        nav_idxs = polar_lookup.pixel_idxs(label_img & NAV_LABEL)
+        if len(ref_nav_idxs) and len(nav_idxs):
+            metrics.setdefault('nav_heading_error', []).append(abs(
+                np.mean(polar_lookup.angles[ref_nav_idxs])
+                - np.mean(polar_lookup.angles[nav_idxs])
+            ))
+
+    results = {name: np.mean(values) for name, values in metrics.items()}
+    for name, total_time in times.items():
+        results[name + '_ms'] = 1000*total_time / len(img_paths)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare perception modes')
+    parser.add_argument(
+        'image_folder',
+        type=str,
+        nargs='?',
+        default='../test_dataset/IMG',
+        help='Path to folder of recorded rover camera images.'
+    )
+    parser.add_argument(
+        '--mode',
+        type=str,
+        default='warp_labels',
+        choices=perception.PERCEPTION_MODES,
+        help='Perception mode to compare against warp_image.'
+    )
+    args = parser.parse_args()
+
+    img_paths = sorted(glob.glob(os.path.join(args.image_folder, '*.jpg')))
+    results = compare_modes(img_paths, args.mode)
+    for name, value in sorted(results.items()):
+        print('{:>20}: {:.3f}'.format(name, value))
@@ -0,0 +1,150 @@
+"""
+Module for keeping the control loop within its frame deadline.
+
+The simulator sends telemetry about 25 times per second and waits for the
+commands of each frame before sending the next. Frames that overrun this
+period delay the commands and make the timers of the decision supervisor
+fire while the rover is in fact moving. FrameDeadline measures the cost
+of every frame and, when frames run late, sheds non-critical work one
+step at a time in the order of DEGRADATIONS, restoring it again once
+frames fit comfortably within the budget. Commands are always sent.
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# Work shed under deadline pressure, first to last:
+# skip_hud -- reuse the last display images instead of rendering new ones
+# skip_map_update -- leave the worldmap untouched while frames run late
+# subsample_threshold -- classify every other camera pixel only
+DEGRADATIONS = ('skip_hud', 'skip_map_update', 'subsample_threshold')
+
+# Step between camera pixels classified under subsample_threshold
+SUBSAMPLED_SRC_STEP = 2
+
+
+class FrameDeadline():
+    """
+    Create a class to watch frame cost and degrade work under pressure.
+
+    Usage, once per telemetry frame:
+    frame_deadline.begin_frame()
+    ... perception_step(Rover, src_step=frame_deadline.src_step,
+                        update_map=not frame_deadline.skip_map_update) ...
+    ... if not frame_deadline.skip_hud: render display images ...
+    ... send commands ...
+    frame_deadline.end_frame()
+
+    """
+
+    def __init__(self, budget=0.04, headroom=0.8, recover_ratio=0.5,
+                 recover_frames=25):
+        """
+        Initialize a FrameDeadline instance.
+
+        Keyword arguments:
+        budget -- seconds available to process one frame, 0 to disable
+        headroom -- fraction of budget a frame may take before the next
+                    degradation is applied
+        recover_ratio -- fraction of budget frames must stay under to
+                         restore the last degradation applied
+        recover_frames -- consecutive frames under recover_ratio of budget
+                          needed to restore one degradation
+
+        """
+        self.budget = budget
+        self.headroom = headroom
+        self.recover_ratio = recover_ratio
+        self.recover_frames = recover_frames
+        self.level = 0  # Number of DEGRADATIONS applied, in order
+        self.frames = 0  # Number of frames watched
+        self.overruns = 0  # Number of frames over budget
+        self.degraded_frames = {name: 0 for name in DEGRADATIONS}
+        self.last_cost = 0.0  # Seconds taken by the last frame
+        self._frame_start = None
+        self._fast_frames = 0  # Consecutive frames under recover_ratio
+
+    def is_degraded(self, name):
+        """Check if degradation name of DEGRADATIONS is applied."""
+        return DEGRADATIONS.index(name) < self.level
+
+    @property
+    def skip_hud(self):
+        """True if display images should not be rendered this frame."""
+        return self.is_degraded('skip_hud')
+
+    @property
+    def skip_map_update(self):
+        """True if the worldmap should not be updated this frame."""
+        return self.is_degraded('skip_map_update')
+
+    @property
+    def src_step(self):
+        """Step between camera pixels to classify this frame."""
+        if self.is_degraded('subsample_threshold'):
+            return SUBSAMPLED_SRC_STEP
+        return 1
+
+    def begin_frame(self):
+        """Start timing a frame."""
+        self._frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """
+        Finish timing a frame and adjust the degradation level.
+
+        Return value:
+        cost -- seconds taken by the frame
+
+        """
+        cost = time.perf_counter() - self._frame_start
+        self.last_cost = cost
+        self.frames += 1
+        for name in DEGRADATIONS[:self.level]:
+            self.degraded_frames[name] += 1
+        if not self.budget:
+            return cost
+
+        if cost > self.budget:
+            self.overruns += 1
+        if cost > self.headroom*self.budget:
+            self._fast_frames = 0
+            if self.level < len(DEGRADATIONS):
+                self.level += 1
+                log.warning("Frame took %.1f ms of %.1f ms budget,"
+                            " degrading: %s", cost*1e3, self.budget*1e3,
+                            DEGRADATIONS[self.level-1])
+        elif cost < self.recover_ratio*self.budget and self.level > 0:
+            self._fast_frames += 1
+            if self._fast_frames >= self.recover_frames:
+                self._fast_frames = 0
+                self.level -= 1
+                log.info("Frames within budget, restoring: %s",
+                         DEGRADATIONS[self.level])
+        else:
+            self._fast_frames = 0
+        return cost
+
+    def report(self):
+        """
+        Summarize deadline pressure so far.
+
+        Return value:
+        report -- dict of frames, overruns, current level and number of
+                  frames each degradation was applied for
+
+        """
+        return {
+            'frames': self.frames,
+            'overruns': self.overruns,
+            'level': self.level,
+            'degraded_frames': dict(self.degraded_frames),
+        }
@@ -18,8 +18,6 @@ __author__ = 'Salman Hashmi'
 __license__ = 'BSD License'
 
 
-import time
-
 import numpy as np
 
 import events
@@ -66,47 +64,115 @@ class DecisionSupervisor():
             'completed_mission': events.completed_mission,
             'reached_home': events.reached_home
         }
+        # State identifier of each state class name
+        self.state_idxs = {type(state).__name__: idx
+                           for idx, state in self.state.items()}
+        # Compile the transition table into dispatch by state identifier
+        self.compile_transitions(handlers.TRANSITIONS)
         # Default state
+        self.curr_idx = 0
         self.curr_state = self.state[0]  # FindWall
         self.starttime = 0.0  # for timer
+        # Events already evaluated in the current perception frame
+        self.event_results = {}
+        self.event_frame = None  # Rover features and frame of the results
+
+    def compile_transitions(self, table):
+        """
+        Compile a transition table into dispatch by state identifier.
+
+        Keyword arguments:
+        table -- dict of state class name -> ordered (guard, next state
+                 class name, action) transitions, see handlers.TRANSITIONS
+
+        """
+        unknown = set(table) - set(self.state_idxs)
+        if unknown:
+            raise ValueError('Unknown states: {}'.format(sorted(unknown)))
+
+        self.transitions = []  # (from, guard, to, action) of each transition
+        self.dispatch = [() for _ in self.state]
+        for name, transitions in table.items():
+            compiled = []
+            for guard, next_name, action in transitions:
+                if next_name not in self.state_idxs:
+                    raise ValueError('Unknown state: {}'.format(next_name))
+                guard = handlers.as_guard(guard)
+                compiled.append((guard.check, self.state_idxs[next_name],
+                                 action, len(self.transitions)))
+                self.transitions.append((name, guard, next_name, action))
+            self.dispatch[self.state_idxs[name]] = tuple(compiled)
+
+        self.transition_counts = [0]*len(self.transitions)
+        self.stay_counts = [0]*len(self.state)
+
+    def describe_transitions(self):
+        """
+        Describe the compiled transitions and how often each was taken.
+
+        Return value:
+        transitions -- list of dicts of from, guard, to, action and count
+                       of each transition in dispatch order, followed by
+                       the frames each state was stayed in
+
+        """
+        described = [
+            {'from': name, 'guard': guard.description, 'to': next_name,
+             'action': action.__name__ if action else None, 'count': count}
+            for (name, guard, next_name, action), count
+            in zip(self.transitions, self.transition_counts)
+        ]
+        described += [
+            {'from': name, 'guard': 'otherwise', 'to': name, 'action': None,
+             'count': self.stay_counts[idx]}
+            for name, idx in self.state_idxs.items()
+        ]
+        return described
 
     def is_event(self, Rover, name):
-        """Check if given event has occurred."""
-        func = self.event.get(name)
-        return func(Rover)
+        """Check if given event has occurred, evaluated once per frame."""
+        frame = Rover.features, Rover.features.frame
+        if self.event_frame != frame:
+            self.event_results = {}
+            self.event_frame = frame
+        if name not in self.event_results:
+            self.event_results[name] = self.event[name](Rover)
+        return self.event_results[name]
 
     def either_events(self, Rover, name1, name2):
         """Check if either events have occurred."""
-        func1 = self.event.get(name1)
-        func2 = self.event.get(name2)
-        return func1(Rover) or func2(Rover)
+        return self.is_event(Rover, name1) or self.is_event(Rover, name2)
 
     def both_events(self, Rover, name1, name2):
         """Check if both events have occurred."""
-        func1 = self.event.get(name1)
-        func2 = self.event.get(name2)
-        return func1(Rover) and func2(Rover)
+        return self.is_event(Rover, name1) and self.is_event(Rover, name2)
 
     def is_state(self, name):
         """Check if handler is in given state."""
         return name is self.curr_state
 
+    def enter_state(self, Rover, idx):
+        """Execute the state of identifier idx and make it current."""
+        state = self.state[idx]
+        state.execute(Rover)
+        self.curr_idx = idx
+        self.curr_state = state
+
     def switch_to_state(self, Rover, name):
         """Update current state to the next state."""
-        name.execute(Rover)
-        self.curr_state = name
+        self.enter_state(Rover, self.state_idxs[type(name).__name__])
 
     def is_stuck_for(self, Rover, stucktime):
-        """Check if rover is stuck for stucktime."""
+        """Check if rover is stuck for stucktime, timed by Rover.clock."""
         exceeded_stucktime = False
         # If not moving then check since when
         if Rover.vel < 0.1:
             if not Rover.timer_on:
-                self.starttime = time.time()  # start timer
+                self.starttime = Rover.clock.now()  # start timer
                 Rover.stuck_heading = Rover.yaw
                 Rover.timer_on = True
             else:
-                endtime = time.time()
+                endtime = Rover.clock.now()
                 exceeded_stucktime = (endtime - self.starttime) > stucktime
         else:  # if started to move then switch OFF/Reset timer
             Rover.timer_on = False
@@ -114,26 +180,18 @@ class DecisionSupervisor():
         return exceeded_stucktime
 
     def execute(self, Rover):
-        """Select and call the handler for the current state."""
+        """Take the first transition of the current state whose guard holds."""
         # Ensure Rover telemetry data is coming in
         if Rover.nav_angles is not None:
-            # State identifiers and corresponding handlers
-            select = {
-                self.state[0]: handlers.finding_wall,
-                self.state[1]: handlers.following_wall,
-                self.state[2]: handlers.turning_to_wall,
-                self.state[3]: handlers.avoiding_wall,
-                self.state[4]: handlers.avoiding_obstacles,
-                self.state[5]: handlers.going_to_sample,
-                self.state[6]: handlers.stopped_at_sample,
-                self.state[7]: handlers.initiating_pickup,
-                self.state[8]: handlers.waiting_pickup_initiate,
-                self.state[9]: handlers.waiting_pickup_finish,
-                self.state[10]: handlers.getting_unstuck,
-                self.state[11]: handlers.returning_home,
-                self.state[12]: handlers.parking
-            }
-            # Select and call the handler function for the current state
-            func = select.get(self.curr_state, lambda: "nothing")
-            func(self, Rover)
+            for check, next_idx, action, transition in (
+                    self.dispatch[self.curr_idx]):
+                if check(self, Rover):
+                    if action is not None:
+                        action(Rover)
+                    self.transition_counts[transition] += 1
+                    self.enter_state(Rover, next_idx)
+                    return Rover
+            # Otherwise remain in the current state
+            self.stay_counts[self.curr_idx] += 1
+            self.enter_state(Rover, self.curr_idx)
         return Rover
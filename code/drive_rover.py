@@ -12,13 +12,12 @@ __license__ = 'BSD License'
 
 # Standard library imports
 import os
-import time
 import json
 import base64
 import shutil
 import pickle
+import logging
 import argparse
-from datetime import datetime
 from io import BytesIO, StringIO
 
 # Related third party imports
@@ -26,111 +25,64 @@ import cv2
 import socketio
 import eventlet
 import eventlet.wsgi
-import numpy as np
-import matplotlib.image as mpimg
+from eventlet import tpool
 from PIL import Image
 from flask import Flask
 
 # Local application/library specific imports
-from perception import perception_step
-import decision_new
-from supporting_functions import update_rover, create_output_images
+from perception import (
+    get_perception_roi, ColorClassifier, PERCEPTION_MODES
+)
+from supporting_functions import status_log
+from telemetry import JPEG_DECODERS
+from telemetry_logging import start_logging, LOG_LEVELS
+from profiling import stage_profiler
+from rover_session import RoverSession
+from perception_pool import PerceptionPool
+
+log = logging.getLogger(__name__)
 
 # Initialize socketio server and Flask application
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
+# Session driving the one simulator, unless serving a fleet
+rover_session = None
 
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying
-# map output looks green in the display image
-ground_truth_3d = np.dstack(
-    (ground_truth*0, ground_truth*255, ground_truth*0)
-).astype(np.float)
+# Sessions of the simulators of a fleet by socketio connection id
+fleet_sessions = {}
 
+# Worker processes running the sessions, unless run by the server
+perception_pool = None
 
-class RoverTelemetry():
-    """
-    Create a class to be a container for rover state telemetry values.
-
-    This allows for tracking telemetry values and results from
-    perception analysis
-
-    """
-
-    def __init__(self):
-        """
-        Initialize a RoverTelemetry instance to retain parameters.
-
-        NOTE: distances in meters and angles in degrees
-
-        """
-        self.start_time = None  # To record the start time of navigation
-        self.total_time = None  # To record total duration of navigation
-        self.img = None  # Current camera image
-        self.pos = None  # Current position (x, y)
-        self.yaw = None  # Current yaw angle
-        self.pitch = None  # Current pitch angle
-        self.roll = None  # Current roll angle
-        self.vel = None  # Current velocity (m/s)
-        self.steer = 0  # Current steering angle
-        self.throttle = 0  # Current throttle value
-        self.brake = 0  # Current brake value
-
-        self.nav_dists = None  # Distances to navigable terrain pixels
-        self.nav_angles = None  # Angles of navigable terrain pixels
-        self.nav_angles_left = None  # Nav terrain angles left of rover heading
-
-        self.obs_dists = None  # Distances to obstacle terrain pixels
-        self.obs_angles = None  # Angles of obstacle terrain pixels
-
-        self.rock_dists = None  # Distances to rock terrain pixels
-        self.rock_angles = None  # Angles of rock terrain pixels
-
-        self.samples_pos = None  # To store the actual sample positions
-        self.samples_to_find = 0  # To store the initial count of samples
-        self.samples_collected = 0  # To count the number of samples collected
-        self.near_sample = 0  # To be set to TLM value data["near_sample"]
-        self.picking_up = 0  # To be set to TLM value data["picking_up"]
-        self.send_pickup = False  # Set to True to trigger rock pickup
-
-        self.home_distance = None  # Current distance to starting location
-        self.home_heading = None  # Current heading to starting location
-        self.going_home = False  # Default rover configuration
-
-        self.timer_on = False  # Timer to determine duration of stuck
-        self.stuck_heading = 0.0  # Heading at the time of getting stuck
-
-        # Rover vision image to be updated with displays of
-        # intermediate analysis steps on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float)
-
-        # Worldmap image to be updated with the positions of
-        # ROIs navigable terrain, obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)
-        self.ground_truth = ground_truth_3d  # Ground truth worldmap
-        # To update % of ground truth map successfully found
-        self.perc_mapped = 0
-
-
-# Initialize our rover
-Rover = RoverTelemetry()
-
-# Initialize decision supervisor
-Decider = decision_new.DecisionSupervisor()
-
-# Variables to track frames per second (FPS)
-# Initialize frame counter
-frame_counter = 0
 
-# Initialize second counter
-second_counter = time.time()
-fps = None
+def get_session(sid):
+    """Get the session driving the simulator of a connection."""
+    if not args.fleet:
+        return rover_session
+    if sid not in fleet_sessions:
+        image_folder = ''
+        if args.image_folder != '':
+            image_folder = os.path.join(args.image_folder, sid)
+            os.makedirs(image_folder, exist_ok=True)
+        fleet_sessions[sid] = make_session(sid, image_folder)
+        log.info("Driving %d simulators", len(fleet_sessions))
+    return fleet_sessions[sid]
+
+
+def make_session(name, image_folder=''):
+    """Create a session driving one simulator as set by the arguments."""
+    if perception_pool is not None:
+        return perception_pool.open_session(name, image_folder)
+    session = RoverSession(
+        name, perception_mode=args.perception_mode, roi=perception_roi,
+        jpeg_decoder=args.jpeg_decoder, hud_rate=args.hud_rate,
+        frame_budget=args.frame_budget/1000, image_folder=image_folder
+    )
+    # Keep table building out of the first frame's deadline
+    session.warm_up()
+    return session
 
 
 # Define telemetry function for what to do with incoming data
@@ -143,76 +95,99 @@ def telemetry(sid, data):
     (nominally 25 times per second)
 
     """
-    global frame_counter, second_counter, fps
-    frame_counter += 1
-    # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    session = get_session(sid)
+    session.count_frame()
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
-
-            # Execute perception and decision steps to update Rover's telemetry
-            Rover = perception_step(Rover)
-            Rover = Decider.execute(Rover)
-
-            # Create output images to send to server
-            out_image_strings = create_output_images(Rover, Decider)
-            out_image_string1, out_image_string2 = out_image_strings
-
-            # The action step!  Send commands to the rover!
-
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in response to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                Rover.send_pickup = False  # Reset Rover flags
+        # Drop frames arriving while the previous one is still processed
+        if session.busy:
+            session.dropped += 1
+            return
+        session.busy = True
+        try:
+            # Frames of a fleet or run by worker processes are processed
+            # off the hub, in native threads, so sessions run concurrently
+            if args.fleet or perception_pool is not None:
+                valid = tpool.execute(session.process, data)
             else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+                valid = session.process(data)
+        finally:
+            session.busy = False
+            # Close the session of a simulator that disconnected while
+            # its frame was processed, now that the frame is done
+            if session.closing:
+                session.close()
+        if session.closing:
+            return
+
+        # The action step!  Send commands to the rover, only to the
+        # simulator sending the frame when serving a fleet
+
+        # Don't send both pickup and control commands, they both trigger
+        # the simulator to send back new telemetry so we must only send
+        # one back in response to the current telemetry data.
+        to = sid if args.fleet else None
+        kind, params = session.command(valid)
+        start = stage_profiler.start()
+        if kind == 'pickup':
+            send_pickup(to)
         else:
+            # Send commands (null for invalid telemetry) to the rover!
+            send_control(*params, to)
+        stage_profiler.lap('send_control', start)
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # To save camera images from autonomous driving, specify a path
+        # Measure frame cost and record the frame, to save camera images
+        # from autonomous driving specify a path
         # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        session.end_frame()
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        emit('manual', {}, sid if args.fleet else None)
 
 
 @sio.on('connect')
 def connect(sid, environ):
     """Invoke the connect event handler."""
-    print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    log.info("connect %s", sid)
+    get_session(sid)
+    to = sid if args.fleet else None
+    send_control((0, 0, 0), '', '', to)
     sample_data = {}
-    sio.emit(
-        "get_samples",
-        sample_data,
-        skip_sid=True)
+    emit("get_samples", sample_data, to)
+
+
+@sio.on('disconnect')
+def disconnect(sid):
+    """Close the session of a simulator of the fleet disconnecting."""
+    log.info("disconnect %s", sid)
+    session = fleet_sessions.pop(sid, None)
+    if session is None:
+        return
+    # A frame still processed in a native thread or worker uses the
+    # session, which telemetry() then closes once the frame is done
+    if session.busy:
+        session.closing = True
+    else:
+        session.close()
+
+
+def emit(event, data, to=None):
+    """
+    Emit an event via socketIO server.
+
+    Keyword arguments:
+    event -- name of the event
+    data -- dictionary sent with the event
+    to -- connection id of the only simulator to send to, None for all
+
+    """
+    if to is None:
+        sio.emit(event, data, skip_sid=True)
+    else:
+        sio.emit(event, data, room=to)
 
 
-def send_control(commands, image_string1, image_string2):
+def send_control(commands, image_string1, image_string2, to=None):
     """Send control commands to the rover."""
     data = {
         'throttle': commands[0].__str__(),
@@ -222,21 +197,15 @@ def send_control(commands, image_string1, image_string2):
         'inset_image2': image_string2,
         }
     # Send commands via socketIO server
-    sio.emit(
-        "data",
-        data,
-        skip_sid=True)
+    emit("data", data, to)
     eventlet.sleep(0)
 
 
-def send_pickup():
+def send_pickup(to=None):
     """Send command to pickup rock sample."""
-    print("Picking up")
+    log.info("Picking up")
     pickup = {}
-    sio.emit(
-        "pickup",
-        pickup,
-        skip_sid=True)
+    emit("pickup", pickup, to)
     eventlet.sleep(0)
 
 
@@ -250,22 +219,189 @@ if __name__ == '__main__':
         help='Path to image folder.' +
         ' This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--perception-mode',
+        type=str,
+        default='warp_image',
+        choices=PERCEPTION_MODES,
+        help='How ROI pixels are labelled in the perspective frame.' +
+        ' warp_labels trades warped-image fidelity for lower latency.'
+    )
+    parser.add_argument(
+        '--hud-rate',
+        type=float,
+        default=5.0,
+        help='Rate (Hz) at which display overlays are rendered in the' +
+        ' background. 0 renders them synchronously on every frame.'
+    )
+    parser.add_argument(
+        '--jpeg-decoder',
+        type=str,
+        default='pil',
+        choices=JPEG_DECODERS,
+        help='Library used to decode camera images.'
+    )
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='INFO',
+        choices=LOG_LEVELS,
+        help='Minimum level of logged messages. Rover status is logged' +
+        ' every frame at DEBUG level.'
+    )
+    parser.add_argument(
+        '--log-rate',
+        type=float,
+        default=1.0,
+        help='Rate (Hz) at which per-frame rover status is logged.' +
+        ' 0 logs every frame.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Time each stage of the control loop and show latencies' +
+        ' on the rover vision display.'
+    )
+    parser.add_argument(
+        '--profile-json',
+        type=str,
+        default='',
+        help='Path to write stage latency statistics to as JSON on exit.' +
+        ' Implies --profile.'
+    )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help='Perceive only pixels inside the camera field of view.' +
+        ' Gives the same rover state at lower latency.'
+    )
+    parser.add_argument(
+        '--roi-dist',
+        type=float,
+        default=None,
+        help='Perceive only pixels closer than this to the rover.' +
+        ' Implies --roi. Events then count fewer pixels.'
+    )
+    parser.add_argument(
+        '--roi-step',
+        type=int,
+        default=1,
+        help='Perceive only every n-th row and column of pixels.' +
+        ' Implies --roi when above 1. Events then count fewer pixels.'
+    )
+    parser.add_argument(
+        '--frame-budget',
+        type=float,
+        default=40.0,
+        help='Time (ms) available to process a frame before HUD' +
+        ' rendering, map updates and full resolution thresholding are' +
+        ' shed in turn. 0 disables degradation.'
+    )
+    parser.add_argument(
+        '--fleet',
+        action='store_true',
+        help='Drive every connecting simulator as a separate rover,' +
+        ' processing their frames concurrently. Frames are recorded in' +
+        ' a subfolder of image_folder per simulator.'
+    )
+    parser.add_argument(
+        '--fleet-threads',
+        type=int,
+        default=None,
+        help='Number of native threads processing frames of the fleet,' +
+        ' defaults to one per CPU core. With --perception-workers the' +
+        ' threads only wait on the workers.'
+    )
+    parser.add_argument(
+        '--perception-workers',
+        type=int,
+        default=0,
+        help='Number of worker processes decoding and processing frames,' +
+        ' leaving the server to I/O only. 0 processes frames in the' +
+        ' server process.'
+    )
     args = parser.parse_args()
 
+    # Time stages of the control loop, keeping rolling percentiles
+    stage_profiler.enabled = args.profile or bool(args.profile_json)
+
+    # Write logs from a background thread, off the control loop
+    log_listener = start_logging(args.log_level)
+    status_log.rate = args.log_rate
+
+    # Perceive only the pixels that matter, if requested
+    perception_roi = None
+    if args.roi or args.roi_dist is not None or args.roi_step > 1:
+        perception_roi = get_perception_roi(max_dist=args.roi_dist,
+                                            step=args.roi_step)
+
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
-        print("Creating image folder at {}".format(args.image_folder))
+        log.info("Creating image folder at %s", args.image_folder)
         if not os.path.exists(args.image_folder):
             os.makedirs(args.image_folder)
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
-        print("Recording this run ...")
+        log.info("Recording this run ...")
+    else:
+        log.info("NOT recording this run ...")
+
+    if args.perception_workers > 0:
+        # Fork the workers before the server handles any connection
+        roi_config = None
+        if perception_roi is not None:
+            roi_config = args.roi_dist, args.roi_step
+        perception_pool = PerceptionPool(
+            args.perception_workers, perception_mode=args.perception_mode,
+            roi=roi_config, jpeg_decoder=args.jpeg_decoder,
+            hud_rate=args.hud_rate, frame_budget=args.frame_budget/1000,
+            log_level=args.log_level
+        )
+        log.info("Processing frames in %d worker processes",
+                 args.perception_workers)
+
+    if args.fleet:
+        # Build lookup tables shared by all sessions once, before
+        # sessions perceive concurrently
+        ColorClassifier().lut
+        # Threads waiting on perception workers need no limit
+        if perception_pool is None or args.fleet_threads:
+            tpool.set_num_threads(args.fleet_threads or os.cpu_count())
     else:
-        print("NOT recording this run ...")
+        rover_session = make_session('rover', args.image_folder)
 
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        for session in [rover_session] + list(fleet_sessions.values()):
+            if session is not None:
+                session.close()
+        if perception_pool is not None:
+            worker_stats = perception_pool.stats()
+            for worker, stats in enumerate(worker_stats):
+                log.info("Worker %d: %d sessions, %d frames,"
+                         " process p95 %.2f ms, round trip p95 %.2f ms",
+                         worker, stats['sessions'], stats['frames'],
+                         stats['process_ms'].get('p95', float('nan')),
+                         stats['round_trip_ms'].get('p95', float('nan')))
+            if args.profile_json:
+                # Stages up to the decision are timed by the workers
+                for stats, stages in zip(worker_stats,
+                                         perception_pool.stages()):
+                    stats['stages'] = stages
+                with open(args.profile_json, 'w') as json_file:
+                    json.dump({'server': stage_profiler.summary(),
+                               'workers': worker_stats},
+                              json_file, indent=2)
+            perception_pool.shutdown()
+        elif args.profile_json:
+            stage_profiler.dump(args.profile_json)
+        if args.profile_json:
+            log.info("Wrote stage latencies to %s", args.profile_json)
+        # Write records still queued, the reports above among them
+        log_listener.stop()
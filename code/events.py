@@ -14,9 +14,6 @@ __author__ = 'Salman Hashmi'
 __license__ = 'BSD License'
 
 
-import numpy as np
-
-
 def velocity_exceeded(Rover, max_vel=2.0):
     """
     Check if velocity is under max_vel.
@@ -34,7 +31,7 @@ def front_path_clear(Rover, safe_pixs=500):
     Keyword arguments:
     safe_pixs -- minimum number of pixels in front to deem front path clear
     """
-    nav_pixs_front = len(Rover.nav_angles)
+    nav_pixs_front = Rover.features.count('nav_angles')
     return nav_pixs_front >= safe_pixs
 
 
@@ -45,7 +42,7 @@ def left_path_clear(Rover, safe_pixs=1500):
     Keyword arguments:
     safe_pixs -- minimum number of pixels on left to deem left path clear
     """
-    nav_pixs_left = len(Rover.nav_angles_left)
+    nav_pixs_left = Rover.features.count('nav_angles_left')
     return nav_pixs_left >= safe_pixs
 
 
@@ -56,7 +53,7 @@ def pointed_at_nav(Rover, angle_limit=17):
     Keyword arguments:
     angle_limit -- angle range limit for nav angles (degrees)
     """
-    nav_heading = np.mean(Rover.nav_angles)
+    nav_heading = Rover.features.mean('nav_angles')
     return -angle_limit <= nav_heading <= angle_limit
 
 
@@ -68,8 +65,9 @@ def pointed_along_wall(Rover, safe_pixs=500, wall_angle_bias=-10):
     safe_pixs --  minimum number of pixels to keep from wall
     wall_angle_bias -- to bias rover heading for pointing along wall (degrees)
     """
-    nav_pixs_left = len(Rover.nav_angles_left)
-    nav_heading_left = np.mean(Rover.nav_angles_left) + wall_angle_bias
+    nav_pixs_left = Rover.features.count('nav_angles_left')
+    nav_heading_left = (Rover.features.mean('nav_angles_left')
+                        + wall_angle_bias)
 
     return (nav_pixs_left >= safe_pixs
             and nav_heading_left > 0)
@@ -82,7 +80,7 @@ def deviated_from_wall(Rover, max_angle_wall=25):
     Keyword arguments:
     max_angle_wall --  maximum allowed angle from left wall (degrees)
     """
-    nav_heading_left = np.mean(Rover.nav_angles_left)
+    nav_heading_left = Rover.features.mean('nav_angles_left')
     return nav_heading_left > max_angle_wall
 
 
@@ -93,7 +91,7 @@ def at_front_obstacle(Rover, safe_pixs=600):
     Keyword arguments:
     safe_pixs -- minimum number of pixels to keep from front obstacles
     """
-    nav_pixs_front = len(Rover.nav_angles)
+    nav_pixs_front = Rover.features.count('nav_angles')
     return nav_pixs_front < safe_pixs
 
 
@@ -105,7 +103,7 @@ def at_left_obstacle(Rover, safe_pixs=50):
     safe_pixs -- minimum number of pixels to keep from left obstacles
     """
 
-    nav_pixs_left = len(Rover.nav_angles_left)
+    nav_pixs_left = Rover.features.count('nav_angles_left')
     return nav_pixs_left < safe_pixs
 
 
@@ -117,8 +115,8 @@ def sample_on_left(Rover, rock_dist_limit=71, min_left_angle=0.0):
     min_left_angle -- rocks only detected when left of this angle from rover
     """
 
-    rock_heading = np.mean(Rover.rock_angles)
-    rock_distance = np.mean(Rover.rock_dists)
+    rock_heading = Rover.features.mean('rock_angles')
+    rock_distance = Rover.features.mean('rock_dists')
 
     return (rock_heading >= min_left_angle
             and rock_distance < rock_dist_limit)
@@ -133,8 +131,8 @@ def sample_right_close(Rover, rock_dist_limit=75, max_right_angle=17):
     max_right_angle -- only rocks to left/above of this are considered
     """
 
-    rock_heading = np.mean(Rover.rock_angles)
-    rock_distance = np.mean(Rover.rock_dists)
+    rock_heading = Rover.features.mean('rock_angles')
+    rock_distance = Rover.features.mean('rock_dists')
 
     return (rock_heading > -max_right_angle
             and rock_distance < rock_dist_limit)
@@ -142,7 +140,7 @@ def sample_right_close(Rover, rock_dist_limit=75, max_right_angle=17):
 
 def sample_in_view(Rover):
     """Check if rock sample still in view."""
-    rock_pixs = len(Rover.rock_angles)
+    rock_pixs = Rover.features.count('rock_angles')
     return rock_pixs >= 1
 
 
@@ -153,7 +151,7 @@ def pointed_at_sample(Rover, angle_limit=17):
     Keyword arguments:
     angle_limit -- angle range limit for rock angles (radians)
     """
-    rock_heading = np.mean(Rover.rock_angles)
+    rock_heading = Rover.features.mean('rock_angles')
     return -angle_limit < rock_heading < angle_limit
 
 
@@ -163,9 +161,16 @@ def can_pickup_sample(Rover):
 
 
 def completed_mission(Rover, min_samples=6, min_mapped=95, max_time=680):
-    """Check if rover has completed mission criteria."""
+    """
+    Check if rover has completed mission criteria.
+
+    Keyword arguments:
+    min_samples -- number of samples to collect
+    min_mapped -- percentage of the worldmap to map
+    max_time -- time limit of the mission, total time on Rover.clock
+    """
     return (Rover.samples_collected >= min_samples
-            and Rover.perc_mapped >= min_mapped
+            and Rover.map_stats.perc_mapped >= min_mapped
             ) or Rover.total_time >= max_time
 
 
@@ -0,0 +1,83 @@
+"""
+Module for features of a perception frame shared by events and states.
+
+Events and states reduce the same ROI pixel arrays of a frame, e.g. the
+mean of nav angles gives the nav heading checked by pointed_at_nav and
+steered to by several states. FrameFeatures computes each reduction the
+first time it is asked for in a frame and returns the stored result
+thereafter, until perception_step starts the next frame.
+
+NOTE:
+distance -- rover frame pixels
+angle, heading -- degrees
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import numpy as np
+
+
+# Rover attributes holding ROI pixel arrays of the current frame
+FEATURE_ARRAYS = (
+    'nav_angles', 'nav_angles_left', 'nav_dists',
+    'obs_angles', 'obs_dists',
+    'rock_angles', 'rock_dists',
+)
+
+# Reductions available of each array
+FEATURE_REDUCTIONS = {
+    'count': len,
+    'mean': np.mean,
+    'median': np.median,
+}
+
+
+class FrameFeatures():
+    """
+    Create a class for reductions of ROI pixel arrays, once per frame.
+
+    Reductions are those of numpy, so means and medians of empty arrays
+    are NaN just as when events and states computed them directly.
+
+    """
+
+    def __init__(self):
+        """Initialize a FrameFeatures instance with no frame yet."""
+        self.frame = 0  # Number of frames seen, identifies the current one
+        self.arrays = {}  # Array name -> ROI pixel array of current frame
+        self.values = {}  # (reduction, array name) -> computed value
+
+    def update(self, Rover):
+        """Start a new frame from the ROI pixel arrays of Rover."""
+        self.frame += 1
+        self.arrays = {name: getattr(Rover, name) for name in FEATURE_ARRAYS}
+        self.values = {}
+
+    def get(self, reduction, name):
+        """
+        Get a reduction of an ROI pixel array, computing it at most once.
+
+        Keyword arguments:
+        reduction -- one of FEATURE_REDUCTIONS
+        name -- one of FEATURE_ARRAYS
+
+        """
+        key = reduction, name
+        if key not in self.values:
+            self.values[key] = FEATURE_REDUCTIONS[reduction](self.arrays[name])
+        return self.values[key]
+
+    def count(self, name):
+        """Return the number of pixels in ROI pixel array name."""
+        return self.get('count', name)
+
+    def mean(self, name):
+        """Return the mean of ROI pixel array name."""
+        return self.get('mean', name)
+
+    def median(self, name):
+        """Return the median of ROI pixel array name."""
+        return self.get('median', name)
@@ -1,6 +1,17 @@
 """
 Module for handling switching from states.
 
+Transitions out of each state are declared in TRANSITIONS as an ordered
+list of (guard, next state, action) entries. The decision supervisor
+compiles the table once and on every frame takes the first transition
+of the current state whose guard holds, performs its action and
+switches to its next state, or stays in the current state if none holds.
+
+Guards are event names, Guard instances, or combinations of them with
+both(), either() and negate(). They are evaluated in order and only
+until one holds, so guards with side effects such as stuck_for() run
+exactly when the original if/elif chains reached them.
+
 NOTE:
 time -- seconds
 distance -- meters
@@ -14,150 +25,160 @@ __author__ = 'Salman Hashmi'
 __license__ = 'BSD License'
 
 
-def finding_wall(Decider, Rover):
-    """Handle switching from FindWall state."""
-    if 45 < Rover.yaw < 65:
-        Decider.switch_to_state(Rover, Decider.state[1])  # FollowWall
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
+class Guard():
+    """Create a class for a described condition on the rover state."""
+
+    def __init__(self, check, description):
+        """
+        Initialize a Guard instance.
+
+        Keyword arguments:
+        check -- function of (Decider, Rover) returning True if the guard
+                 holds
+        description -- readable form of the condition, for introspection
+
+        """
+        self.check = check
+        self.description = description
+
+    def __repr__(self):
+        """Return the description of the guard."""
+        return self.description
 
 
-def following_wall(Decider, Rover):
-    """Handle switching from FollowWall state."""
-    # Time in seconds allowed to remain stuck in this state
-    stucktime = 2.0
-    if Decider.both_events(Rover, 'deviated_from_wall', 'left_path_clear'):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[2])  # TurnToWall
-
-    elif Decider.is_event(Rover, 'at_left_obstacle'):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[3])  # AvoidWall
-
-    elif Decider.either_events(Rover, 'sample_on_left', 'sample_right_close'):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[5])  # GoToSample
-
-    elif Decider.is_event(Rover, 'completed_mission'):
-        Rover.going_home = True
-        Decider.switch_to_state(Rover, Decider.state[11])  # ReturnHome
-
-    elif Decider.is_stuck_for(Rover, stucktime):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[10])  # GetUnstuck
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def turning_to_wall(Decider, Rover):
-    """Handle switching from TurnToWall state."""
-    if Decider.is_event(Rover, 'pointed_along_wall'):
-        Decider.switch_to_state(Rover, Decider.state[1])  # FollowWall
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def avoiding_wall(Decider, Rover):
-    """Handle switching from AvoidWall state."""
-    if Decider.is_event(Rover, 'pointed_along_wall'):
-        Decider.switch_to_state(Rover, Decider.state[1])  # FollowWall
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def avoiding_obstacles(Decider, Rover):
-    """Handle switching from AvoidObstacles state."""
-    if Decider.both_events(Rover, 'front_path_clear', 'pointed_at_nav'):
-        Decider.switch_to_state(Rover, Decider.state[11])  # ReturnHome
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def going_to_sample(Decider, Rover):
-    """Handle switching from GoToSample state."""
-    # Time in seconds allowed to remain stuck in this state
-    stucktime = 4.0
-    # if Decider.is_event(Rover, 'sample_in_view'):
-    if Rover.near_sample:
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[6])  # Stop
-
-    elif Decider.is_stuck_for(Rover, stucktime):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[10])  # GetUnstuck
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def stopped_at_sample(Decider, Rover):
-    """Handle switching from Stop state."""
-    if Decider.is_event(Rover, 'can_pickup_sample'):
-        Decider.switch_to_state(Rover, Decider.state[7])  # InitiatePickup
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def initiating_pickup(Decider, Rover):
-    """Handle switching from InitiatePickup state."""
-    Decider.switch_to_state(Rover, Decider.state[8])  # WaitForPickupInitiate
-
-
-def waiting_pickup_initiate(Decider, Rover):
-    """Handle switching from WaitForPickupInitiate state."""
-    if Rover.picking_up == 1:
-        Decider.switch_to_state(Rover, Decider.state[9])  # WaitForPickupFinish
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def waiting_pickup_finish(Decider, Rover):
-    """Handle switching from WaitForPickupFinish state."""
-    if Rover.picking_up == 0:
-        Decider.switch_to_state(Rover, Decider.state[3])  # AvoidWall
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def getting_unstuck(Decider, Rover):
-    """Handle switching from GetUnstuck state."""
-    # If reached sufficient velocity or stuck while in GetUnstuck state
-    # then get out of GetUnstuck state
-    stucktime = 2.3
-    if Rover.vel >= 1.0:
-        if Rover.going_home:
-            Decider.switch_to_state(Rover, Decider.state[11])  # ReturnHome
-        else:
-            Decider.switch_to_state(Rover, Decider.state[1])  # FollowWall
-
-    elif Decider.is_stuck_for(Rover, stucktime):
-        Rover.timer_on = False
-        if Rover.going_home:
-            Decider.switch_to_state(Rover, Decider.state[11])  # ReturnHome
-        else:
-            Decider.switch_to_state(Rover, Decider.state[1])  # FollowWall
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def returning_home(Decider, Rover):
-    """Handle switching from ReturnHome state."""
-    # Time in seconds allowed to remain stuck in this state
-    stucktime = 2.5
-    if Decider.is_event(Rover, 'at_front_obstacle'):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[4])  # AvoidObstacles
-
-    elif Decider.is_event(Rover, 'reached_home'):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[12])  # Park
-
-    elif Decider.is_stuck_for(Rover, stucktime):
-        Rover.timer_on = False
-        Decider.switch_to_state(Rover, Decider.state[10])  # GetUnstuck
-    else:
-        Decider.switch_to_state(Rover, Decider.curr_state)
-
-
-def parking(Decider, Rover):
-    """Handle switching from Park state."""
-    Decider.switch_to_state(Rover, Decider.state[12])  # Remain in Park
+def as_guard(guard):
+    """Return guard as a Guard, turning event names into event guards."""
+    if isinstance(guard, Guard):
+        return guard
+    return event(guard)
+
+
+def event(name):
+    """Guard holding if the event name of DecisionSupervisor has occurred."""
+    def check(Decider, Rover):
+        return Decider.is_event(Rover, name)
+    return Guard(check, name)
+
+
+def both(guard1, guard2):
+    """Guard holding if both guards hold."""
+    guard1, guard2 = as_guard(guard1), as_guard(guard2)
+    check1, check2 = guard1.check, guard2.check
+
+    def check(Decider, Rover):
+        return check1(Decider, Rover) and check2(Decider, Rover)
+    return Guard(check, '{} and {}'.format(guard1, guard2))
+
+
+def either(guard1, guard2):
+    """Guard holding if either guard holds."""
+    guard1, guard2 = as_guard(guard1), as_guard(guard2)
+    check1, check2 = guard1.check, guard2.check
+
+    def check(Decider, Rover):
+        return check1(Decider, Rover) or check2(Decider, Rover)
+    return Guard(check, '({} or {})'.format(guard1, guard2))
+
+
+def negate(guard):
+    """Guard holding if guard does not hold."""
+    guard = as_guard(guard)
+    check_guard = guard.check
+
+    def check(Decider, Rover):
+        return not check_guard(Decider, Rover)
+    return Guard(check, 'not {}'.format(guard))
+
+
+def rover(predicate, description):
+    """Guard holding if predicate(Rover) is true."""
+    def check(Decider, Rover):
+        return predicate(Rover)
+    return Guard(check, description)
+
+
+def stuck_for(stucktime):
+    """Guard holding if rover has not moved for stucktime seconds."""
+    def check(Decider, Rover):
+        return Decider.is_stuck_for(Rover, stucktime)
+    return Guard(check, 'stuck_for({})'.format(stucktime))
+
+
+# Guards of rover telemetry flags
+always = Guard(lambda Decider, Rover: True, 'always')
+going_home = rover(lambda Rover: Rover.going_home, 'going_home')
+near_sample = rover(lambda Rover: Rover.near_sample, 'near_sample')
+
+
+def stop_timer(Rover):
+    """Switch OFF the stuck timer, to restart it in the next state."""
+    Rover.timer_on = False
+
+
+def start_going_home(Rover):
+    """Flag that the mission is completed and rover is returning home."""
+    Rover.going_home = True
+
+
+# State class name -> ordered (guard, next state class name, action)
+# transitions, actions being None or a function of Rover
+TRANSITIONS = {
+    'FindWall': (
+        (rover(lambda Rover: 45 < Rover.yaw < 65, '45 < yaw < 65'),
+         'FollowWall', None),
+    ),
+    'FollowWall': (
+        (both('deviated_from_wall', 'left_path_clear'),
+         'TurnToWall', stop_timer),
+        ('at_left_obstacle', 'AvoidWall', stop_timer),
+        (either('sample_on_left', 'sample_right_close'),
+         'GoToSample', stop_timer),
+        ('completed_mission', 'ReturnHome', start_going_home),
+        (stuck_for(2.0), 'GetUnstuck', stop_timer),
+    ),
+    'TurnToWall': (
+        ('pointed_along_wall', 'FollowWall', None),
+    ),
+    'AvoidWall': (
+        ('pointed_along_wall', 'FollowWall', None),
+    ),
+    'AvoidObstacles': (
+        (both('front_path_clear', 'pointed_at_nav'), 'ReturnHome', None),
+    ),
+    'GoToSample': (
+        (near_sample, 'Stop', stop_timer),
+        (stuck_for(4.0), 'GetUnstuck', stop_timer),
+    ),
+    'Stop': (
+        ('can_pickup_sample', 'InitiatePickup', None),
+    ),
+    'InitiatePickup': (
+        (always, 'WaitForPickupInitiate', None),
+    ),
+    'WaitForPickupInitiate': (
+        (rover(lambda Rover: Rover.picking_up == 1, 'picking_up'),
+         'WaitForPickupFinish', None),
+    ),
+    'WaitForPickupFinish': (
+        (rover(lambda Rover: Rover.picking_up == 0, 'not picking_up'),
+         'AvoidWall', None),
+    ),
+    # Once sufficient velocity is reached or stuck while getting unstuck,
+    # resume returning home or following the wall. Stuck time is checked
+    # by exactly one of the last two transitions
+    'GetUnstuck': (
+        (both(rover(lambda Rover: Rover.vel >= 1.0, 'vel >= 1.0'),
+              going_home),
+         'ReturnHome', None),
+        (rover(lambda Rover: Rover.vel >= 1.0, 'vel >= 1.0'),
+         'FollowWall', None),
+        (both(going_home, stuck_for(2.3)), 'ReturnHome', stop_timer),
+        (both(negate(going_home), stuck_for(2.3)), 'FollowWall', stop_timer),
+    ),
+    'ReturnHome': (
+        ('at_front_obstacle', 'AvoidObstacles', stop_timer),
+        ('reached_home', 'Park', stop_timer),
+        (stuck_for(2.5), 'GetUnstuck', stop_timer),
+    ),
+    'Park': (),
+}
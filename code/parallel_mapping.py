@@ -0,0 +1,231 @@
+"""
+Build worldmaps of long recorded runs on all CPU cores.
+
+The frames of a recording are decoded into one shared memory block and
+split into contiguous shards. Each worker process maps its shards into a
+partial worldmap with BatchPerception, reading frames straight from the
+shared block so images are never pickled. Detections are only counted,
+so the partial worldmaps add up exactly to the worldmap built frame by
+frame.
+
+Example:
+$ python parallel_mapping.py ../test_dataset_2 --workers 4
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from batch_perception import BatchPerception, read_poses
+from perception import PERCEPTION_MODES
+from replay import iter_robot_log
+from rover_telemetry import RoverTelemetry
+from worldmap import WorldMap, NAV_CHANNEL
+
+
+class SharedFrames():
+    """
+    Create a class to hold a stack of camera frames in shared memory.
+
+    The process creating the frames owns the block and must unlink() it,
+    other processes attach to it by name and only close() it. Attaching
+    registers the block with the resource tracker as well, so attaching
+    processes must share the tracker of the creating process, started
+    before they are, for the block not to be freed again at their exit.
+
+    """
+
+    def __init__(self, shape, name=None):
+        """
+        Create a shared frame stack, or attach to an existing one.
+
+        Keyword arguments:
+        shape -- N x height x width x 3 shape of the uint8 frame stack
+        name -- name of an existing block to attach to, None to create one
+
+        """
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray(self.shape, dtype=np.uint8,
+                                 buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        """Name other processes attach to the shared block with."""
+        return self.shm.name
+
+    def close(self):
+        """Detach this process from the shared block."""
+        self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared block once all processes have closed it."""
+        self.shm.unlink()
+
+
+# State of each worker process, set up once by _init_worker
+_worker_frames = None
+_worker_perception = None
+
+
+def _init_worker(frames_name, frames_shape, mode):
+    """Attach a worker process to the shared frames."""
+    global _worker_frames, _worker_perception
+    _worker_frames = SharedFrames(frames_shape, name=frames_name)
+    _worker_perception = BatchPerception(mode=mode)
+    # Build the color lookup table before mapping, unless inherited
+    _worker_perception.classifier.lut
+
+
+def _decode_shard(first, img_paths):
+    """Decode camera images into the shared frames from index first."""
+    for frame, img_path in enumerate(img_paths, first):
+        _worker_frames.frames[frame] = mpimg.imread(img_path)
+
+
+def _map_shard(first, poses, batch_size):
+    """
+    Map a shard of the shared frames into a partial worldmap.
+
+    Keyword arguments:
+    first -- index of the first frame of the shard
+    poses -- tuple of rover_pos, rover_yaw, rover_pitch, rover_roll
+             arrays of the frames of the shard
+    batch_size -- number of frames mapped per batch
+
+    Return value:
+    counts, num_hits -- counters and total detections of the partial
+                        worldmap
+
+    """
+    worldmap = WorldMap()
+    num_frames = len(poses[1])
+    for start in range(0, num_frames, batch_size):
+        stop = min(start + batch_size, num_frames)
+        _worker_perception.map_frames(
+            _worker_frames.frames[first+start:first+stop],
+            *(pose[start:stop] for pose in poses), worldmap=worldmap
+        )
+    return worldmap.counts, worldmap.num_hits
+
+
+def build_worldmap(dataset_dir, mode='warp_image', workers=None,
+                   shards_per_worker=4, batch_size=64):
+    """
+    Build the worldmap of a recorded dataset in parallel.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+    mode -- one of perception.PERCEPTION_MODES
+    workers -- number of worker processes, None for one per CPU core
+    shards_per_worker -- shards of frames per worker, more shards even
+                         out workers mapping frames at different speeds
+    batch_size -- number of frames mapped per batch by a worker
+
+    Return value:
+    Rover, times -- RoverTelemetry holding the worldmap and map statistics,
+                    and dict of seconds spent decoding and mapping frames
+
+    """
+    rows = list(iter_robot_log(dataset_dir))
+    poses = read_poses(rows)
+    img_paths = [row['Path'] for row in rows]
+    height, width, _ = mpimg.imread(img_paths[0]).shape
+    workers = workers or os.cpu_count()
+
+    num_shards = max(1, min(len(rows), workers*shards_per_worker))
+    bounds = np.linspace(0, len(rows), num_shards + 1).astype(int)
+    shards = list(zip(bounds[:-1], bounds[1:]))
+
+    # Build the color lookup table once, forked workers inherit it
+    BatchPerception(mode=mode).classifier.lut
+    # Workers share the resource tracker freeing the shared frames
+    resource_tracker.ensure_running()
+
+    Rover = RoverTelemetry()
+    times = {}
+    shared_frames = SharedFrames((len(rows), height, width, 3))
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(shared_frames.name, shared_frames.shape, mode)
+        ) as executor:
+            start = time.perf_counter()
+            list(executor.map(
+                _decode_shard, bounds[:-1],
+                [img_paths[first:last] for first, last in shards]
+            ))
+            times['decode'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for counts, num_hits in executor.map(
+                    _map_shard, bounds[:-1],
+                    [tuple(pose[first:last] for pose in poses)
+                     for first, last in shards],
+                    [batch_size]*len(shards)):
+                # Reduce partial worldmaps as they complete
+                Rover.worldmap.add_counts(counts, num_hits)
+            times['map'] = time.perf_counter() - start
+    finally:
+        shared_frames.close()
+        shared_frames.unlink()
+
+    Rover.map_stats.add_nav_pixs(
+        np.flatnonzero(Rover.worldmap.layer(NAV_CHANNEL))
+    )
+
+    return Rover, times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map dataset in parallel')
+    parser.add_argument(
+        'dataset',
+        type=str,
+        nargs='?',
+        default='../test_dataset',
+        help='Path to dataset folder holding robot_log.csv and IMG.'
+    )
+    parser.add_argument(
+        '--mode',
+        type=str,
+        default='warp_image',
+        choices=PERCEPTION_MODES,
+        help='Perception mode to map with.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes, defaults to one per CPU core.'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=64,
+        help='Number of frames mapped per batch.'
+    )
+    args = parser.parse_args()
+
+    Rover, times = build_worldmap(args.dataset, args.mode, args.workers,
+                                  batch_size=args.batch_size)
+    num_frames = len(list(iter_robot_log(args.dataset)))
+    for stage, stage_time in times.items():
+        print('{:>8}: {:.1f} fps'.format(stage, num_frames / stage_time))
+    print('{:>8}: {:.1f}% mapped, {:.1f}% fidelity'.format(
+        'worldmap', Rover.map_stats.perc_mapped, Rover.map_stats.fidelity))
@@ -36,11 +36,27 @@ __author__ = 'Salman Hashmi, Ryan Keenan'
 __license__ = 'BSD License'
 
 
+import copy
 from collections import namedtuple
 
 import numpy as np
 import cv2
 
+from profiling import stage_profiler
+
+
+# Binary images of the three ROIs returned by color_thresh()
+ThreshedImages = namedtuple('ThreshedImages', 'nav obs rock')
+
+# Numpy arrays of pixel x,y points in some frame
+PixPoints = namedtuple('PixPoints', 'x y')
+
+# Bit flags identifying each ROI in a single channel label image
+NAV_LABEL, OBS_LABEL, ROCK_LABEL = 1, 2, 4
+
+# Only ROI pixels within these distances from rover are mapped (for fidelity)
+NAV_MAX_DIST, OBS_MAX_DIST, ROCK_MAX_DIST = 60, 80, 70
+
 
 def color_thresh(input_img, rgb_thresh=(160, 160, 160),
                  low_bound=(75, 130, 130), upp_bound=(255, 255, 255)):
@@ -87,57 +103,308 @@ def color_thresh(input_img, rgb_thresh=(160, 160, 160),
     rock_img = cv2.inRange(hsv_img, low_bound, upp_bound)
 
     # Return the threshed binary images
-    ThreshedImages = namedtuple('ThreshedImages', 'nav obs rock')
     thresh_imgs = ThreshedImages(nav_img, obs_img, rock_img)
 
     return thresh_imgs
 
 
-def perspect_transform(src_img, dst_grid=10, bottom_offset=6):
+class ColorClassifier():
     """
-    Apply a perspective transformation to input 3D image.
+    Classify every pixel of an RGB image into ROIs in a single pass.
+
+    A lookup table holding the ROI label of each of the 2^24 RGB colors
+    is built once from color_thresh() so that classifying a frame is one
+    packing of its pixels into 24-bit color indexes followed by a single
+    gather into a preallocated label image. The label image has bits
+    NAV_LABEL, OBS_LABEL and ROCK_LABEL set where each ROI was detected.
+
+    """
+
+    # Lookup tables shared by all instances, keyed by thresholds
+    _luts = {}
+
+    def __init__(self, rgb_thresh=(160, 160, 160),
+                 low_bound=(75, 130, 130), upp_bound=(255, 255, 255)):
+        """
+        Initialize a ColorClassifier instance.
+
+        Keyword arguments:
+        rgb_thresh -- RGB thresh tuple above which only ground pixels are
+                      detected
+        low/up_bounds -- HSV tuples defining color range of gold rock samples
+
+        """
+        self.thresholds = (tuple(rgb_thresh),
+                           tuple(low_bound), tuple(upp_bound))
+        self.packed_img = None  # RGBA buffer viewed as 24-bit color indexes
+        self.label_img = None  # Preallocated uint8 label image
+
+    @property
+    def lut(self):
+        """Lookup table of ROI labels indexed by packed 24-bit colors."""
+        lut = ColorClassifier._luts.get(self.thresholds)
+        if lut is None:
+            lut = build_color_lut(*self.thresholds)
+            ColorClassifier._luts[self.thresholds] = lut
+        return lut
+
+    def classify(self, input_img):
+        """
+        Label navigable/obstacle/rock pixels of input_img.
+
+        Keyword arguments:
+        input_img -- 3 channel uint8 numpy image to classify
+
+        Return value:
+        label_img -- uint8 image of ROI bit flags (reused between calls)
+
+        """
+        height, width = input_img.shape[0], input_img.shape[1]
+        if self.label_img is None or self.label_img.shape != (height, width):
+            self.packed_img = np.zeros((height, width, 4), dtype=np.uint8)
+            self.label_img = np.zeros((height, width), dtype=np.uint8)
+
+        # Pack the R,G,B bytes of each pixel into one little-endian
+        # uint32 index, dropping the alpha byte added by the conversion
+        cv2.cvtColor(input_img, cv2.COLOR_RGB2RGBA, dst=self.packed_img)
+        color_idxs = self.packed_img.view(np.uint32)[:, :, 0]
+        np.bitwise_and(color_idxs, 0xFFFFFF, out=color_idxs)
+
+        # One gather from the lookup table labels the entire image
+        np.take(self.lut, color_idxs, out=self.label_img)
+
+        return self.label_img
+
+
+def build_color_lut(rgb_thresh=(160, 160, 160),
+                    low_bound=(75, 130, 130), upp_bound=(255, 255, 255)):
+    """
+    Build a lookup table of ROI labels for every 24-bit RGB color.
 
     Keyword arguments:
-    src_img -- 3D numpy image on which perspective transform is applied
-    dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
-    bottom_offset -- bottom of cam image is some distance in front of rover
+    rgb_thresh -- RGB thresh tuple above which only ground pixels are detected
+    low/up_bounds -- HSV tuples defining color range of gold rock samples
 
     Return value:
-    dst_img -- 2D warped numpy image with overhead view
+    lut -- uint8 numpy array of 2^24 ROI labels indexed by R | G<<8 | B<<16
+
+    """
+    # Lay out all colors as one 4096x4096 image so that color_thresh()
+    # itself defines the labels and the two paths cannot disagree
+    color_idxs = np.arange(1 << 24, dtype=np.uint32).reshape(4096, 4096)
+    all_colors = np.empty((4096, 4096, 3), dtype=np.uint8)
+    all_colors[:, :, 0] = color_idxs & 0xFF
+    all_colors[:, :, 1] = (color_idxs >> 8) & 0xFF
+    all_colors[:, :, 2] = color_idxs >> 16
+
+    thresh_imgs = color_thresh(all_colors, rgb_thresh, low_bound, upp_bound)
+
+    lut = thresh_imgs.nav * np.uint8(NAV_LABEL)
+    lut[thresh_imgs.obs > 0] |= OBS_LABEL
+    lut[thresh_imgs.rock > 0] |= ROCK_LABEL
 
+    return lut.ravel()
+
+
+# Four source points defining a 1 Sq m grid on the rover camera image
+# acquired from calibration data (example_grid1.jpg) in test notebook
+CALIB_SRC_POINTS = ((14, 140), (301, 140), (200, 96), (118, 96))
+
+
+class PerspectiveCalibration():
     """
-    # Dimension of source image from rover camera
-    height, width = src_img.shape[0], src_img.shape[1]
+    Cache the perspective transform of the rover camera.
 
-    # Numpy array of four source points defining a grid on input 3D image
-    # acquired from calibration data in test notebook
-    src_x1, src_y1 = 14, 140
-    src_x2, src_y2 = 301, 140
-    src_x3, src_y3 = 200, 96
-    src_x4, src_y4 = 118, 96
+    The camera geometry never changes between frames, so the transform
+    matrix and the remap tables derived from it are computed once for a
+    given (image size, dst_grid, bottom_offset) and reused thereafter.
+    The source points are part of every cache key so that recalibrating
+    from the grid image invalidates all previously computed warps.
 
-    # Corresponding destination points on output 2D overhead image
-    dst_x1, dst_y1 = (width/2 - dst_grid/2), (height-bottom_offset)
-    dst_x2, dst_y2 = (width/2 + dst_grid/2), (height-bottom_offset)
-    dst_x3, dst_y3 = (width/2 + dst_grid/2), (height-dst_grid-bottom_offset)
-    dst_x4, dst_y4 = (width/2 - dst_grid/2), (height-dst_grid-bottom_offset)
+    """
 
-    src_points_3d = np.float32([[src_x1, src_y1],
-                                [src_x2, src_y2],
-                                [src_x3, src_y3],
-                                [src_x4, src_y4]])
+    def __init__(self, src_points=CALIB_SRC_POINTS):
+        """
+        Initialize a PerspectiveCalibration instance.
+
+        Keyword arguments:
+        src_points -- four x,y points defining a grid on the camera image
+
+        """
+        self.src_points = tuple(tuple(pt) for pt in src_points)
+        self.warp_maps = {}  # Key -> (transform_matrix, map_x, map_y)
+        self.subsampled_maps = {}  # Key, src_step -> scaled map_x, map_y
+        self.dst_imgs = {}  # Output buffers reused by warp(reuse_dst=True)
+
+    def recalibrate(self, src_points):
+        """
+        Replace the calibration source points and drop cached warps.
+
+        Keyword arguments:
+        src_points -- four x,y points defining a grid on the camera image
+
+        """
+        self.src_points = tuple(tuple(pt) for pt in src_points)
+        self.warp_maps.clear()
+        self.subsampled_maps.clear()
+
+    def key(self, height, width, dst_grid, bottom_offset):
+        """Return the cache key of a warp with the given geometry."""
+        return height, width, dst_grid, bottom_offset, self.src_points
+
+    def get_warp(self, height, width, dst_grid=10, bottom_offset=6):
+        """
+        Get the cached transform matrix and remap tables for a geometry.
+
+        Keyword arguments:
+        height, width -- dimensions of source and destination images
+        dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
+        bottom_offset -- bottom of cam image is some distance in front of rover
+
+        Return value:
+        transform_matrix, map_x, map_y -- 3x3 homography from source to
+            destination image and float32 source x,y of each output pixel
+
+        """
+        key = self.key(height, width, dst_grid, bottom_offset)
+        if key not in self.warp_maps:
+            self.warp_maps[key] = self._compute_warp(height, width,
+                                                     dst_grid, bottom_offset)
+        return self.warp_maps[key]
+
+    def _compute_warp(self, height, width, dst_grid, bottom_offset):
+        """Compute transform matrix and remap tables for a geometry."""
+        # Corresponding destination points on output 2D overhead image
+        bottom_y = height - bottom_offset
+        dst_x1, dst_y1 = (width/2 - dst_grid/2), bottom_y
+        dst_x2, dst_y2 = (width/2 + dst_grid/2), bottom_y
+        dst_x3, dst_y3 = (width/2 + dst_grid/2), (bottom_y - dst_grid)
+        dst_x4, dst_y4 = (width/2 - dst_grid/2), (bottom_y - dst_grid)
+
+        src_points_3d = np.float32(self.src_points)
+
+        dst_points_2d = np.float32([[dst_x1, dst_y1],
+                                    [dst_x2, dst_y2],
+                                    [dst_x3, dst_y3],
+                                    [dst_x4, dst_y4]])
+
+        transform_matrix = cv2.getPerspectiveTransform(src_points_3d,
+                                                       dst_points_2d)
+
+        # Map every output pixel back through the inverse homography to
+        # the source pixel it samples, as warpPerspective does per frame
+        inv_matrix = np.linalg.inv(transform_matrix)
+        ypix_pts, xpix_pts = np.mgrid[0:height, 0:width].astype(np.float64)
+        src_x = inv_matrix[0, 0]*xpix_pts + inv_matrix[0, 1]*ypix_pts \
+            + inv_matrix[0, 2]
+        src_y = inv_matrix[1, 0]*xpix_pts + inv_matrix[1, 1]*ypix_pts \
+            + inv_matrix[1, 2]
+        src_w = inv_matrix[2, 0]*xpix_pts + inv_matrix[2, 1]*ypix_pts \
+            + inv_matrix[2, 2]
+
+        # Points at infinity are sent outside the image (black border)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            map_x = np.where(src_w != 0, src_x/src_w, -1).astype(np.float32)
+            map_y = np.where(src_w != 0, src_y/src_w, -1).astype(np.float32)
+
+        return transform_matrix, map_x, map_y
+
+    def warp(self, src_img, dst_grid=10, bottom_offset=6, reuse_dst=False,
+             interpolation=cv2.INTER_LINEAR, buffers=None):
+        """
+        Apply the cached perspective transformation to input 3D image.
+
+        Keyword arguments:
+        src_img -- 3D numpy image on which perspective transform is applied
+        dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
+        bottom_offset -- bottom of cam image is some distance in front of rover
+        reuse_dst -- warp into a buffer owned by the calibration which is
+                     overwritten on the next call, instead of a new image
+        interpolation -- OpenCV interpolation flag, e.g. cv2.INTER_NEAREST
+                         for label images
+        buffers -- dict of output buffers reused with reuse_dst instead
+                   of those of the calibration, e.g. of one rover's
+                   PerceptionContext
+
+        Return value:
+        dst_img -- 2D warped numpy image with overhead view
+
+        """
+        height, width = src_img.shape[0], src_img.shape[1]
+        map_x, map_y = self.get_warp(height, width,
+                                     dst_grid, bottom_offset)[1:]
+
+        dst_img = None
+        if reuse_dst:
+            if buffers is None:
+                buffers = self.dst_imgs
+            buffer_key = src_img.shape, src_img.dtype
+            if buffer_key not in buffers:
+                buffers[buffer_key] = np.empty_like(src_img)
+            dst_img = buffers[buffer_key]
+
+        # Keep same size as source image
+        return cv2.remap(src_img, map_x, map_y, interpolation, dst=dst_img)
+
+    def warp_subsampled(self, src_img, src_step, dst_grid=10,
+                        bottom_offset=6, interpolation=cv2.INTER_NEAREST,
+                        buffers=None):
+        """
+        Warp an image of every src_step-th camera pixel to full size.
+
+        The remap tables of the full size camera image are scaled down to
+        sample the subsampled image, so the output has the geometry of a
+        full size warp.
+
+        Keyword arguments:
+        src_img -- numpy image of the camera image subsampled by src_step
+                   along both axes
+        src_step -- step between camera pixels kept in src_img
+        buffers -- dict of output buffers to reuse instead of those of
+                   the calibration
+
+        Return value:
+        dst_img -- full size warped image (a buffer owned by the
+                   calibration, or in buffers, which is overwritten on
+                   the next call)
+
+        """
+        height = src_img.shape[0]*src_step
+        width = src_img.shape[1]*src_step
+        key = self.key(height, width, dst_grid, bottom_offset), src_step
+        if key not in self.subsampled_maps:
+            map_x, map_y = self.get_warp(height, width,
+                                         dst_grid, bottom_offset)[1:]
+            self.subsampled_maps[key] = map_x/src_step, map_y/src_step
+        map_x, map_y = self.subsampled_maps[key]
+
+        if buffers is None:
+            buffers = self.dst_imgs
+        buffer_key = (height, width) + src_img.shape[2:], src_img.dtype
+        if buffer_key not in buffers:
+            buffers[buffer_key] = np.empty(buffer_key[0], dtype=src_img.dtype)
+        return cv2.remap(src_img, map_x, map_y, interpolation,
+                         dst=buffers[buffer_key])
+
+
+# Calibration of the rover camera shared by perception functions
+perspect_calibration = PerspectiveCalibration()
 
-    dst_points_2d = np.float32([[dst_x1, dst_y1],
-                                [dst_x2, dst_y2],
-                                [dst_x3, dst_y3],
-                                [dst_x4, dst_y4]])
 
-    transform_matrix = cv2.getPerspectiveTransform(src_points_3d,
-                                                   dst_points_2d)
-    # Keep same size as source image
-    dst_img = cv2.warpPerspective(src_img, transform_matrix, (width, height))
+def perspect_transform(src_img, dst_grid=10, bottom_offset=6):
+    """
+    Apply a perspective transformation to input 3D image.
 
-    return dst_img
+    Keyword arguments:
+    src_img -- 3D numpy image on which perspective transform is applied
+    dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
+    bottom_offset -- bottom of cam image is some distance in front of rover
+
+    Return value:
+    dst_img -- 2D warped numpy image with overhead view
+
+    """
+    return perspect_calibration.warp(src_img, dst_grid, bottom_offset)
 
 
 def perspect_to_rover(binary_img):
@@ -187,6 +454,92 @@ def to_polar_coords(pixpts):
     return dists, angles
 
 
+class PolarLookup():
+    """
+    Lookup rover frame coordinates of pixels in the perspective frame.
+
+    Each pixel (row, col) of a warped image always maps to the same rover
+    frame x,y point, distance and angle, so these are tabulated once per
+    image size (in row-major pixel order, matching nonzero()) and the
+    coordinates of any binary image are a gather of its set pixels.
+
+    """
+
+    def __init__(self, height=160, width=320):
+        """
+        Initialize a PolarLookup instance for images of a given size.
+
+        Keyword arguments:
+        height, width -- dimensions of the warped perspective frame images
+
+        """
+        self.shape = height, width
+        xpix_pts_rf, ypix_pts_rf = perspect_to_rover(
+            np.ones(self.shape, dtype=np.uint8)
+        )
+        self.xpix_pts_rf = xpix_pts_rf
+        self.ypix_pts_rf = ypix_pts_rf
+        self.dists, self.angles = to_polar_coords((xpix_pts_rf, ypix_pts_rf))
+        self.dist_masks = {}  # Max distance -> pixels within that distance
+
+    def within(self, max_dist):
+        """Return flat boolean mask of pixels closer than max_dist."""
+        if max_dist not in self.dist_masks:
+            self.dist_masks[max_dist] = self.dists < max_dist
+        return self.dist_masks[max_dist]
+
+    def pixel_idxs(self, binary_img, max_dist=None):
+        """
+        Get flat indexes of nonzero pixels in binary_img.
+
+        Keyword arguments:
+        binary_img -- single channel 2D warped numpy image in perspective frame
+        max_dist -- optionally keep only pixels closer than this to rover
+
+        """
+        pix_idxs = np.flatnonzero(binary_img)
+        if max_dist is not None:
+            pix_idxs = pix_idxs[self.within(max_dist)[pix_idxs]]
+        return pix_idxs
+
+    def rover_pixpts(self, pix_idxs):
+        """Return tuple of pixel x,y points in rover frame."""
+        return self.xpix_pts_rf[pix_idxs], self.ypix_pts_rf[pix_idxs]
+
+    def polar_coords(self, pix_idxs):
+        """Return distances and angles(deg) of pixels to rover."""
+        return self.dists[pix_idxs], self.angles[pix_idxs]
+
+    def subset(self, pix_idxs):
+        """
+        Get the lookup of only some pixels, for images holding just those.
+
+        Keyword arguments:
+        pix_idxs -- flat indexes of the pixels kept, in the order they
+                    are laid out in the 1 x N images to be looked up
+
+        """
+        lookup = copy.copy(self)
+        lookup.shape = 1, len(pix_idxs)
+        lookup.xpix_pts_rf = self.xpix_pts_rf[pix_idxs]
+        lookup.ypix_pts_rf = self.ypix_pts_rf[pix_idxs]
+        lookup.dists = self.dists[pix_idxs]
+        lookup.angles = self.angles[pix_idxs]
+        lookup.dist_masks = {}
+        return lookup
+
+
+# Lookup tables of each perspective frame size seen by perception_step
+polar_lookups = {}
+
+
+def get_polar_lookup(height, width):
+    """Get the shared PolarLookup instance for a perspective frame size."""
+    if (height, width) not in polar_lookups:
+        polar_lookups[height, width] = PolarLookup(height, width)
+    return polar_lookups[height, width]
+
+
 def rotate_pixpts(pixpts, angle):
     """
     Geometrically rotate pixel points by specified angle.
@@ -206,8 +559,7 @@ def rotate_pixpts(pixpts, angle):
     xpix_pts_rotated = xpix_pts*np.cos(angle_rad) - ypix_pts*np.sin(angle_rad)
     ypix_pts_rotated = xpix_pts*np.sin(angle_rad) + ypix_pts*np.cos(angle_rad)
 
-    PixPointsRot = namedtuple('PixPointsRot', 'x y')
-    pixpts_rot = PixPointsRot(xpix_pts_rotated, ypix_pts_rotated)
+    pixpts_rot = PixPoints(xpix_pts_rotated, ypix_pts_rotated)
 
     return pixpts_rot
 
@@ -230,12 +582,154 @@ def translate_pixpts(pixpts_rot, translation, scale_factor=10):
     xpix_pts_translated = pixpts_rot.x/scale_factor + translation_x
     ypix_pts_translated = pixpts_rot.y/scale_factor + translation_y
 
-    PixPointsTran = namedtuple('PixPointsTran', 'x y')
-    pixpts_tran = PixPointsTran(xpix_pts_translated, ypix_pts_translated)
+    pixpts_tran = PixPoints(xpix_pts_translated, ypix_pts_translated)
 
     return pixpts_tran
 
 
+def world_affine(rover_pos, rover_yaw, scale_factor=10):
+    """
+    Get the affine transform of pixel points from rover to world frame.
+
+    Keyword arguments:
+    rover_pos -- tuple of rover x,y position in world frame
+    rover_yaw -- rover yaw angle in world frame
+    scale_factor -- between world and rover frame pixels
+
+    Return value:
+    affine_matrix -- 2x3 numpy array rotating by yaw, scaling and
+                     translating by rover position
+
+    """
+    deg2rad = np.pi/180.
+    yaw_rad = rover_yaw*deg2rad
+    cos_yaw = np.cos(yaw_rad)/scale_factor
+    sin_yaw = np.sin(yaw_rad)/scale_factor
+
+    return np.array([[cos_yaw, -sin_yaw, rover_pos[0]],
+                     [sin_yaw, cos_yaw, rover_pos[1]]])
+
+
+def inv_world_affine(rover_pos, rover_yaw, scale_factor=10):
+    """
+    Get the affine transform of pixel points from world to rover frame.
+
+    Keyword arguments:
+    rover_pos -- tuple of rover x,y position in world frame
+    rover_yaw -- rover yaw angle in world frame
+    scale_factor -- between world and rover frame pixels
+
+    Return value:
+    affine_matrix -- 2x3 numpy array inverting world_affine()
+
+    """
+    deg2rad = np.pi/180.
+    yaw_rad = rover_yaw*deg2rad
+    cos_yaw = np.cos(yaw_rad)*scale_factor
+    sin_yaw = np.sin(yaw_rad)*scale_factor
+    pos_x, pos_y = rover_pos[0], rover_pos[1]
+
+    return np.array([[cos_yaw, sin_yaw, -cos_yaw*pos_x - sin_yaw*pos_y],
+                     [-sin_yaw, cos_yaw, sin_yaw*pos_x - cos_yaw*pos_y]])
+
+
+class WorldTransform():
+    """
+    Transform pixel points of all ROIs from rover to world frame at once.
+
+    The points of every ROI are stacked into preallocated buffers and
+    transformed by one 2x3 affine matrix, and the resulting integer world
+    indexes are written into preallocated buffers as well. Buffers only
+    grow, so a steady stream of frames stops allocating after warm up.
+
+    """
+
+    def __init__(self, world_size=200, scale_factor=10):
+        """
+        Initialize a WorldTransform instance.
+
+        Keyword arguments:
+        world_size -- integer length of square world map of 200 x 200 pixels
+        scale_factor -- between world and rover frame pixels
+
+        """
+        self.world_size = world_size
+        self.scale_factor = scale_factor
+        self.capacity = 0
+        self._allocate(1 << 15)
+
+    def _allocate(self, capacity):
+        """Allocate buffers for capacity stacked pixel points."""
+        self.capacity = capacity
+        self.xpix_pts_rf = np.empty(capacity, dtype=np.float64)
+        self.ypix_pts_rf = np.empty(capacity, dtype=np.float64)
+        self.pix_pts_tmp = np.empty(capacity, dtype=np.float64)
+        self.pix_pts_prod = np.empty(capacity, dtype=np.float64)
+        self.xpix_pts_wf = np.empty(capacity, dtype=np.int_)
+        self.ypix_pts_wf = np.empty(capacity, dtype=np.int_)
+
+    def rover_to_world(self, rois_pixpts_rf, rover_pos, rover_yaw):
+        """
+        Transform pixel points of several ROIs from rover frame to world frame.
+
+        Keyword arguments:
+        rois_pixpts_rf -- sequence of tuples of numpy arrays of x,y pixel
+                          points in rover frame, one per ROI
+        rover_pos -- tuple of rover x,y position in world frame
+        rover_yaw -- rover yaw angle in world frame
+
+        Return value:
+        rois_pixpts_wf -- list of namedtuples of numpy arrays of pixel x,y
+                          points in world frame, one per ROI (views into
+                          buffers overwritten on the next call)
+
+        """
+        sizes = [len(pixpts_rf[0]) for pixpts_rf in rois_pixpts_rf]
+        num_pts = sum(sizes)
+        if num_pts > self.capacity:
+            self._allocate(max(num_pts, 2*self.capacity))
+
+        # Stack x,y points of all ROIs
+        xpix_pts_rf = self.xpix_pts_rf[:num_pts]
+        ypix_pts_rf = self.ypix_pts_rf[:num_pts]
+        np.concatenate([pixpts_rf[0] for pixpts_rf in rois_pixpts_rf],
+                       out=xpix_pts_rf)
+        np.concatenate([pixpts_rf[1] for pixpts_rf in rois_pixpts_rf],
+                       out=ypix_pts_rf)
+
+        # Apply rotation, scaling and translation in place
+        affine = world_affine(rover_pos, rover_yaw, self.scale_factor)
+        xpix_pts_wf = self._apply_row(affine[0], xpix_pts_rf, ypix_pts_rf,
+                                      self.xpix_pts_wf[:num_pts])
+        ypix_pts_wf = self._apply_row(affine[1], xpix_pts_rf, ypix_pts_rf,
+                                      self.ypix_pts_wf[:num_pts])
+
+        # Split stacked world points back into ROIs
+        rois_pixpts_wf = []
+        start = 0
+        for size in sizes:
+            rois_pixpts_wf.append(PixPoints(xpix_pts_wf[start:start+size],
+                                            ypix_pts_wf[start:start+size]))
+            start += size
+
+        return rois_pixpts_wf
+
+    def _apply_row(self, affine_row, xpix_pts, ypix_pts, pix_pts_wf):
+        """Compute one world coordinate of stacked points into pix_pts_wf."""
+        num_pts = len(xpix_pts)
+        pix_pts = np.multiply(xpix_pts, affine_row[0],
+                              out=self.pix_pts_tmp[:num_pts])
+        pix_pts += np.multiply(ypix_pts, affine_row[1],
+                               out=self.pix_pts_prod[:num_pts])
+        pix_pts += affine_row[2]
+
+        # Truncate like np.int_ and clip pixels to be within world size
+        np.copyto(pix_pts_wf, pix_pts, casting='unsafe')
+        np.clip(pix_pts_wf, 0, self.world_size-1, out=pix_pts_wf)
+
+        return pix_pts_wf
+
+
 def rover_to_world(pixpts_rf, rover_pos, rover_yaw, world_size=200):
     """
     Transform pixel points of ROIs from rover frame to world frame.
@@ -251,16 +745,18 @@ def rover_to_world(pixpts_rf, rover_pos, rover_yaw, world_size=200):
 
     """
     # Apply rotation and translation
-    pixpts_rot = rotate_pixpts(pixpts_rf, rover_yaw)
-    pixpts_tran = translate_pixpts(pixpts_rot, rover_pos)
+    affine = world_affine(rover_pos, rover_yaw)
+    xpix_pts, ypix_pts = pixpts_rf
+    xpix_pts_tran = affine[0, 0]*xpix_pts + affine[0, 1]*ypix_pts \
+        + affine[0, 2]
+    ypix_pts_tran = affine[1, 0]*xpix_pts + affine[1, 1]*ypix_pts \
+        + affine[1, 2]
 
     # Clip pixels to be within world size
-    xpix_pts_wf = np.clip(np.int_(pixpts_tran.x), 0, world_size-1)
-    ypix_pts_wf = np.clip(np.int_(pixpts_tran.y), 0, world_size-1)
+    xpix_pts_wf = np.clip(np.int_(xpix_pts_tran), 0, world_size-1)
+    ypix_pts_wf = np.clip(np.int_(ypix_pts_tran), 0, world_size-1)
 
-    # Define a named tuple for the points of the three ROIs
-    PixPointsWf = namedtuple('PixPointsWf', 'x y')
-    pixpts_wf = PixPointsWf(xpix_pts_wf, ypix_pts_wf)
+    pixpts_wf = PixPoints(xpix_pts_wf, ypix_pts_wf)
 
     return pixpts_wf
 
@@ -284,8 +780,7 @@ def inv_translate_pixpts(pixpts_wf, translation, scale_factor=10):
     xpix_pts_rotated = (xpix_pts_wf - translation_x)*scale_factor
     ypix_pts_rotated = (ypix_pts_wf - translation_y)*scale_factor
 
-    PixPointsRot = namedtuple('PixPointsRot', 'x y')
-    pixpts_rot = PixPointsRot(xpix_pts_rotated, ypix_pts_rotated)
+    pixpts_rot = PixPoints(xpix_pts_rotated, ypix_pts_rotated)
 
     return pixpts_rot
 
@@ -308,7 +803,6 @@ def inv_rotate_pixpts(pixpts_rot, angle):
     xpix_pts = pixpts_rot.x*np.cos(angle_rad) + pixpts_rot.y*np.sin(angle_rad)
     ypix_pts = -pixpts_rot.x*np.sin(angle_rad) + pixpts_rot.y*np.cos(angle_rad)
 
-    PixPoints = namedtuple('PixPoints', 'x y')
     pixpts = PixPoints(xpix_pts, ypix_pts)
 
     return pixpts
@@ -328,69 +822,362 @@ def world_to_rover(pixpts_wf, rover_pos, rover_yaw):
 
     """
     # Apply inverse translation and rotation
-    pixpts_rot = inv_translate_pixpts(pixpts_wf, rover_pos)
-    pixpts_rf = inv_rotate_pixpts(pixpts_rot, rover_yaw)
+    affine = inv_world_affine(rover_pos, rover_yaw)
+    xpix_pts_wf, ypix_pts_wf = pixpts_wf
+    xpix_pts_rf = affine[0, 0]*xpix_pts_wf + affine[0, 1]*ypix_pts_wf \
+        + affine[0, 2]
+    ypix_pts_rf = affine[1, 0]*xpix_pts_wf + affine[1, 1]*ypix_pts_wf \
+        + affine[1, 2]
+
+    pixpts_rf = PixPoints(xpix_pts_rf, ypix_pts_rf)
 
     return pixpts_rf
 
 
-def perception_step(Rover, R=0, G=1, B=2):
+class PerceptionContext():
+    """
+    Create a class for the buffers reused by perception steps of a rover.
+
+    Perception steps overwrite label images, warped images and world
+    points held in preallocated buffers. Steps of one rover run one after
+    the other and share a context, while rovers perceived concurrently
+    each need a context of their own. Lookup tables are read only and
+    remain shared by all contexts.
+
+    """
+
+    def __init__(self):
+        """Initialize a PerceptionContext instance."""
+        self.color_classifier = ColorClassifier()
+        # Classifier of subsampled camera images, keeping its own label
+        # buffer so switching between full and subsampled frames
+        # reallocates nothing
+        self.subsampled_classifier = ColorClassifier()
+        # Classifier of the 1 x N images of PerceptionROI pixels
+        self.roi_classifier = ColorClassifier()
+        self.world_transform = WorldTransform()
+        self.dst_imgs = {}  # Warped image buffers, see PerspectiveCalibration
+        self.roi_label_imgs = {}  # PerceptionROI -> full frame label image
+
+    def roi_label_img(self, roi):
+        """Get the full frame label image painted from roi pixels."""
+        if roi not in self.roi_label_imgs:
+            # Pixels not kept by roi are never written
+            self.roi_label_imgs[roi] = np.zeros(roi.shape, dtype=np.uint8)
+        return self.roi_label_imgs[roi]
+
+
+# Buffers shared by successive perception steps of a single rover
+perception_context = PerceptionContext()
+
+# Ways of obtaining the ROI label image in perspective frame:
+# warp_image -- warp the 3 channel camera image, then classify its pixels
+# warp_labels -- classify camera image pixels, then warp only the labels
+PERCEPTION_MODES = ('warp_image', 'warp_labels')
+
+
+class PerceptionROI():
+    """
+    Restrict perception to the perspective frame pixels that matter.
+
+    About a third of the warped image lies outside the camera's field of
+    view and is always black, so it never holds an ROI. The pixels inside
+    the field of view, optionally only those within max_dist of the rover
+    and on every step-th row and column, are found once and perception
+    warps, classifies and looks up only those, laid out as a 1 x N image.
+
+    With the defaults the rover state and worldmap are exactly those of
+    full frame perception. A max_dist or step drops pixels, so events
+    counting ROI pixels see fewer of them.
+
+    """
+
+    def __init__(self, height=160, width=320, max_dist=None, step=1):
+        """
+        Initialize a PerceptionROI instance.
+
+        Keyword arguments:
+        height, width -- dimensions of the camera and perspective frames
+        max_dist -- keep only pixels closer than this to rover, None for all
+        step -- keep only every step-th row and column of pixels
+
+        """
+        self.shape = height, width
+        self.max_dist = max_dist
+        self.step = step
+
+        # Pixels sampling the camera image, including those at its border
+        # that interpolate with the black outside
+        map_x, map_y = perspect_calibration.get_warp(height, width)[1:]
+        keep = (map_x > -1) & (map_x < width) & (map_y > -1) & (map_y < height)
+        keep[np.arange(height) % step != 0] = False
+        keep[:, np.arange(width) % step != 0] = False
+        polar_lookup = get_polar_lookup(height, width)
+        if max_dist is not None:
+            keep &= polar_lookup.within(max_dist).reshape(height, width)
+
+        self.pix_idxs = np.flatnonzero(keep)
+        self.polar_lookup = polar_lookup.subset(self.pix_idxs)
+        self.remap_tables = {}  # src_step -> map_x, map_y of kept pixels
+
+    def get_remap(self, src_step=1):
+        """Get remap tables sampling a camera image subsampled by src_step."""
+        if src_step not in self.remap_tables:
+            map_x, map_y = perspect_calibration.get_warp(*self.shape)[1:]
+            self.remap_tables[src_step] = tuple(
+                np.ascontiguousarray(
+                    table.ravel()[self.pix_idxs].reshape(1, -1) / src_step,
+                    dtype=np.float32
+                )
+                for table in (map_x, map_y)
+            )
+        return self.remap_tables[src_step]
+
+    def label_img(self, src_img, mode='warp_image', src_step=1,
+                  context=perception_context):
+        """
+        Label ROI pixels of the kept pixels, see perspect_label_img().
+
+        Return value:
+        label_img -- uint8 1 x N image of ROI bit flags of kept pixels
+                     (a buffer of context that is overwritten on the next
+                     call)
+
+        """
+        start = stage_profiler.start()
+        if mode == 'warp_image' and src_step == 1:
+            warped_pixs = cv2.remap(src_img, *self.get_remap(),
+                                    cv2.INTER_LINEAR)
+            start = stage_profiler.lap('perception.warp', start)
+            label_img = context.roi_classifier.classify(warped_pixs)
+            stage_profiler.lap('perception.threshold', start)
+            return label_img
+
+        classifier = context.color_classifier if src_step == 1 \
+            else context.subsampled_classifier
+        cam_label_img = classifier.classify(
+            np.ascontiguousarray(src_img[::src_step, ::src_step])
+        )
+        start = stage_profiler.lap('perception.threshold', start)
+        label_img = cv2.remap(cam_label_img, *self.get_remap(src_step),
+                              cv2.INTER_NEAREST)
+        stage_profiler.lap('perception.warp', start)
+        return label_img
+
+    def paint(self, vision_image, label_img, context=perception_context):
+        """Color kept pixels of vision_image by label, clearing the rest."""
+        frame_label_img = context.roi_label_img(self)
+        frame_label_img.ravel()[self.pix_idxs] = label_img.ravel()
+        np.take(VISION_PALETTE, frame_label_img, axis=0, out=vision_image)
+
+
+# Perception regions of each configuration and camera calibration
+perception_rois = {}
+
+
+def get_perception_roi(height=160, width=320, max_dist=None, step=1):
+    """Get the shared PerceptionROI of a configuration and calibration."""
+    key = (height, width, max_dist, step,
+           perspect_calibration.key(height, width, 10, 6))
+    if key not in perception_rois:
+        perception_rois[key] = PerceptionROI(height, width, max_dist, step)
+    return perception_rois[key]
+
+
+def perspect_label_img(src_img, mode='warp_image', src_step=1, roi=None,
+                       context=perception_context):
+    """
+    Label ROI pixels of a rover camera image in the perspective frame.
+
+    Keyword arguments:
+    src_img -- 3D numpy image from rover camera
+    mode -- one of PERCEPTION_MODES
+    src_step -- classify only every src_step-th camera pixel along both
+                axes and warp the labels as in warp_labels, whatever the
+                mode, to cut thresholding cost when frames run late
+    roi -- PerceptionROI to label only its pixels, None for all pixels
+    context -- PerceptionContext holding the buffers to reuse
+
+    Return value:
+    label_img -- uint8 image of ROI bit flags in perspective frame
+                 (a buffer of context that is overwritten on the next call)
+
+    """
+    if mode not in PERCEPTION_MODES:
+        raise ValueError('Unknown perception mode: {}'.format(mode))
+    if roi is not None:
+        return roi.label_img(src_img, mode, src_step, context)
+
+    start = stage_profiler.start()
+    if src_step > 1:
+        cam_label_img = context.subsampled_classifier.classify(
+            np.ascontiguousarray(src_img[::src_step, ::src_step])
+        )
+        start = stage_profiler.lap('perception.threshold', start)
+        label_img = perspect_calibration.warp_subsampled(
+            cam_label_img, src_step, buffers=context.dst_imgs
+        )
+        stage_profiler.lap('perception.warp', start)
+        return label_img
+    elif mode == 'warp_image':
+        warped_img = perspect_calibration.warp(src_img, reuse_dst=True,
+                                               buffers=context.dst_imgs)
+        start = stage_profiler.lap('perception.warp', start)
+        label_img = context.color_classifier.classify(warped_img)
+        stage_profiler.lap('perception.threshold', start)
+        return label_img
+    else:
+        # warp_labels: each perspective frame pixel takes the label of the
+        # camera pixel it projects from, so no warped RGB image is produced
+        cam_label_img = context.color_classifier.classify(src_img)
+        start = stage_profiler.lap('perception.threshold', start)
+        label_img = perspect_calibration.warp(
+            cam_label_img, reuse_dst=True, interpolation=cv2.INTER_NEAREST,
+            buffers=context.dst_imgs
+        )
+        stage_profiler.lap('perception.warp', start)
+        return label_img
+
+
+def warm_up(height=160, width=320, mode='warp_image', src_steps=(1,),
+            roi=None, context=perception_context):
+    """
+    Build the tables and buffers perception_step needs ahead of frames.
+
+    The color lookup table, remap and polar tables and the buffers of
+    context are otherwise built on the first frame, taking far longer
+    than any frame that follows.
+
+    Keyword arguments:
+    height, width -- dimensions of the camera images to be perceived
+    mode, roi, context -- as passed to perception_step()
+    src_steps -- steps between camera pixels classified that frames
+                 may be perceived with
+
+    """
+    blank_img = np.zeros((height, width, 3), dtype=np.uint8)
+    for src_step in src_steps:
+        perspect_label_img(blank_img, mode, src_step, roi, context)
+
+    if roi is None:
+        polar_lookup = get_polar_lookup(height, width)
+    else:
+        polar_lookup = roi.polar_lookup
+    for max_dist in (NAV_MAX_DIST, OBS_MAX_DIST, ROCK_MAX_DIST):
+        polar_lookup.within(max_dist)
+
+
+def is_stable_pose(rover_pitch, rover_roll):
+    """
+    Check if rover pose is level enough to map its camera view.
+
+    High pitch/rolls cause inaccurate 3D to 2D mapping and low fidelity.
+
+    Keyword arguments:
+    rover_pitch, rover_roll -- rover angles, scalars or numpy arrays
+
+    """
+    return (((rover_pitch > 359) | (rover_pitch < 0.25))
+            & ((rover_roll > 359) | (rover_roll < 0.37)))
+
+
+# Rover vision image color of each label, ROIs assigned to one of
+# the RGB color channels: obs to R, rock to G, nav to B
+VISION_R_VAL, VISION_G_VAL, VISION_B_VAL = 135, 255, 175
+VISION_PALETTE = np.array(
+    [[VISION_R_VAL*bool(label & OBS_LABEL),
+      VISION_G_VAL*bool(label & ROCK_LABEL),
+      VISION_B_VAL*bool(label & NAV_LABEL)]
+     for label in range(8)],
+    dtype=np.float64
+)
+
+
+def perception_step(Rover, R=0, G=1, B=2, mode='warp_image',
+                    src_step=1, update_map=True, roi=None,
+                    context=perception_context):
     """
     Sense environment with rover camera and update rover state accordingly.
 
     Keyword arguments:
     Rover -- instance of RoverTelemetry class
     R,G,B -- indexes representing the RGB color channels in a numpy image
+    mode -- one of PERCEPTION_MODES
+    src_step -- step between camera pixels classified, see
+                perspect_label_img()
+    update_map -- False to leave the worldmap untouched this frame, the
+                  commands of this frame do not depend on it
+    roi -- PerceptionROI to perceive only its pixels, None for all pixels
+    context -- PerceptionContext holding the buffers to reuse, one per
+               rover when several rovers are perceived concurrently
 
     """
-    # Apply perspective transform to get 2D overhead view of rover cam
-    warped_img = perspect_transform(Rover.img)
-
-    # Apply color thresholds to extract pixels of navigable/obstacles/rocks
-    thresh_pixpts_pf = color_thresh(warped_img)
+    # Label pixels of navigable/obstacles/rocks in a 2D overhead view
+    # of rover cam
+    label_img = perspect_label_img(Rover.img, mode, src_step, roi, context)
 
     # Update rover vision image with each ROI assigned to one of
     # the RGB color channels (to be displayed on left side of sim screen)
-    VISION_R_VAL, VISION_G_VAL, VISION_B_VAL = 135, 1, 175
-    Rover.vision_image[:, :, R] = thresh_pixpts_pf.obs * VISION_R_VAL
-    Rover.vision_image[:, :, G] = thresh_pixpts_pf.rock * VISION_G_VAL
-    Rover.vision_image[:, :, B] = thresh_pixpts_pf.nav * VISION_B_VAL
-
-    # Transform pixel coordinates from perspective frame to rover frame
-    nav_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.nav)
-    obs_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.obs)
-    rock_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.rock)
-
-    # Convert above cartesian coordinates to polar coordinates
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(nav_pixpts_rf)
-    Rover.obs_dists, Rover.obs_angles = to_polar_coords(obs_pixpts_rf)
-    Rover.rock_dists = to_polar_coords(rock_pixpts_rf)[0]
+    start = stage_profiler.start()
+    if roi is None:
+        np.take(VISION_PALETTE, label_img, axis=0, out=Rover.vision_image)
+    else:
+        roi.paint(Rover.vision_image, label_img, context)
+    start = stage_profiler.lap('perception.vision', start)
+
+    # Precomputed rover frame coordinates of each perspective frame pixel
+    if roi is None:
+        polar_lookup = get_polar_lookup(*label_img.shape)
+    else:
+        polar_lookup = roi.polar_lookup
+
+    # Identify pixels of each ROI in perspective frame
+    nav_idxs = polar_lookup.pixel_idxs(label_img & NAV_LABEL)
+    obs_idxs = polar_lookup.pixel_idxs(label_img & OBS_LABEL)
+    rock_idxs = polar_lookup.pixel_idxs(label_img & ROCK_LABEL)
+
+    # Look up polar coordinates of ROI pixels in rover frame
+    Rover.nav_dists, Rover.nav_angles = polar_lookup.polar_coords(nav_idxs)
+    Rover.obs_dists, Rover.obs_angles = polar_lookup.polar_coords(obs_idxs)
+    Rover.rock_dists = polar_lookup.dists[rock_idxs]
 
     # Extract subset of nav_angles that are left of rover heading
     Rover.nav_angles_left = Rover.nav_angles[Rover.nav_angles > 0]
 
     # Only include pixels within certain distances from rover (for fidelity)
-    nav_pixpts_rf = [pts[Rover.nav_dists < 60] for pts in nav_pixpts_rf]
-    obs_pixpts_rf = [pts[Rover.obs_dists < 80] for pts in obs_pixpts_rf]
-    rock_pixpts_rf = [pts[Rover.rock_dists < 70] for pts in rock_pixpts_rf]
-
-    # Convert rock cartesian coords to polar coords
-    Rover.rock_angles = to_polar_coords(rock_pixpts_rf)[1]
+    nav_idxs = nav_idxs[polar_lookup.within(NAV_MAX_DIST)[nav_idxs]]
+    obs_idxs = obs_idxs[polar_lookup.within(OBS_MAX_DIST)[obs_idxs]]
+    rock_idxs = rock_idxs[polar_lookup.within(ROCK_MAX_DIST)[rock_idxs]]
+
+    # Look up rock angles and rover frame points of the remaining pixels
+    Rover.rock_angles = polar_lookup.angles[rock_idxs]
+    # Reductions of the ROI pixel arrays are computed afresh this frame
+    Rover.features.update(Rover)
+    nav_pixpts_rf = polar_lookup.rover_pixpts(nav_idxs)
+    obs_pixpts_rf = polar_lookup.rover_pixpts(obs_idxs)
+    rock_pixpts_rf = polar_lookup.rover_pixpts(rock_idxs)
+    start = stage_profiler.lap('perception.polar', start)
 
     # Transform pixel points of ROIs from rover frame to world frame
-    nav_pixpts_wf = rover_to_world(nav_pixpts_rf, Rover.pos, Rover.yaw)
-    obs_pixpts_wf = rover_to_world(obs_pixpts_rf, Rover.pos, Rover.yaw)
-    rock_pixpts_wf = rover_to_world(rock_pixpts_rf, Rover.pos, Rover.yaw)
+    nav_pixpts_wf, obs_pixpts_wf, rock_pixpts_wf = (
+        context.world_transform.rover_to_world(
+            (nav_pixpts_rf, obs_pixpts_rf, rock_pixpts_rf),
+            Rover.pos, Rover.yaw
+        )
+    )
+    start = stage_profiler.lap('perception.world', start)
 
     # Only update worldmap (displayed on right) if rover has a stable drive
-    # High pitch/rolls cause inaccurate 3D to 2D mapping and low fidelity
-    is_stable = ((Rover.pitch > 359 or Rover.pitch < 0.25)
-                 and (Rover.roll > 359 or Rover.roll < 0.37))
-
-    if is_stable:  # Update map with each ROI assigned to an RGB color channel
-        MAP_R_VAL, MAP_G_VAL, MAP_B_VAL = 255, 255, 255
-        Rover.worldmap[obs_pixpts_wf.y, obs_pixpts_wf.x, R] += MAP_R_VAL
-        Rover.worldmap[rock_pixpts_wf.y, rock_pixpts_wf.x, G] += MAP_G_VAL
-        Rover.worldmap[nav_pixpts_wf.y, nav_pixpts_wf.x, B] += MAP_B_VAL
+    if update_map and is_stable_pose(Rover.pitch, Rover.roll):
+        # Update map with each ROI assigned to an RGB color channel
+        new_pixs = Rover.worldmap.update(
+            (obs_pixpts_wf, rock_pixpts_wf, nav_pixpts_wf), (R, G, B)
+        )
+        # Update mapping statistics from newly mapped nav pixels only
+        Rover.map_stats.add_nav_pixs(new_pixs[2])
+        # Check known samples against newly detected rock pixels only
+        if Rover.sample_locator is not None:
+            Rover.sample_locator.add_rock_pixs(new_pixs[1])
+    stage_profiler.lap('perception.map', start)
 
     return Rover
@@ -0,0 +1,403 @@
+"""
+Module for processing telemetry frames in worker processes.
+
+NumPy and OpenCV calls of the telemetry handler block the eventlet hub
+of the server, so frames of all connections are processed one after the
+other. A PerceptionPool runs the RoverSession of each simulator in one
+of several worker processes instead: the server writes the camera image
+of a frame into a shared memory slot of the session and the worker
+decodes it, perceives, decides and returns only the command to send.
+Sessions keep their worldmap and decision state between frames, so each
+is pinned to the worker it was opened on, and sessions are spread over
+workers by their number of sessions.
+
+Waiting for a worker blocks, so PooledSession.process is called through
+eventlet.tpool to leave the hub free for I/O meanwhile, while sessions are
+closed without waiting for their worker.
+
+Example:
+$ python drive_rover.py --fleet --perception-workers 4
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory, util
+
+from perception import get_perception_roi, ColorClassifier
+from profiling import RollingLatency, stage_profiler
+from rover_session import RoverSession
+from telemetry_logging import start_logging
+
+log = logging.getLogger(__name__)
+
+# Initial size of the shared memory slot of a session's camera image,
+# base64 JPEG images of the simulator camera are a few tens of KB
+SLOT_SIZE = 1 << 18
+
+
+class SharedSlot():
+    """
+    Create a class for a shared memory block holding one message.
+
+    The process creating the slot owns the block and must unlink() it,
+    other processes attach to it by name and only close() it.
+
+    """
+
+    def __init__(self, size=SLOT_SIZE, name=None):
+        """
+        Create a shared slot, or attach to an existing one.
+
+        Keyword arguments:
+        size -- capacity of the slot in bytes, ignored when attaching
+        name -- name of an existing block to attach to, None to create one
+
+        """
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+    @property
+    def name(self):
+        """Name other processes attach to the shared block with."""
+        return self.shm.name
+
+    @property
+    def size(self):
+        """Capacity of the slot in bytes."""
+        return self.shm.size
+
+    def write(self, message):
+        """Copy bytes of message into the slot and return its length."""
+        self.shm.buf[:len(message)] = message
+        return len(message)
+
+    def read(self, length):
+        """Return a copy of the first length bytes of the slot."""
+        return bytes(self.shm.buf[:length])
+
+    def close(self):
+        """Detach this process from the shared block."""
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared block once all processes have closed it."""
+        self.shm.unlink()
+
+
+# State of each worker process, set up once by _init_worker
+_worker_config = None
+_worker_sessions = {}  # Session name -> RoverSession
+_worker_slots = {}  # Session name -> SharedSlot attached
+_worker_images = {}  # Session name -> display images last returned
+
+
+def _init_worker(config):
+    """Set up a worker process to run sessions configured by config."""
+    global _worker_config
+    _worker_config = config
+    # The log writer thread of the server is not forked with it, and
+    # records still queued are written when the worker exits
+    log_listener = start_logging(config['log_level'])
+    util.Finalize(None, log_listener.stop, exitpriority=0)
+    # Time stages of the sessions if the server does, as workers started
+    # by spawn or forkserver do not inherit its profiler
+    stage_profiler.enabled = config['profile']
+    # Build the color lookup table, unless inherited
+    ColorClassifier().lut
+
+
+def _open_session(name, image_folder):
+    """Create a session of the worker."""
+    roi = None
+    if _worker_config['roi'] is not None:
+        max_dist, step = _worker_config['roi']
+        roi = get_perception_roi(max_dist=max_dist, step=step)
+    _worker_sessions[name] = RoverSession(
+        name, perception_mode=_worker_config['perception_mode'], roi=roi,
+        jpeg_decoder=_worker_config['jpeg_decoder'],
+        hud_rate=_worker_config['hud_rate'],
+        frame_budget=_worker_config['frame_budget'],
+        image_folder=image_folder
+    )
+    _worker_sessions[name].warm_up()
+    _worker_images[name] = None
+
+
+def _close_session(name):
+    """Close a session of the worker and detach from its slot."""
+    _worker_sessions.pop(name).close()
+    _worker_images.pop(name)
+    slot = _worker_slots.pop(name, None)
+    if slot is not None:
+        slot.close()
+
+
+def _process_frame(name, slot_name, image_length, data):
+    """
+    Process a telemetry frame of a session of the worker.
+
+    Keyword arguments:
+    name -- name of the session
+    slot_name -- name of the shared slot holding the camera image
+    image_length -- length of the base64 camera image in the slot
+    data -- telemetry message dictionary without its camera image
+
+    Return value:
+    valid, command, seconds -- validity of the telemetry and command to
+        send, see RoverSession, with display images replaced by None if
+        they are those last returned, and seconds spent processing
+
+    """
+    start = time.perf_counter()
+    slot = _worker_slots.get(name)
+    if slot is None or slot.name != slot_name:
+        # The server replaced the slot by a larger one
+        if slot is not None:
+            slot.close()
+        slot = SharedSlot(name=slot_name)
+        _worker_slots[name] = slot
+    data['image'] = slot.read(image_length)
+
+    session = _worker_sessions[name]
+    session.count_frame()
+    valid = session.process(data)
+    command = session.command(valid)
+    session.end_frame()
+
+    # Display images change at the renderer's rate, so most frames need
+    # not send them back
+    kind, params = command
+    if kind == 'control':
+        commands, image_string1, image_string2 = params
+        if (image_string1, image_string2) == _worker_images[name]:
+            params = commands, None, None
+        else:
+            _worker_images[name] = image_string1, image_string2
+        command = kind, params
+
+    return valid, command, time.perf_counter() - start
+
+
+def _worker_stages():
+    """Return stage latency statistics of the worker."""
+    return stage_profiler.summary()
+
+
+class PooledSession():
+    """
+    Create a class standing in for a RoverSession run by a worker.
+
+    Offers the part of the RoverSession interface used by the telemetry
+    handler of the server, so sessions run in process or by a worker are
+    handled alike.
+
+    """
+
+    def __init__(self, pool, name, worker):
+        """
+        Initialize a PooledSession instance.
+
+        Keyword arguments:
+        pool -- PerceptionPool running the session
+        name -- name of the session
+        worker -- index of the worker running the session
+
+        """
+        self.pool = pool
+        self.name = name
+        self.worker = worker
+        self.slot = SharedSlot()
+        self.busy = False  # True while a frame is being processed
+        self.closing = False  # True to close once the frame is processed
+        self.dropped = 0  # Frames dropped as they arrived while busy
+        self.last_command = None  # Command of the frame last processed
+        self.image_strings = ('', '')  # Display images last received
+
+    def count_frame(self):
+        """Frames are counted by the worker."""
+
+    def process(self, data):
+        """
+        Process a telemetry frame by the worker, waiting for its command.
+
+        Return value:
+        True if the telemetry was valid, see RoverSession.process()
+
+        """
+        start = time.perf_counter()
+        image = data['image'].encode('ascii')
+        if len(image) > self.slot.size:
+            self.slot.close()
+            self.slot.unlink()
+            self.slot = SharedSlot(2*len(image))
+        image_length = self.slot.write(image)
+        data = {key: value for key, value in data.items() if key != 'image'}
+
+        future = self.pool.executors[self.worker].submit(
+            _process_frame, self.name, self.slot.name, image_length, data
+        )
+        valid, command, seconds = future.result()
+        self.pool.record(self.worker, seconds, time.perf_counter() - start)
+
+        kind, params = command
+        if kind == 'control':
+            commands, image_string1, image_string2 = params
+            if image_string1 is None:
+                image_string1, image_string2 = self.image_strings
+            else:
+                self.image_strings = image_string1, image_string2
+            command = kind, (commands, image_string1, image_string2)
+        self.last_command = command
+        return valid
+
+    def command(self, valid):
+        """Return the command chosen by the worker for the last frame."""
+        return self.last_command
+
+    def end_frame(self):
+        """Frames are finished by the worker."""
+
+    def close(self):
+        """Close the session in its worker and free its slot, not waiting."""
+        self.pool.close_session(self)
+
+
+class PerceptionPool():
+    """Create a class to run rover sessions in worker processes."""
+
+    def __init__(self, workers=2, perception_mode='warp_image', roi=None,
+                 jpeg_decoder='pil', hud_rate=5.0, frame_budget=0.04,
+                 log_level='INFO', window=1000):
+        """
+        Initialize a PerceptionPool instance and start its workers.
+
+        Keyword arguments:
+        workers -- number of worker processes
+        perception_mode, jpeg_decoder, hud_rate, frame_budget -- settings
+            of the sessions, see RoverSession
+        roi -- tuple of max_dist, step of the perception.PerceptionROI of
+               the sessions, None for full frame perception
+        log_level -- minimum level of records logged by the workers
+        window -- number of most recent frames of each worker latencies
+                  are reported over
+
+        """
+        config = {
+            'perception_mode': perception_mode, 'roi': roi,
+            'jpeg_decoder': jpeg_decoder, 'hud_rate': hud_rate,
+            'frame_budget': frame_budget, 'log_level': log_level,
+            # Workers time stages if the server does when starting them
+            'profile': stage_profiler.enabled,
+        }
+
+        # Build the color lookup table once, forked workers inherit it
+        ColorClassifier().lut
+        # Workers attaching to slots register them with the resource
+        # tracker, which must be that of the server freeing them rather
+        # than one started by each worker, to not free them twice
+        resource_tracker.ensure_running()
+
+        # One single process executor per worker pins sessions to it
+        self.executors = [
+            ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                initargs=(config,))
+            for _ in range(workers)
+        ]
+        self.sessions = [0]*workers  # Number of open sessions per worker
+        self.frames = [0]*workers  # Number of frames processed per worker
+        # Seconds a worker spends processing a frame, and from submitting
+        # a frame until its command is back, including waiting in queue
+        self.process_latency = [RollingLatency(window)
+                                for _ in range(workers)]
+        self.round_trip_latency = [RollingLatency(window)
+                                   for _ in range(workers)]
+        # Frames are recorded from the native threads waiting on workers
+        self.record_lock = threading.Lock()
+
+        # Start the workers now rather than on their first frame
+        for executor in self.executors:
+            executor.submit(_worker_stages).result()
+
+    def open_session(self, name, image_folder=''):
+        """
+        Open a session on the worker running the fewest sessions.
+
+        Keyword arguments:
+        name -- name of the session, unique among open sessions
+        image_folder -- existing folder to record frames in, '' to not
+                        record them
+
+        Return value:
+        session -- PooledSession to process frames of the session with
+
+        """
+        worker = self.sessions.index(min(self.sessions))
+        self.sessions[worker] += 1
+        # Frames submitted later are run after the session is opened
+        self.executors[worker].submit(_open_session, name, image_folder)
+        log.info("Running session %s on worker %d", name, worker)
+        return PooledSession(self, name, worker)
+
+    def close_session(self, session):
+        """
+        Close a session in its worker and free its slot once closed.
+
+        Returns without waiting for the worker, which may be busy with
+        frames of other sessions, so it may be called from the hub.
+
+        """
+        def release_slot(future):
+            if future.exception() is not None:
+                log.error("Closing session %s failed: %r", session.name,
+                          future.exception())
+            session.slot.close()
+            session.slot.unlink()
+
+        self.sessions[session.worker] -= 1
+        self.executors[session.worker].submit(
+            _close_session, session.name
+        ).add_done_callback(release_slot)
+
+    def record(self, worker, seconds, round_trip):
+        """Record the latencies of a frame processed by a worker."""
+        with self.record_lock:
+            self.frames[worker] += 1
+            self.process_latency[worker].add(seconds)
+            self.round_trip_latency[worker].add(round_trip)
+
+    def stats(self):
+        """
+        Get latency statistics of each worker.
+
+        Return value:
+        stats -- list of dicts of sessions, frames, process_ms and
+                 round_trip_ms statistics of each worker
+
+        """
+        with self.record_lock:
+            return [
+                {'sessions': self.sessions[worker],
+                 'frames': self.frames[worker],
+                 'process_ms': self.process_latency[worker].stats(),
+                 'round_trip_ms': self.round_trip_latency[worker].stats()}
+                for worker in range(len(self.executors))
+            ]
+
+    def stages(self):
+        """Get stage latency statistics of each worker, see profiling."""
+        return [executor.submit(_worker_stages).result()
+                for executor in self.executors]
+
+    def shutdown(self):
+        """Stop the workers once their pending frames are processed."""
+        for executor in self.executors:
+            executor.shutdown(wait=True)
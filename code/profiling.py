@@ -0,0 +1,180 @@
+"""
+Module for profiling stages of the rover control loop.
+
+Stages are timed by pairs of start() and lap() calls around them, and the
+latencies of the most recent frames of each stage are kept in a fixed size
+window to report rolling percentiles. While profiling is disabled start()
+and lap() return at once without reading the clock, so the calls can stay
+in the control loop. Sessions of a fleet time their stages concurrently
+from native threads, so recording and reporting latencies take a lock.
+
+Stage names:
+update_rover -- telemetry decoding and rover state update
+perception_step -- whole perception step, made up of:
+    perception.warp -- perspective transform
+    perception.threshold -- color classification of ROI pixels
+    perception.vision -- coloring of the rover vision image
+    perception.polar -- ROI pixel selection and polar coordinates
+    perception.world -- rover to world frame transform
+    perception.map -- worldmap and mapping statistics update
+decision -- DecisionSupervisor.execute
+create_output_images -- rendering and encoding of the HUD displays
+send_control -- emitting commands to the simulator
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import json
+import time
+import threading
+
+import numpy as np
+import cv2
+
+
+# Latency percentiles reported for each stage
+PROFILE_PERCENTILES = (50, 95, 99)
+
+
+class RollingLatency():
+    """Create a class to keep the latencies of the last frames of a stage."""
+
+    def __init__(self, window=1000):
+        """
+        Initialize a RollingLatency instance.
+
+        Keyword arguments:
+        window -- number of most recent latencies kept
+
+        """
+        self.samples = np.zeros(window, dtype=np.float64)
+        self.count = 0  # Number of latencies recorded so far
+
+    def add(self, seconds):
+        """Record the latency of a frame, replacing the oldest if full."""
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+
+    def stats(self):
+        """
+        Compute statistics of the latencies in the window.
+
+        Return value:
+        stats -- dict of count, mean, p50, p95, p99 and max latencies (ms)
+
+        """
+        samples = 1000*self.samples[:min(self.count, len(self.samples))]
+        stats = {'count': self.count}
+        if len(samples):
+            stats['mean'] = float(samples.mean())
+            for percentile, value in zip(
+                    PROFILE_PERCENTILES,
+                    np.percentile(samples, PROFILE_PERCENTILES)):
+                stats['p{}'.format(percentile)] = float(value)
+            stats['max'] = float(samples.max())
+        return stats
+
+
+class StageProfiler():
+    """
+    Create a class to time stages of the control loop.
+
+    Usage:
+    start = stage_profiler.start()
+    ... stage 1 ...
+    start = stage_profiler.lap('stage_1', start)
+    ... stage 2 ...
+    stage_profiler.lap('stage_2', start)
+
+    """
+
+    def __init__(self, window=1000, enabled=False):
+        """
+        Initialize a StageProfiler instance.
+
+        Keyword arguments:
+        window -- number of most recent frames kept per stage
+        enabled -- True to time stages, False to make timing calls no-ops
+
+        """
+        self.window = window
+        self.enabled = enabled
+        self.stages = {}  # Stage name -> RollingLatency, in order seen
+        self.lock = threading.Lock()  # Guards stages across threads
+
+    def start(self):
+        """Return the start time of the next stage, 0 if disabled."""
+        if not self.enabled:
+            return 0.0
+        return time.perf_counter()
+
+    def lap(self, stage, start):
+        """
+        Record the latency of a stage started at time start.
+
+        Return value:
+        now -- end time of the stage, start time of the next stage
+
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        self.record(stage, now - start)
+        return now
+
+    def record(self, stage, seconds):
+        """Record a latency measured elsewhere for a stage."""
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = RollingLatency(self.window)
+            self.stages[stage].add(seconds)
+
+    def reset(self):
+        """Forget all recorded latencies."""
+        with self.lock:
+            self.stages = {}
+
+    def summary(self):
+        """Return dict of statistics of each stage, see RollingLatency."""
+        with self.lock:
+            return {stage: latency.stats()
+                    for stage, latency in self.stages.items()}
+
+    def to_json(self, indent=2):
+        """Return the summary as a JSON string."""
+        return json.dumps(self.summary(), indent=indent)
+
+    def dump(self, path):
+        """Write the summary as JSON to path."""
+        with open(path, 'w') as json_file:
+            json_file.write(self.to_json())
+
+    def draw(self, img, org=(200, 40), line_height=11, percentile=95):
+        """
+        Draw a latency percentile of each top level stage onto img.
+
+        Sub-stages, named with a dot, are left out to fit small displays.
+
+        Keyword arguments:
+        img -- image to draw on in place
+        org -- bottom left corner of the first line of text
+        line_height -- pixels between lines of text
+        percentile -- one of PROFILE_PERCENTILES
+
+        """
+        x_pos, y_pos = org
+        key = 'p{}'.format(percentile)
+        for stage, stats in self.summary().items():
+            if '.' in stage or key not in stats:
+                continue
+            cv2.putText(img, '{} {:.1f}ms'.format(stage[:12], stats[key]),
+                        (x_pos, y_pos), cv2.FONT_HERSHEY_SIMPLEX, 0.3,
+                        (255, 255, 255), 1)
+            y_pos += line_height
+
+
+# Profiler shared by all stages of the control loop
+stage_profiler = StageProfiler()
@@ -0,0 +1,131 @@
+"""
+Module for recording runs off the control loop.
+
+Camera frames arrive from the simulator already JPEG encoded, so they
+are written as received by a worker thread, in batches, into an IMG
+folder next to a robot_log.csv telemetry log, in the layout and format
+of the test datasets so recorded runs can be replayed.
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import os
+import queue
+import threading
+from datetime import datetime
+
+
+# Header of the telemetry log recorded by the simulator for the datasets
+ROBOT_LOG_HEADER = (
+    'Path;SteerAngle;Throttle;Brake;Speed;X_Position;Y_Position;Pitch;Yaw;Roll'
+)
+
+
+class FrameRecorder():
+    """
+    Create a class to record camera frames and telemetry in the background.
+
+    Frames submitted while the queue of pending frames is full are
+    dropped and counted rather than making the caller wait.
+
+    """
+
+    def __init__(self, image_folder, log_name='robot_log.csv',
+                 batch_size=16, max_pending=64):
+        """
+        Initialize a FrameRecorder instance and start its worker.
+
+        Keyword arguments:
+        image_folder -- existing folder to save the telemetry log in, and
+                        frames in its IMG folder
+        log_name -- file name of the telemetry log in image_folder
+        batch_size -- maximum number of frames written per batch
+        max_pending -- maximum number of frames waiting to be written
+
+        """
+        self.image_folder = image_folder
+        self.img_folder = os.path.join(image_folder, 'IMG')
+        os.makedirs(self.img_folder, exist_ok=True)
+        self.log_path = os.path.join(image_folder, log_name)
+        self.batch_size = batch_size
+        self.recorded = 0  # Number of frames written so far
+        self.dropped = 0  # Number of frames dropped under backpressure
+        self._last_stamp = None  # Timestamp of the last written frame
+        self._stamp_repeats = 0  # Frames written with the same timestamp
+
+        with open(self.log_path, 'w') as log_file:
+            log_file.write(ROBOT_LOG_HEADER + '\n')
+
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, jpeg_bytes, Rover):
+        """
+        Queue a camera frame and current telemetry to be recorded.
+
+        Return value:
+        True if queued, False if dropped because the queue is full
+
+        """
+        telemetry = (Rover.steer, Rover.throttle, Rover.brake, Rover.vel,
+                     Rover.pos[0], Rover.pos[1],
+                     Rover.pitch, Rover.yaw, Rover.roll)
+        try:
+            self._pending.put_nowait((datetime.utcnow(), jpeg_bytes,
+                                      telemetry))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        """Stop the worker after writing all pending frames."""
+        if self._worker is not None:
+            self._pending.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _write_batch(self, batch):
+        """Write frames of a batch and append their telemetry lines."""
+        log_lines = []
+        for timestamp, jpeg_bytes, telemetry in batch:
+            stamp = timestamp.strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+            # Keep frames received within the same millisecond apart
+            if stamp == self._last_stamp:
+                self._stamp_repeats += 1
+                image_name = 'robocam_{}_{}.jpg'.format(stamp,
+                                                        self._stamp_repeats)
+            else:
+                self._last_stamp, self._stamp_repeats = stamp, 0
+                image_name = 'robocam_{}.jpg'.format(stamp)
+            image_path = os.path.join(self.img_folder, image_name)
+            with open(image_path, 'wb') as image_file:
+                image_file.write(jpeg_bytes)
+            log_lines.append(
+                ';'.join([image_path] + [str(value) for value in telemetry])
+            )
+
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('\n'.join(log_lines) + '\n')
+        self.recorded += len(batch)
+
+    def _run(self):
+        """Write submitted frames in batches until closed."""
+        closed = False
+        while not closed:
+            batch = [self._pending.get()]
+            # Gather frames queued meanwhile into the same batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closed = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                self._write_batch(batch)
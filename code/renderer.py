@@ -0,0 +1,121 @@
+"""
+Module for rendering display overlays off the control loop.
+
+Rendering the worldmap and rover vision displays and JPEG encoding them
+does not affect the commands sent to the rover, so it is done at a lower
+rate in a worker thread while each telemetry frame reuses the most
+recently encoded images.
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import copy
+import time
+import queue
+import threading
+
+from supporting_functions import create_output_images
+
+
+def snapshot_state(Rover, Decider):
+    """
+    Copy the rover and decider state read by create_output_images.
+
+    Arrays that perception updates in place are copied so that rendering
+    from the snapshot is unaffected by frames processed meanwhile, and
+    create_output_images may draw on the vision image of the snapshot.
+
+    Return value:
+    rover_snapshot, decider_snapshot -- shallow copies owning their arrays
+
+    """
+    rover_snapshot = copy.copy(Rover)
+    rover_snapshot.vision_image = Rover.vision_image.copy()
+
+    rover_snapshot.worldmap = copy.copy(Rover.worldmap)
+    rover_snapshot.worldmap.counts = Rover.worldmap.counts.copy()
+    rover_snapshot.map_stats = copy.copy(Rover.map_stats)
+
+    if Rover.sample_locator is not None:
+        rover_snapshot.sample_locator = copy.copy(Rover.sample_locator)
+        rover_snapshot.sample_locator.located = (
+            Rover.sample_locator.located.copy()
+        )
+
+    return rover_snapshot, copy.copy(Decider)
+
+
+class OverlayRenderer():
+    """
+    Create a class to render display output images at a limited rate.
+
+    At most one render is pending at any time; frames arriving while the
+    worker is busy or before the next render is due simply reuse the last
+    encoded images.
+
+    """
+
+    def __init__(self, rate=5.0):
+        """
+        Initialize an OverlayRenderer instance and start its worker.
+
+        Keyword arguments:
+        rate -- renders per second, or 0 to render synchronously every frame
+
+        """
+        self.rate = rate
+        self.last_render_time = None
+        self.out_image_strings = ('', '')
+        self.renders = 0  # Number of images rendered so far
+
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(maxsize=1)
+        self._worker = None
+        if rate > 0:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def submit(self, Rover, Decider):
+        """Request new output images of current state if a render is due."""
+        if self._worker is None:
+            self._store(create_output_images(Rover, Decider))
+            return
+
+        now = time.monotonic()
+        if (self.last_render_time is not None
+                and now - self.last_render_time < 1/self.rate):
+            return
+        if self._pending.full():
+            return
+
+        self.last_render_time = now
+        self._pending.put_nowait(snapshot_state(Rover, Decider))
+
+    def latest(self):
+        """Return the most recently encoded pair of output image strings."""
+        with self._lock:
+            return self.out_image_strings
+
+    def close(self):
+        """Stop the worker after any pending render."""
+        if self._worker is not None:
+            self._pending.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _store(self, out_image_strings):
+        """Publish newly encoded output images."""
+        with self._lock:
+            self.out_image_strings = out_image_strings
+            self.renders += 1
+
+    def _run(self):
+        """Render snapshots as they are submitted until closed."""
+        while True:
+            state = self._pending.get()
+            if state is None:
+                break
+            self._store(create_output_images(*state))
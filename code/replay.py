@@ -0,0 +1,292 @@
+"""
+Replay recorded datasets through the rover pipeline without the simulator.
+
+Frames in the IMG folder of a dataset are streamed together with the rows
+of its robot_log.csv as telemetry messages into update_rover, followed by
+perception_step and DecisionSupervisor.execute as fast as possible.
+Reports frames per second, latency of each stage and final map statistics.
+
+Example:
+$ python replay.py ../test_dataset_2 --mode warp_labels --render
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import os
+import csv
+import time
+import base64
+import argparse
+
+import numpy as np
+
+import decision_new
+from perception import (
+    perception_step, get_perception_roi, PERCEPTION_MODES
+)
+from profiling import stage_profiler
+from clock import make_clock, CLOCKS
+from rover_telemetry import RoverTelemetry
+from supporting_functions import update_rover, create_output_images
+from telemetry import TelemetryDecoder, JPEG_DECODERS
+
+
+def iter_robot_log(dataset_dir):
+    """
+    Yield rows of the robot_log.csv of a recorded dataset.
+
+    Image paths in robot_log.csv are resolved by file name in the IMG
+    folder of dataset_dir, since some logs hold absolute paths of the
+    recording machine.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+
+    """
+    img_folder = os.path.join(dataset_dir, 'IMG')
+    with open(os.path.join(dataset_dir, 'robot_log.csv')) as log_file:
+        for row in csv.DictReader(log_file, delimiter=';'):
+            row['Path'] = os.path.join(img_folder,
+                                       os.path.basename(row['Path']))
+            yield row
+
+
+def iter_telemetry(dataset_dir):
+    """
+    Yield telemetry messages of a recorded dataset.
+
+    Messages carry the same fields as those sent by the simulator.
+    Sample positions are not recorded, so none are reported.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+
+    """
+    for row in iter_robot_log(dataset_dir):
+        with open(row['Path'], 'rb') as img_file:
+            img_string = base64.b64encode(img_file.read()).decode('utf-8')
+        yield {
+            'speed': row['Speed'],
+            'position': '{};{}'.format(row['X_Position'],
+                                       row['Y_Position']),
+            'yaw': row['Yaw'],
+            'pitch': row['Pitch'],
+            'roll': row['Roll'],
+            'throttle': row['Throttle'],
+            'steering_angle': row['SteerAngle'],
+            'near_sample': '0',
+            'picking_up': '0',
+            'samples_x': '',
+            'samples_y': '',
+            'sample_count': '0',
+            'image': img_string,
+        }
+
+
+def replay(dataset_dir, mode='warp_image', jpeg_decoder='pil',
+           render=False, limit=None, warmup=1, profile=False, roi=None,
+           clock='frame'):
+    """
+    Run the rover pipeline on every frame of a recorded dataset.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+    mode -- perception mode, one of perception.PERCEPTION_MODES
+    jpeg_decoder -- library decoding camera images
+    render -- True to also render the display output images
+    limit -- maximum number of frames to replay, None for all
+    warmup -- number of first frames left out of the latency statistics,
+              these build lookup tables and buffers
+    profile -- True to also time sub-stages with profiling.stage_profiler
+    roi -- perception.PerceptionROI to perceive only its pixels, None for
+           full frame perception
+    clock -- one of clock.CLOCKS timing the mission and stuck timers,
+             'frame' to decide as if frames arrived at the simulator's
+             rate, whatever the replay speed
+
+    Return value:
+    results -- dict of:
+        frames -- number of frames replayed
+        fps -- frames per second over time spent in the stages
+        <stage>_ms -- latency statistics of each stage (ms)
+        profile -- stage_profiler.summary() of every stage and sub-stage,
+                   if profile is True
+        perc_mapped, fidelity -- final map statistics (%)
+        transitions -- DecisionSupervisor.describe_transitions() of the
+                       transitions taken at least once
+        Rover -- final rover state
+
+    """
+    Rover = RoverTelemetry(clock=make_clock(clock))
+    Decider = decision_new.DecisionSupervisor()
+    decoder = TelemetryDecoder(jpeg_decoder=jpeg_decoder)
+
+    stages = ['update_rover', 'perception_step', 'decision']
+    if render:
+        stages.append('create_output_images')
+    latencies = {stage: [] for stage in stages}
+
+    stage_profiler.enabled = profile and not warmup
+    stage_profiler.reset()
+    frames = 0
+    for data in iter_telemetry(dataset_dir):
+        if limit is not None and frames >= limit:
+            break
+        frames += 1
+        times = [time.perf_counter()]
+
+        update_rover(Rover, data, decoder)
+        times.append(time.perf_counter())
+        if np.isfinite(Rover.vel):
+            perception_step(Rover, mode=mode, roi=roi)
+            times.append(time.perf_counter())
+            Decider.execute(Rover)
+            times.append(time.perf_counter())
+            if render:
+                create_output_images(Rover, Decider)
+                times.append(time.perf_counter())
+
+        if frames == warmup:
+            # Leave warmup frames out of the sub-stage statistics too
+            stage_profiler.enabled = profile
+            stage_profiler.reset()
+        elif frames > warmup:
+            for stage, start, end in zip(stages, times[:-1], times[1:]):
+                latencies[stage].append(end - start)
+                stage_profiler.record(stage, end - start)
+
+    results = {'frames': frames}
+    total_time = sum(sum(stage_times) for stage_times in latencies.values())
+    # NaN if all frames were warmup frames, none of them being timed
+    results['fps'] = float('nan')
+    if total_time > 0:
+        results['fps'] = len(latencies['update_rover']) / total_time
+    for stage, stage_times in latencies.items():
+        if stage_times:
+            stage_times = 1000*np.array(stage_times)
+            results[stage + '_ms'] = {
+                'mean': np.mean(stage_times),
+                'p50': np.percentile(stage_times, 50),
+                'p95': np.percentile(stage_times, 95),
+                'max': np.max(stage_times),
+            }
+    if profile:
+        results['profile'] = stage_profiler.summary()
+        stage_profiler.enabled = False
+    results['transitions'] = [transition for transition
+                              in Decider.describe_transitions()
+                              if transition['count']]
+    results['perc_mapped'] = Rover.map_stats.perc_mapped
+    results['fidelity'] = Rover.map_stats.fidelity
+    results['Rover'] = Rover
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded dataset')
+    parser.add_argument(
+        'dataset',
+        type=str,
+        nargs='?',
+        default='../test_dataset',
+        help='Path to dataset folder holding robot_log.csv and IMG.'
+    )
+    parser.add_argument(
+        '--mode',
+        type=str,
+        default='warp_image',
+        choices=PERCEPTION_MODES,
+        help='Perception mode to replay with.'
+    )
+    parser.add_argument(
+        '--jpeg-decoder',
+        type=str,
+        default='pil',
+        choices=JPEG_DECODERS,
+        help='Library used to decode camera images.'
+    )
+    parser.add_argument(
+        '--render',
+        action='store_true',
+        help='Also render the display output images every frame.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='Maximum number of frames to replay.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Also report latency percentiles of perception sub-stages.'
+    )
+    parser.add_argument(
+        '--profile-json',
+        type=str,
+        default='',
+        help='Path to write stage latency statistics to as JSON.' +
+        ' Implies --profile.'
+    )
+    parser.add_argument(
+        '--clock',
+        type=str,
+        default='frame',
+        choices=CLOCKS,
+        help='Clock timing the mission and stuck timers. frame advances' +
+        ' at the simulator rate per frame, for repeatable decisions.'
+    )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help='Perceive only pixels inside the camera field of view.'
+    )
+    parser.add_argument(
+        '--roi-dist',
+        type=float,
+        default=None,
+        help='Perceive only pixels closer than this to the rover.' +
+        ' Implies --roi.'
+    )
+    parser.add_argument(
+        '--roi-step',
+        type=int,
+        default=1,
+        help='Perceive only every n-th row and column of pixels.' +
+        ' Implies --roi when above 1.'
+    )
+    args = parser.parse_args()
+
+    roi = None
+    if args.roi or args.roi_dist is not None or args.roi_step > 1:
+        roi = get_perception_roi(max_dist=args.roi_dist, step=args.roi_step)
+    profile = args.profile or bool(args.profile_json)
+    results = replay(args.dataset, mode=args.mode,
+                     jpeg_decoder=args.jpeg_decoder,
+                     render=args.render, limit=args.limit, profile=profile,
+                     roi=roi, clock=args.clock)
+
+    print('{:>24}: {}'.format('frames', results['frames']))
+    print('{:>24}: {:.1f}'.format('fps', results['fps']))
+    for name, value in results.items():
+        if name.endswith('_ms'):
+            print('{:>24}: {}'.format(name, ' '.join(
+                '{} {:.3f}'.format(stat, stat_value)
+                for stat, stat_value in value.items())))
+    print('{:>24}: {:.1f}'.format('perc_mapped', results['perc_mapped']))
+    print('{:>24}: {:.1f}'.format('fidelity', results['fidelity']))
+    for transition in results['transitions']:
+        print('{:>24}: {} -> {} on {}'.format(
+            transition['count'], transition['from'], transition['to'],
+            transition['guard']))
+    if profile:
+        for stage, stats in results['profile'].items():
+            print('{:>24}: {}'.format(stage, ' '.join(
+                '{} {:.3f}'.format(stat, stats[stat])
+                for stat in ('p50', 'p95', 'p99'))))
+    if args.profile_json:
+        stage_profiler.dump(args.profile_json)
@@ -0,0 +1,217 @@
+"""
+Module for the state of driving one simulator.
+
+A RoverSession owns everything a telemetry frame reads and updates: the
+rover telemetry, decision supervisor, telemetry decoder, perception
+buffers, frame deadline, display renderer and frame recorder. A server
+driving one simulator keeps a single session, while a server driving a
+fleet of simulators keeps a session per connection, so that no state is
+shared between rovers and their frames can be processed concurrently.
+
+Usage, once before the first frame:
+session.warm_up()
+
+Usage, once per telemetry frame:
+session.count_frame()
+valid = session.process(data)
+... send session.command(valid) ...
+session.end_frame()
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import logging
+
+import numpy as np
+
+import decision_new
+import perception
+from perception import perception_step, PerceptionContext
+from supporting_functions import update_rover
+from telemetry import TelemetryDecoder
+from profiling import stage_profiler
+from deadline import FrameDeadline, SUBSAMPLED_SRC_STEP
+from renderer import OverlayRenderer
+from recorder import FrameRecorder
+from rover_telemetry import RoverTelemetry
+
+log = logging.getLogger(__name__)
+
+
+class RoverSession():
+    """Create a class for the state of driving one simulator."""
+
+    def __init__(self, name='rover', perception_mode='warp_image', roi=None,
+                 jpeg_decoder='pil', hud_rate=5.0, frame_budget=0.04,
+                 image_folder=''):
+        """
+        Initialize a RoverSession instance.
+
+        Keyword arguments:
+        name -- identifies the session in logs, e.g. its connection id
+        perception_mode -- one of perception.PERCEPTION_MODES
+        roi -- perception.PerceptionROI to perceive only its pixels, None
+               for full frame perception (read only, so may be shared)
+        jpeg_decoder -- library decoding camera images, one of
+                        telemetry.JPEG_DECODERS
+        hud_rate -- rate (Hz) of rendering display overlays in the
+                    background, 0 renders them synchronously every frame
+        frame_budget -- seconds available to process a frame, 0 disables
+                        degradation
+        image_folder -- existing folder to record frames in, '' to not
+                        record them
+
+        """
+        self.name = name
+        self.perception_mode = perception_mode
+        self.roi = roi
+
+        self.Rover = RoverTelemetry()
+        self.Decider = decision_new.DecisionSupervisor()
+        # Decode telemetry of this session
+        self.telemetry_decoder = TelemetryDecoder(jpeg_decoder=jpeg_decoder)
+        # Perceive into buffers of this session
+        self.perception_context = PerceptionContext()
+        # Watch frame cost against the telemetry period
+        self.frame_deadline = FrameDeadline(budget=frame_budget)
+        # Render display overlays off the control loop
+        self.overlay_renderer = OverlayRenderer(rate=hud_rate)
+        self.frame_recorder = None
+        if image_folder != '':
+            self.frame_recorder = FrameRecorder(image_folder)
+
+        self.busy = False  # True while a frame is being processed
+        self.closing = False  # True to close once the frame is processed
+        self.dropped = 0  # Frames dropped as they arrived while busy
+        self.jpeg_bytes = None  # Camera image of the current frame
+
+        # Variables to track frames per second (FPS)
+        self.frame_counter = 0
+        self.second_counter = time.time()
+        self.fps = None
+
+    def warm_up(self, height=160, width=320):
+        """
+        Build perception tables and buffers before the first frame.
+
+        Otherwise the first frame takes several hundred ms and its
+        deadline overrun needlessly degrades the frames that follow.
+
+        Keyword arguments:
+        height, width -- dimensions of the simulator camera images
+
+        """
+        perception.warm_up(height, width, self.perception_mode,
+                           src_steps=(1, SUBSAMPLED_SRC_STEP), roi=self.roi,
+                           context=self.perception_context)
+
+    def count_frame(self):
+        """Count a telemetry frame, logging a rough FPS every second."""
+        self.frame_counter += 1
+        if (time.time() - self.second_counter) > 1:
+            self.fps = self.frame_counter
+            self.frame_counter = 0
+            self.second_counter = time.time()
+            log.info("Current FPS of %s: %s", self.name, self.fps)
+
+    def process(self, data):
+        """
+        Decode a telemetry frame, perceive and decide rover commands.
+
+        Touches only the state of this session, so frames of different
+        sessions may be processed in concurrent threads.
+
+        Keyword arguments:
+        data -- telemetry message dictionary
+
+        Return value:
+        True if the telemetry was valid and the commands to send are
+        those of self.Rover, False if null commands should be sent
+
+        """
+        self.frame_deadline.begin_frame()
+        # Initialize / update Rover with current telemetry
+        start = stage_profiler.start()
+        self.Rover, self.jpeg_bytes = update_rover(self.Rover, data,
+                                                   self.telemetry_decoder)
+        start = stage_profiler.lap('update_rover', start)
+
+        if not np.isfinite(self.Rover.vel):
+            return False
+
+        # Execute perception and decision steps to update Rover's
+        # telemetry, cheaper if recent frames ran past their deadline
+        self.Rover = perception_step(
+            self.Rover, mode=self.perception_mode,
+            src_step=self.frame_deadline.src_step,
+            update_map=not self.frame_deadline.skip_map_update,
+            roi=self.roi, context=self.perception_context
+        )
+        start = stage_profiler.lap('perception_step', start)
+        self.Rover = self.Decider.execute(self.Rover)
+        stage_profiler.lap('decision', start)
+
+        # Request output images to send to server, rendered at a lower
+        # rate than telemetry in the background, unless frames run late
+        if not self.frame_deadline.skip_hud:
+            self.overlay_renderer.submit(self.Rover, self.Decider)
+        return True
+
+    def command(self, valid):
+        """
+        Choose the command to send for the frame processed.
+
+        Pickup and control commands both trigger the simulator to send
+        back new telemetry, so only one of them is sent per frame.
+
+        Keyword arguments:
+        valid -- value returned by process() for the frame
+
+        Return value:
+        'pickup', None -- to pick up a rock sample
+        'control', (commands, image_string1, image_string2) -- throttle,
+            brake and steer, and display images, null for invalid
+            telemetry
+
+        """
+        # In case of invalid telemetry, send null commands
+        if not valid:
+            return 'control', ((0, 0, 0), '', '')
+
+        # If in a state where want to pickup a rock send pickup command
+        Rover = self.Rover
+        if Rover.send_pickup and not Rover.picking_up:
+            Rover.send_pickup = False  # Reset Rover flags
+            return 'pickup', None
+
+        commands = (Rover.throttle, Rover.brake, Rover.steer)
+        return 'control', (commands,) + self.overlay_renderer.latest()
+
+    def end_frame(self):
+        """Finish a frame once its commands are sent."""
+        # Measure frame cost up to the commands sent, adjusting the work
+        # done on the next frames
+        self.frame_deadline.end_frame()
+
+        # Record the frame in the background, dropped if recording lags
+        if self.frame_recorder is not None:
+            self.frame_recorder.submit(self.jpeg_bytes, self.Rover)
+
+    def close(self):
+        """Stop background workers and log statistics of the session."""
+        self.overlay_renderer.close()
+        log.info("Frame deadline of %s: %s", self.name,
+                 self.frame_deadline.report())
+        if self.dropped:
+            log.info("Dropped %d frames of %s arriving while busy",
+                     self.dropped, self.name)
+        if self.frame_recorder is not None:
+            # Write frames still pending
+            self.frame_recorder.close()
+            log.info("Recorded %d frames of %s, dropped %d",
+                     self.frame_recorder.recorded, self.name,
+                     self.frame_recorder.dropped)
@@ -0,0 +1,106 @@
+"""
+Module for the rover state container.
+
+Holds the rover telemetry values received from the simulator together
+with the results of perception analysis, for the live server as well as
+offline replay of recorded datasets.
+
+"""
+
+__author__ = 'Salman Hashmi, Ryan Keenan, Curt Welch'
+__license__ = 'BSD License'
+
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from clock import MonotonicClock
+from features import FrameFeatures
+from worldmap import WorldMap, MapStats
+
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+ground_truth = mpimg.imread('../calibration_images/map_bw.png')
+
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying
+# map output looks green in the display image
+ground_truth_3d = np.dstack(
+    (ground_truth*0, ground_truth*255, ground_truth*0)
+).astype(np.float)
+
+
+class RoverTelemetry():
+    """
+    Create a class to be a container for rover state telemetry values.
+
+    This allows for tracking telemetry values and results from
+    perception analysis
+
+    """
+
+    def __init__(self, clock=None):
+        """
+        Initialize a RoverTelemetry instance to retain parameters.
+
+        Keyword arguments:
+        clock -- clock.MonotonicClock or clock.FrameClock timing the
+                 mission and stuck timers, real time if None
+
+        NOTE: distances in meters and angles in degrees
+
+        """
+        # Clock read for total time and by the decision supervisor
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.start_time = None  # To record the start time of navigation
+        self.total_time = None  # To record total duration of navigation
+        self.img = None  # Current camera image
+        self.decode_time = None  # Seconds taken to decode last telemetry
+        self.pos = None  # Current position (x, y)
+        self.yaw = None  # Current yaw angle
+        self.pitch = None  # Current pitch angle
+        self.roll = None  # Current roll angle
+        self.vel = None  # Current velocity (m/s)
+        self.steer = 0  # Current steering angle
+        self.throttle = 0  # Current throttle value
+        self.brake = 0  # Current brake value
+
+        self.nav_dists = None  # Distances to navigable terrain pixels
+        self.nav_angles = None  # Angles of navigable terrain pixels
+        self.nav_angles_left = None  # Nav terrain angles left of rover heading
+
+        self.obs_dists = None  # Distances to obstacle terrain pixels
+        self.obs_angles = None  # Angles of obstacle terrain pixels
+
+        self.rock_dists = None  # Distances to rock terrain pixels
+        self.rock_angles = None  # Angles of rock terrain pixels
+        # Counts, means and medians of the above, computed once per frame
+        self.features = FrameFeatures()
+
+        self.samples_pos = None  # To store the actual sample positions
+        self.sample_locator = None  # To confirm samples located on worldmap
+        self.samples_to_find = 0  # To store the initial count of samples
+        self.samples_collected = 0  # To count the number of samples collected
+        self.near_sample = 0  # To be set to TLM value data["near_sample"]
+        self.picking_up = 0  # To be set to TLM value data["picking_up"]
+        self.send_pickup = False  # Set to True to trigger rock pickup
+
+        self.home_distance = None  # Current distance to starting location
+        self.home_heading = None  # Current heading to starting location
+        self.going_home = False  # Default rover configuration
+
+        self.timer_on = False  # Timer to determine duration of stuck
+        self.stuck_heading = 0.0  # Heading at the time of getting stuck
+
+        # Rover vision image to be updated with displays of
+        # intermediate analysis steps on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float)
+
+        # Worldmap image to be updated with the positions of
+        # ROIs navigable terrain, obstacles and rock samples
+        self.worldmap = WorldMap(world_size=200)
+        self.ground_truth = ground_truth_3d  # Ground truth worldmap
+        # To track % of ground truth map successfully found and fidelity
+        self.map_stats = MapStats(ground_truth_3d[:, :, 1])
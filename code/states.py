@@ -62,7 +62,8 @@ class FollowWall():
         """Execute the FollowWall state action."""
 
         # Add negative bias to nav angles left of rover to follow wall
-        wall_heading = np.mean(Rover.nav_angles_left) + self.WALL_ANGLE_OFFSET
+        wall_heading = (Rover.features.mean('nav_angles_left')
+                        + self.WALL_ANGLE_OFFSET)
         # Drive below max velocity
         if Rover.vel < self.MAX_VEL:
             Rover.throttle = self.THROTTLE_SET
@@ -136,7 +137,7 @@ class AvoidObstacles():
 
     def execute(self, Rover):
         """Execute the AvoidObstacles state action."""
-        nav_heading = np.mean(Rover.nav_angles)
+        nav_heading = Rover.features.mean('nav_angles')
         # Stop before avoiding obstacles
         if Rover.vel > self.MIN_VEL:
             Rover.throttle = 0
@@ -172,7 +173,7 @@ class GoToSample():
 
     def execute(self, Rover):
         """Execute the GoToSample state action."""
-        rock_pixs = len(Rover.rock_angles)
+        rock_pixs = Rover.features.count('rock_angles')
         # Stop before going to sample
         if Rover.vel > self.APPROACH_VEL:
             Rover.throttle = 0
@@ -183,7 +184,8 @@ class GoToSample():
             # If sample in view
             if rock_pixs >= 1:
                 # Add a right bias to heading so as not to bump in left wall
-                rock_heading = np.mean(Rover.rock_angles) + self.HEADING_BIAS
+                rock_heading = (Rover.features.mean('rock_angles')
+                                + self.HEADING_BIAS)
                 # Yaw left if rock sample to left more than 23 deg
                 if rock_heading >= 23:
                     Rover.throttle = 0
@@ -256,7 +258,7 @@ class GetUnstuck():
 
     def execute(self, Rover):
         """Execute the GetUnstuck state action."""
-        nav_heading = np.mean(Rover.nav_angles)
+        nav_heading = Rover.features.mean('nav_angles')
 
         # Yaw value measured from either
         # right or left of the obstacle
@@ -319,7 +321,7 @@ class ReturnHome():
         Rover.home_heading = np.mean(home_headings)
 
         # Drive at a weighted average of home and nav headings with a 3:7 ratio
-        nav_heading = np.mean(Rover.nav_angles)
+        nav_heading = Rover.features.mean('nav_angles')
         homenav_heading = 0.3*Rover.home_heading + (1 - 0.3)*nav_heading
 
         # Keep within max velocity
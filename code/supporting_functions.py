@@ -10,172 +10,246 @@ __author__ = 'Salman Hashmi, Ryan Keenan'
 __license__ = 'BSD License'
 
 
-import time
 import base64
-from io import BytesIO, StringIO
+import logging
+from io import BytesIO
 
 import cv2
 import numpy as np
 from PIL import Image
 
+from profiling import stage_profiler
+from telemetry import parse_floats, telemetry_decoder
+from telemetry_logging import SampledLogger
+from worldmap import OBS_CHANNEL, NAV_CHANNEL, SampleLocator
 
-def convert_to_float(string_to_convert):
-    """
-    Convert telemetry strings to float.
 
-    This is done independent of decimal convention
+log = logging.getLogger(__name__)
+
+# Per-frame rover status, logged at a limited rate
+status_log = SampledLogger(log, rate=1.0)
+
 
+def update_rover(Rover, data, decoder=telemetry_decoder):
     """
-    if ',' in string_to_convert:
-        float_value = np.float(string_to_convert.replace(',', '.'))
-    else:
-        float_value = np.float(string_to_convert)
-    return float_value
+    Update rover state.
+
+    Keyword arguments:
+    Rover -- rover telemetry instance to update
+    data -- telemetry message dictionary
+    decoder -- TelemetryDecoder instance to decode data with
 
+    Return value:
+    Rover, jpeg_bytes -- updated Rover and camera image for optional saving
+
+    """
+    # Mark a new frame for clocks advancing with telemetry
+    Rover.clock.tick()
 
-def update_rover(Rover, data):
-    """Update rover state."""
     # Initialize start time and sample positions
     if Rover.start_time is None:
-        Rover.start_time = time.time()
+        Rover.start_time = Rover.clock.now()
         Rover.total_time = 0
-        samples_xpos = np.int_(
-              [convert_to_float(pos.strip())
-               for pos in data["samples_x"].split(';')]
-        )
-        samples_ypos = np.int_(
-              [convert_to_float(pos.strip())
-               for pos in data["samples_y"].split(';')]
-        )
+        samples_xpos = np.int_(parse_floats(data["samples_x"]))
+        samples_ypos = np.int_(parse_floats(data["samples_y"]))
         Rover.samples_pos = (samples_xpos, samples_ypos)
-        Rover.samples_to_find = np.int(data["sample_count"])
+        Rover.sample_locator = SampleLocator(Rover.samples_pos)
+        Rover.samples_to_find = int(data["sample_count"])
+        # Log the fields in the telemetry data dictionary
+        log.debug('Telemetry fields: %s', list(data.keys()))
 
     # Or just update elapsed time
     else:
-        tot_time = time.time() - Rover.start_time
+        tot_time = Rover.clock.now() - Rover.start_time
         if np.isfinite(tot_time):
             Rover.total_time = tot_time
 
-    # Print out the fields in the telemetry data dictionary
-    print(data.keys())
-    # The current speed of the rover in m/s
-    Rover.vel = convert_to_float(data["speed"])
-    # The current position of the rover
-    Rover.pos = [convert_to_float(pos.strip())
-                 for pos in data["position"].split(';')]
-    # The current yaw angle of the rover
-    Rover.yaw = convert_to_float(data["yaw"])
-    # The current yaw angle of the rover
-    Rover.pitch = convert_to_float(data["pitch"])
-    # The current yaw angle of the rover
-    Rover.roll = convert_to_float(data["roll"])
-    # The current throttle setting
-    Rover.throttle = convert_to_float(data["throttle"])
-    # The current steering angle
-    Rover.steer = convert_to_float(data["steering_angle"])
-    # Near sample flag
-    Rover.near_sample = np.int(data["near_sample"])
-    # Picking up flag
-    Rover.picking_up = np.int(data["picking_up"])
+    # Update speed, pose, controls, sample flags and the current image
+    # from the center camera of the rover
+    jpeg_bytes = decoder.decode(Rover, data)
     # Update number of rocks collected
-    Rover.samples_collected = (
-        Rover.samples_to_find - np.int(data["sample_count"])
-    )
-
-    print(
-        'speed =', Rover.vel,
-        'position =', Rover.pos,
-        'throttle =', Rover.throttle,
-        'steer_angle =', Rover.steer,
-        'near_sample:', Rover.near_sample,
-        'picking_up:', data["picking_up"],
-        'sending pickup:', Rover.send_pickup,
-        'total time:', Rover.total_time,
-        'samples remaining:', data["sample_count"],
-        'samples collected:', Rover.samples_collected
+    Rover.samples_collected = Rover.samples_to_find - int(data["sample_count"])
+
+    status_log.log(
+        'speed = %s position = %s throttle = %s steer_angle = %s'
+        ' near_sample: %s picking_up: %s sending pickup: %s'
+        ' total time: %s samples remaining: %s samples collected: %s'
+        ' decode time (ms): %.3f',
+        Rover.vel, Rover.pos, Rover.throttle, Rover.steer,
+        Rover.near_sample, Rover.picking_up, Rover.send_pickup,
+        Rover.total_time, data["sample_count"], Rover.samples_collected,
+        Rover.decode_time*1e3
     )
-    # Get the current image from the center camera of the rover
-    imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    Rover.img = np.asarray(image)
 
     # Return updated Rover and separate image for optional saving
-    return Rover, image
+    return Rover, jpeg_bytes
+
+
+class TextStamp():
+    """
+    Create a class for text prerendered to be stamped onto images.
+
+    Text is drawn once with cv2.putText onto a blank canvas of the target
+    image shape, recording the pixels it covers and their colors. Stamping
+    then copies just those pixels, which gives the same result as drawing
+    the text again since putText (with default lineType) does not blend.
+
+    """
+
+    def __init__(self, shape, texts):
+        """
+        Initialize a TextStamp instance.
+
+        Keyword arguments:
+        shape -- shape of the 3 channel images to be stamped
+        texts -- sequence of (text, org, font, scale, color, thickness)
+                 tuples of cv2.putText arguments, drawn in order
+
+        """
+        canvas = np.zeros(shape, dtype=np.float32)
+        mask = np.zeros(shape[:2], dtype=np.uint8)
+        for text, org, font, scale, color, thickness in texts:
+            cv2.putText(canvas, text, org, font, scale, color, thickness)
+            cv2.putText(mask, text, org, font, scale, 255, thickness)
+
+        self.shape = shape
+        self.ypix_pts, self.xpix_pts = mask.nonzero()
+        self.colors = canvas[self.ypix_pts, self.xpix_pts]
+
+        # Flat indexes of every channel value of the covered pixels for
+        # faster stamping of contiguous images
+        num_channels = shape[2]
+        pix_idxs = self.ypix_pts*shape[1] + self.xpix_pts
+        self.value_idxs = (pix_idxs[:, np.newaxis]*num_channels
+                           + np.arange(num_channels)).reshape(-1)
+        self.values = self.colors.reshape(-1)
+
+    def stamp(self, img):
+        """Draw the prerendered text onto img in place."""
+        if img.flags.c_contiguous and img.shape == self.shape:
+            img.reshape(-1)[self.value_idxs] = self.values
+        else:
+            img[self.ypix_pts, self.xpix_pts] = self.colors
+
+
+# Text of HUD displays that never changes, as cv2.putText arguments
+MAP_STATIC_TEXTS = (
+    ("Time: ", (2, 10),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+    ("Mapped: ", (2, 25),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+    ("Fidelity: ", (2, 40),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+    ("Rocks", (2, 55),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+    (" Located: ", (10, 70),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+    (" Collected: ", (10, 85),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1),
+)
+MAP_GOING_HOME_TEXTS = (
+    ("Going Home:", (2, 145),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.37, (255, 255, 0), 1),
+    ("distance: ", (3, 160),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 255), 1),
+    ("heading: ", (3, 175),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.32, (255, 255, 255), 1),
+)
+MAP_IN_PROGRESS_TEXTS = (
+    ("Mission:", (2, 135),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.37, (255, 255, 255), 1),
+    ("In Progress", (10, 150),
+     cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 0), 1),
+)
+VISION_STATIC_TEXTS = (
+    ("> ", (5, 20),
+     cv2.FONT_HERSHEY_COMPLEX, 0.53, (55, 255, 17), 2),
+    ("State:", (23, 20),
+     cv2.FONT_HERSHEY_COMPLEX, 0.65, (55, 255, 17), 1),
+    ("Robot Vision", (5, 151),
+     cv2.FONT_HERSHEY_COMPLEX, 0.53, (255, 255, 255), 1),
+)
+
+# Prerendered text stamps keyed by (name, image shape)
+hud_stamps = {}
+
+
+def get_hud_stamp(name, shape, texts):
+    """Get the memoized TextStamp of texts for images of given shape."""
+    key = name, shape
+    if key not in hud_stamps:
+        hud_stamps[key] = TextStamp(shape, texts)
+    return hud_stamps[key]
+
+
+# Ground truth map and its version scaled for overlaying
+scaled_ground_truth = [None, None]
+
+
+def get_ground_truth_overlay(ground_truth, weight=0.5):
+    """Get ground truth map scaled by weight, computed once per map."""
+    if scaled_ground_truth[0] is not ground_truth:
+        scaled_ground_truth[:] = ground_truth, ground_truth*weight
+    return scaled_ground_truth[1]
 
 
 def create_output_images(Rover, Decider):
     """Create display output given worldmap results."""
-    # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:, :, 2]) > 0:
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        navigable = (Rover.worldmap[:, :, 2] *
-                     (255 / np.mean(Rover.worldmap[nav_pix, 2])))
-    else:
-        navigable = Rover.worldmap[:, :, 2]
+    start = stage_profiler.start()
+    map_add, vision_image = render_output_images(Rover, Decider)
 
-    if np.max(Rover.worldmap[:, :, 0]) > 0:
-        obs_pix = Rover.worldmap[:, :, 0] > 0
-        obstacle = (Rover.worldmap[:, :, 0] *
-                    (255 / np.mean(Rover.worldmap[obs_pix, 0])))
-    else:
-        obstacle = Rover.worldmap[:, :, 0]
+    # Convert map and vision image to base64 strings for sending to server
+    pil_img = Image.fromarray(map_add.astype(np.uint8))
+    buff = BytesIO()
+    pil_img.save(buff, format="JPEG")
+    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
+
+    pil_img = Image.fromarray(vision_image.astype(np.uint8))
+    buff = BytesIO()
+    pil_img.save(buff, format="JPEG")
+    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    stage_profiler.lap('create_output_images', start)
+
+    return encoded_string1, encoded_string2
+
+
+def render_output_images(Rover, Decider):
+    """
+    Draw worldmap and rover vision displays given worldmap results.
+
+    Return value:
+    map_add, vision_image -- float images of map display and of rover
+                             vision display (Rover.vision_image drawn on)
+
+    """
+    # Create a scaled map for plotting and clean up obs/nav pixels a bit
+    navigable = Rover.worldmap.normalized(NAV_CHANNEL)
+    obstacle = Rover.worldmap.normalized(OBS_CHANNEL)
 
     likely_nav = navigable >= obstacle
     obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
+    plotmap = np.zeros(Rover.worldmap.shape, dtype=np.float64)
     plotmap[:, :, 0] = obstacle
     plotmap[:, :, 2] = navigable
     plotmap = plotmap.clip(0, 255)
     # Overlay obstacle and navigable terrain map with ground truth map
-    map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
+    map_add = plotmap
+    map_add += get_ground_truth_overlay(Rover.ground_truth)
 
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:, :, 1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
+    # Plot the location of known samples confirmed by rock detections
+    # within 3 meters (samples located are tracked as the map is updated)
     samples_located = 0
-    if rock_world_pos[0].any():
+    if Rover.sample_locator is not None:
         rock_size = 2
-        for idx in range(len(Rover.samples_pos[0])):
-            test_rock_x = Rover.samples_pos[0][idx]
-            test_rock_y = Rover.samples_pos[1][idx]
-            rock_sample_dists = np.sqrt(
-                (test_rock_x - rock_world_pos[1])**2 +
-                (test_rock_y - rock_world_pos[0])**2
-            )
-            # If rocks were detected within 3 meters of known sample positions
-            # consider it a success and plot the location of the known
-            # sample on the map
-            if np.min(rock_sample_dists) < 3:
-                samples_located += 1
-                map_add[test_rock_y-rock_size:test_rock_y+rock_size,
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-    # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:, :, 2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(
-        len(((plotmap[:, :, 2] > 0) &
-            (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0])
-    )
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(
-        len(((plotmap[:, :, 2] > 0) &
-            (Rover.ground_truth[:, :, 1] == 0)).nonzero()[0])
-    )
-    # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
-
-    # Calculate % of ground truth map that has been successfully found
-    Rover.perc_mapped = round(100*good_nav_pix / tot_map_pix, 1)
+        samples_located = Rover.sample_locator.samples_located
+        for test_rock_x, test_rock_y in zip(
+                *Rover.sample_locator.located_pos()):
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size,
+                    test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
 
-    # Calculate the number of good map pixel detections divided by total pixels
-    # found to be navigable terrain
-    if tot_nav_pix > 0:
-        fidelity = round(100*good_nav_pix / (tot_nav_pix), 1)
-    else:
-        fidelity = 0
+    # Statistics on the map results are tracked as the map is updated
+    perc_mapped = Rover.map_stats.perc_mapped
+    fidelity = Rover.map_stats.fidelity
 
     # Flip the map for plotting so that the y-axis points upward in the display
     map_add = np.flipud(map_add).astype(np.float32)
@@ -183,85 +257,50 @@ def create_output_images(Rover, Decider):
     # NOTE: For more information, refer to OpenCV docs for putText function:
     #       http://docs.opencv.org/2.4/modules/core/doc/drawing_functions.html
 
-    # Add some text about map and rock sample detection results
-    cv2.putText(map_add, "Time: ",
-                (2, 10), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+    # Add prerendered labels, then text about map and rock sample
+    # detection results
+    get_hud_stamp('map', map_add.shape, MAP_STATIC_TEXTS).stamp(map_add)
+
     cv2.putText(map_add, ""+str(np.round(Rover.total_time, 1))+' s',
                 (39, 10), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-
-    cv2.putText(map_add, "Mapped: ",
-                (2, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
-    cv2.putText(map_add, ""+str(Rover.perc_mapped)+'%',
+    cv2.putText(map_add, ""+str(perc_mapped)+'%',
                 (57, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-
-    cv2.putText(map_add, "Fidelity: ",
-                (2, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, ""+str(fidelity)+'%',
                 (54, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-
-    cv2.putText(map_add, "Rocks",
-                (2, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
-
-    cv2.putText(map_add, " Located: ",
-                (10, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, ""+str(samples_located),
                 (74, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-
-    cv2.putText(map_add, " Collected: ",
-                (10, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, ""+str(Rover.samples_collected),
                 (80, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
 
     # Add information about ReturnHome state on map display
     if Rover.going_home:
-        cv2.putText(map_add, "Going Home:",
-                    (2, 145),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.37, (255, 255, 0), 1)
+        get_hud_stamp('going_home', map_add.shape,
+                      MAP_GOING_HOME_TEXTS).stamp(map_add)
 
-        cv2.putText(map_add, "distance: ",
-                    (3, 160),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 255), 1)
         cv2.putText(map_add, ""+str(np.round(Rover.home_distance, 1))+' m',
                     (55, 160),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 0), 1)
-
-        cv2.putText(map_add, "heading: ",
-                    (3, 175),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.32, (255, 255, 255), 1)
         cv2.putText(map_add, ""+str(np.round(Rover.home_heading, 1))+' deg',
                     (51, 175),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 0), 1)
     else:
-        cv2.putText(map_add, "Mission:",
-                    (2, 135),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.37, (255, 255, 255), 1)
-
-        cv2.putText(map_add, "In Progress",
-                    (10, 150),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 0), 1)
-
-    # Add state information on rover vision display
-    cv2.putText(Rover.vision_image, "> ",
-                (5, 20), cv2.FONT_HERSHEY_COMPLEX, 0.53, (55, 255, 17), 2)
-
-    cv2.putText(Rover.vision_image, "State:",
-                (23, 20), cv2.FONT_HERSHEY_COMPLEX, 0.65, (55, 255, 17), 1)
-
-    cv2.putText(Rover.vision_image, "_ "+Decider.curr_state.NAME.lower(),
-                (97, 20), cv2.FONT_HERSHEY_COMPLEX, 0.65, (55, 255, 17), 1)
-
-    cv2.putText(Rover.vision_image, "Robot Vision",
-                (5, 151), cv2.FONT_HERSHEY_COMPLEX, 0.53, (255, 255, 255), 1)
-
-    # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
-
-    return encoded_string1, encoded_string2
+        get_hud_stamp('in_progress', map_add.shape,
+                      MAP_IN_PROGRESS_TEXTS).stamp(map_add)
+
+    # Add state information on rover vision display, with the rendered
+    # name of each state memoized
+    vision_image = Rover.vision_image
+    get_hud_stamp('vision', vision_image.shape,
+                  VISION_STATIC_TEXTS).stamp(vision_image)
+
+    state_name = "_ "+Decider.curr_state.NAME.lower()
+    get_hud_stamp(state_name, vision_image.shape, (
+        (state_name, (97, 20),
+         cv2.FONT_HERSHEY_COMPLEX, 0.65, (55, 255, 17), 1),
+    )).stamp(vision_image)
+
+    # Add stage latencies on rover vision display when profiling
+    if stage_profiler.enabled:
+        stage_profiler.draw(vision_image)
+
+    return map_add, vision_image
@@ -0,0 +1,163 @@
+"""
+Module for decoding rover telemetry.
+
+Parses the fields of each telemetry message sent by the simulator with
+parsers selected once per field, and decodes the base64 encoded JPEG
+camera image straight into the RGB frame handed to perception.
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import binascii
+from io import BytesIO
+from operator import itemgetter
+
+import cv2
+import numpy as np
+from PIL import JpegImagePlugin
+
+
+# Libraries available to decode camera images, fastest one depends on
+# the libjpeg-turbo version each is built with
+JPEG_DECODERS = ('pil', 'opencv')
+
+
+def parse_float(string_to_convert):
+    """
+    Convert a telemetry string to float.
+
+    This is done independent of decimal convention
+
+    """
+    try:
+        return float(string_to_convert)
+    except ValueError:
+        return float(string_to_convert.replace(',', '.'))
+
+
+def parse_floats(string_to_convert):
+    """Convert a ';' separated telemetry string to a list of floats."""
+    if not string_to_convert:
+        return []
+    return [parse_float(value) for value in string_to_convert.split(';')]
+
+
+# Rover attribute, telemetry field and parser of each per-frame value
+TELEMETRY_FIELDS = (
+    ('vel', 'speed', parse_float),  # Current speed in m/s
+    ('pos', 'position', parse_floats),  # Current position (x, y)
+    ('yaw', 'yaw', parse_float),
+    ('pitch', 'pitch', parse_float),
+    ('roll', 'roll', parse_float),
+    ('throttle', 'throttle', parse_float),
+    ('steer', 'steering_angle', parse_float),
+    ('near_sample', 'near_sample', int),
+    ('picking_up', 'picking_up', int),
+)
+
+
+class TelemetryParser():
+    """
+    Create a class to parse telemetry fields into rover attributes.
+
+    The field lookups are compiled into one itemgetter so a message is
+    parsed with a single pass over pre-selected parsers.
+
+    """
+
+    def __init__(self, fields=TELEMETRY_FIELDS):
+        """
+        Initialize a TelemetryParser instance.
+
+        Keyword arguments:
+        fields -- tuple of (attribute, field, parser) tuples
+
+        """
+        self.attrs, self.fields, self.parsers = zip(*fields)
+        self._get_values = itemgetter(*self.fields)
+
+    def update(self, Rover, data):
+        """Set rover attributes to the parsed values of data."""
+        for attr, parser, value in zip(self.attrs, self.parsers,
+                                       self._get_values(data)):
+            setattr(Rover, attr, parser(value))
+
+
+class TelemetryDecoder():
+    """
+    Create a class to decode telemetry messages into rover state.
+
+    The camera image of every message is decoded into a new RGB frame
+    that is used as is, without copying it into a buffer of the decoder,
+    so consumers may retain frames but must not write to them.
+
+    """
+
+    def __init__(self, jpeg_decoder='pil', fields=TELEMETRY_FIELDS):
+        """
+        Initialize a TelemetryDecoder instance.
+
+        Keyword arguments:
+        jpeg_decoder -- library decoding camera images, one of JPEG_DECODERS
+        fields -- tuple of (attribute, field, parser) tuples
+
+        """
+        if jpeg_decoder not in JPEG_DECODERS:
+            raise ValueError(
+                'Unknown JPEG decoder {!r}, expected one of {}'.format(
+                    jpeg_decoder, JPEG_DECODERS)
+            )
+        self.jpeg_decoder = jpeg_decoder
+        self.parser = TelemetryParser(fields)
+        self.decode_time = None  # Seconds taken to decode last message
+
+    def decode_image(self, img_string):
+        """
+        Decode a base64 encoded JPEG image into an RGB frame.
+
+        Keyword arguments:
+        img_string -- base64 encoded JPEG image string
+
+        Return value:
+        frame -- RGB image decoded from img_string, not to be written to
+        jpeg_bytes -- undecoded JPEG image bytes for optional saving
+
+        """
+        jpeg_bytes = binascii.a2b_base64(img_string)
+
+        if self.jpeg_decoder == 'opencv':
+            # OpenCV decodes to BGR, converted to RGB in place
+            frame = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8),
+                                 cv2.IMREAD_COLOR)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        else:
+            frame = np.asarray(
+                JpegImagePlugin.JpegImageFile(BytesIO(jpeg_bytes))
+            )
+
+        return frame, jpeg_bytes
+
+    def decode(self, Rover, data):
+        """
+        Update rover state with a telemetry message.
+
+        Sets Rover.img to the decoded camera frame and Rover.decode_time
+        to the seconds taken to decode the message.
+
+        Return value:
+        jpeg_bytes -- undecoded JPEG image bytes for optional saving
+
+        """
+        start = time.perf_counter()
+        self.parser.update(Rover, data)
+        Rover.img, jpeg_bytes = self.decode_image(data["image"])
+        self.decode_time = time.perf_counter() - start
+        Rover.decode_time = self.decode_time
+        return jpeg_bytes
+
+
+telemetry_decoder = TelemetryDecoder()
@@ -0,0 +1,92 @@
+"""
+Module for logging off the control loop.
+
+Log records of all rover modules are put on a queue and written to the
+console by a background thread, so logging from the telemetry handler
+never blocks on console I/O. Messages logged every frame go through a
+SampledLogger to limit them to a configurable rate.
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import queue
+import logging
+import logging.handlers
+
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def start_logging(level='INFO', stream=None, fmt=LOG_FORMAT):
+    """
+    Route log records through a queue drained by a background writer.
+
+    Keyword arguments:
+    level -- minimum level of records logged, one of LOG_LEVELS
+    stream -- stream records are written to, defaults to sys.stderr
+    fmt -- log record format string
+
+    Return value:
+    listener -- started QueueListener, stop() flushes remaining records
+
+    """
+    log_queue = queue.SimpleQueue()
+
+    writer = logging.StreamHandler(stream)
+    writer.setFormatter(logging.Formatter(fmt))
+    listener = logging.handlers.QueueListener(log_queue, writer)
+
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+    listener.start()
+    return listener
+
+
+class SampledLogger():
+    """
+    Create a class to log messages at a limited rate.
+
+    Messages arriving before the next one is due are dropped and counted
+    without being formatted.
+
+    """
+
+    def __init__(self, logger, rate=1.0, level=logging.DEBUG):
+        """
+        Initialize a SampledLogger instance.
+
+        Keyword arguments:
+        logger -- logging.Logger instance to log messages with
+        rate -- messages logged per second, or 0 to log every message
+        level -- level of logged messages
+
+        """
+        self.logger = logger
+        self.rate = rate
+        self.level = level
+        self.last_log_time = None
+        self.dropped = 0  # Number of messages dropped by sampling
+
+    def log(self, msg, *args):
+        """Log msg % args if enabled and due, return True if logged."""
+        if not self.logger.isEnabledFor(self.level):
+            return False
+
+        now = time.monotonic()
+        if (self.rate > 0 and self.last_log_time is not None
+                and now - self.last_log_time < 1/self.rate):
+            self.dropped += 1
+            return False
+
+        self.last_log_time = now
+        self.logger.log(self.level, msg, *args)
+        return True
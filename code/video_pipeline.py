@@ -0,0 +1,354 @@
+"""
+Render mapping videos of recorded datasets as a streaming pipeline.
+
+Replaces the notebook's process_image() + moviepy flow. A reader thread
+decodes camera frames, the calling thread maps them with perception_step
+and composes mosaic frames (camera, warped camera and worldmap overlay)
+into a small pool of reused buffers, and an encoder thread writes them to
+an ffmpeg pipe, or an OpenCV VideoWriter if ffmpeg is not installed.
+Stages are connected by bounded queues, so a slow stage holds back the
+others instead of letting frames pile up in memory. A stage thread that
+fails keeps its queues moving and leaves its error to be raised by the
+calling thread, so a failing reader or encoder never hangs the pipeline.
+
+Example:
+$ python video_pipeline.py ../test_dataset ../output/test_mapping.mp4
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import time
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+import cv2
+import matplotlib.image as mpimg
+
+from perception import perception_step, perspect_calibration, PERCEPTION_MODES
+from replay import iter_robot_log
+from rover_telemetry import RoverTelemetry
+from supporting_functions import get_hud_stamp, get_ground_truth_overlay
+from worldmap import OBS_CHANNEL, NAV_CHANNEL
+
+
+# Text drawn over the camera image of every mosaic frame, scaled to fit
+# within the 320 pixel wide camera image
+MOSAIC_TEXTS = (
+    ("Testing mapping of ROI pixels into a worldmap:", (20, 20),
+     cv2.FONT_HERSHEY_COMPLEX, 0.35, (255, 255, 255), 1),
+)
+
+
+class FfmpegWriter():
+    """Create a class to encode RGB frames by piping them to ffmpeg."""
+
+    def __init__(self, path, fps, frame_size, ffmpeg_exe='ffmpeg',
+                 preset='veryfast'):
+        """
+        Start an ffmpeg process encoding raw frames into an H.264 video.
+
+        Keyword arguments:
+        path -- output video file path
+        fps -- frames per second of the output video
+        frame_size -- width, height of the frames
+        ffmpeg_exe -- path to the ffmpeg executable
+        preset -- x264 speed preset, encoding takes most of the time of
+                  rendering a video with the default 'medium' preset
+
+        """
+        self.process = subprocess.Popen(
+            [ffmpeg_exe, '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+             '-s', '{}x{}'.format(*frame_size), '-r', str(fps), '-i', '-',
+             '-an', '-vcodec', 'libx264', '-preset', preset,
+             '-pix_fmt', 'yuv420p', path],
+            stdin=subprocess.PIPE
+        )
+
+    def write(self, frame):
+        """Write a uint8 RGB frame."""
+        self.process.stdin.write(frame.data)
+
+    def release(self):
+        """Finish encoding and wait for ffmpeg to exit."""
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class OpenCVWriter():
+    """Create a class to encode RGB frames with an OpenCV VideoWriter."""
+
+    def __init__(self, path, fps, frame_size, fourcc='mp4v'):
+        """
+        Open a VideoWriter on the output video.
+
+        Keyword arguments:
+        path -- output video file path
+        fps -- frames per second of the output video
+        frame_size -- width, height of the frames
+        fourcc -- four character code of the video codec
+
+        """
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc),
+                                      fps, frame_size)
+        width, height = frame_size
+        self.bgr_frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def write(self, frame):
+        """Write a uint8 RGB frame."""
+        cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.bgr_frame)
+        self.writer.write(self.bgr_frame)
+
+    def release(self):
+        """Finish encoding and close the video file."""
+        self.writer.release()
+
+
+def open_video_writer(path, fps, frame_size, ffmpeg_exe=None,
+                      preset='veryfast'):
+    """Open an ffmpeg pipe if ffmpeg is available, else a VideoWriter."""
+    ffmpeg_exe = ffmpeg_exe or shutil.which('ffmpeg')
+    if ffmpeg_exe:
+        return FfmpegWriter(path, fps, frame_size, ffmpeg_exe, preset)
+    return OpenCVWriter(path, fps, frame_size)
+
+
+class MosaicComposer():
+    """
+    Create a class to compose mosaic video frames into reused buffers.
+
+    A mosaic holds the camera image in the upper left, the warped camera
+    image in the upper right and the worldmap overlaid on the ground
+    truth map in the lower left. Every region is written in place, so
+    buffers handed back by the encoder are reused without clearing.
+
+    """
+
+    def __init__(self, img_shape, world_size=200, num_buffers=4):
+        """
+        Initialize a MosaicComposer instance.
+
+        Keyword arguments:
+        img_shape -- height, width of camera images
+        world_size -- integer length of square world map of 200 x 200 pixels
+        num_buffers -- number of mosaic buffers cycled through the pipeline
+
+        """
+        height, width = img_shape[:2]
+        self.img_shape = height, width
+        self.world_size = world_size
+        self.shape = height + world_size, 2*width, 3
+        self.free_buffers = queue.Queue()
+        for _ in range(num_buffers):
+            self.free_buffers.put(np.zeros(self.shape, dtype=np.uint8))
+        self.plotmap = np.zeros((world_size, world_size, 3), dtype=np.float64)
+
+    def compose(self, img, Rover):
+        """
+        Compose the mosaic of a camera image and the current worldmap.
+
+        Blocks until a buffer is handed back if all are in use.
+
+        Return value:
+        mosaic -- uint8 RGB mosaic image, to be handed back with release()
+
+        """
+        height, width = self.img_shape
+        mosaic = self.free_buffers.get()
+
+        mosaic[:height, :width] = img
+        map_x, map_y = perspect_calibration.get_warp(height, width)[1:]
+        cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR,
+                  dst=mosaic[:height, width:])
+        get_hud_stamp('mosaic', mosaic.shape, MOSAIC_TEXTS).stamp(mosaic)
+
+        # Overlay scaled obstacle and navigable terrain map with ground
+        # truth map, flipped so that the y-axis points upward
+        navigable = Rover.worldmap.normalized(NAV_CHANNEL)
+        obstacle = Rover.worldmap.normalized(OBS_CHANNEL)
+        obstacle[navigable >= obstacle] = 0
+        plotmap = self.plotmap
+        plotmap[:, :, 0] = obstacle
+        plotmap[:, :, 1] = 0  # Ground truth of the previous frame
+        plotmap[:, :, 2] = navigable
+        plotmap += get_ground_truth_overlay(Rover.ground_truth)
+        np.clip(plotmap, 0, 255, out=plotmap)
+        np.copyto(mosaic[height:, :self.world_size], plotmap[::-1],
+                  casting='unsafe')
+
+        return mosaic
+
+    def release(self, mosaic):
+        """Hand back a mosaic buffer once it has been encoded."""
+        self.free_buffers.put(mosaic)
+
+
+def _read_frames(rows, frames, stop, errors):
+    """Decode camera images of rows into the frames queue, then None."""
+    try:
+        for row in rows:
+            if stop.is_set():
+                break
+            frames.put((mpimg.imread(row['Path']), row))
+    except Exception as error:
+        errors.append(error)
+    frames.put(None)
+
+
+def _encode_frames(writer, mosaics, composer, errors):
+    """
+    Encode mosaics until None, handing their buffers back.
+
+    Once encoding fails, or another stage has failed, mosaics are only
+    handed back so that the composing thread never waits on the encoder,
+    and the error is left in errors.
+
+    """
+    while True:
+        mosaic = mosaics.get()
+        if mosaic is None:
+            break
+        if not errors:
+            try:
+                writer.write(mosaic)
+            except Exception as error:
+                errors.append(error)
+        composer.release(mosaic)
+    try:
+        writer.release()
+    except Exception as error:
+        errors.append(error)
+
+
+def render_video(dataset_dir, output_path, fps=60, mode='warp_image',
+                 queue_size=8, ffmpeg_exe=None, preset='veryfast'):
+    """
+    Render the mapping video of a recorded dataset.
+
+    Keyword arguments:
+    dataset_dir -- folder holding robot_log.csv and the IMG folder
+    output_path -- output video file path
+    fps -- frames per second of the output video
+    mode -- one of perception.PERCEPTION_MODES
+    queue_size -- maximum number of frames waiting between stages
+    ffmpeg_exe -- path to ffmpeg, None to look it up on the PATH
+    preset -- x264 speed preset used with ffmpeg
+
+    Return value:
+    Rover, num_frames -- RoverTelemetry holding the worldmap and map
+                         statistics, and number of frames rendered
+
+    """
+    rows = list(iter_robot_log(dataset_dir))
+    first_img = mpimg.imread(rows[0]['Path'])
+    composer = MosaicComposer(first_img.shape, num_buffers=queue_size + 2)
+    writer = open_video_writer(output_path, fps,
+                               (composer.shape[1], composer.shape[0]),
+                               ffmpeg_exe, preset)
+
+    frames = queue.Queue(maxsize=queue_size)
+    mosaics = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []  # Exceptions raised by the reader and encoder threads
+    reader = threading.Thread(target=_read_frames,
+                              args=(rows, frames, stop, errors), daemon=True)
+    encoder = threading.Thread(target=_encode_frames,
+                               args=(writer, mosaics, composer, errors),
+                               daemon=True)
+    reader.start()
+    encoder.start()
+
+    Rover = RoverTelemetry()
+    num_frames = 0
+    try:
+        while not errors:
+            item = frames.get()
+            if item is None:
+                break
+            img, row = item
+            Rover.img = img
+            Rover.pos = (float(row['X_Position']), float(row['Y_Position']))
+            Rover.yaw = float(row['Yaw'])
+            Rover.pitch = float(row['Pitch'])
+            Rover.roll = float(row['Roll'])
+            perception_step(Rover, mode=mode)
+            mosaics.put(composer.compose(img, Rover))
+            num_frames += 1
+    finally:
+        stop.set()
+        # Unblock the reader if it waits on a full queue
+        while reader.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                reader.join(0.01)
+        mosaics.put(None)
+        encoder.join()
+
+    if errors:
+        raise errors[0]
+
+    return Rover, num_frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render mapping video')
+    parser.add_argument(
+        'dataset',
+        type=str,
+        nargs='?',
+        default='../test_dataset',
+        help='Path to dataset folder holding robot_log.csv and IMG.'
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        nargs='?',
+        default='../output/test_mapping.mp4',
+        help='Path of the output video.'
+    )
+    parser.add_argument(
+        '--fps',
+        type=int,
+        default=60,
+        help='Frames per second of the output video.'
+    )
+    parser.add_argument(
+        '--mode',
+        type=str,
+        default='warp_image',
+        choices=PERCEPTION_MODES,
+        help='Perception mode to map with.'
+    )
+    parser.add_argument(
+        '--ffmpeg',
+        type=str,
+        default=None,
+        help='Path to ffmpeg, used instead of OpenCV when available.' +
+        ' Looked up on the PATH by default.'
+    )
+    parser.add_argument(
+        '--preset',
+        type=str,
+        default='veryfast',
+        help='x264 speed preset used with ffmpeg.'
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    Rover, num_frames = render_video(args.dataset, args.output, args.fps,
+                                     args.mode, ffmpeg_exe=args.ffmpeg,
+                                     preset=args.preset)
+    elapsed = time.perf_counter() - start
+    print('Rendered {} frames in {:.2f} s ({:.1f} fps), {:.1f}% mapped,'
+          ' {:.1f}% fidelity'.format(num_frames, elapsed,
+                                     num_frames / elapsed,
+                                     Rover.map_stats.perc_mapped,
+                                     Rover.map_stats.fidelity))
@@ -0,0 +1,259 @@
+"""
+Module for the rover worldmap.
+
+Accumulates detections of regions of interest (ROIs) in the world frame
+into per-channel counters, one channel per ROI.
+
+NOTE:
+
+Short Forms:
+pixpts -- pixel points
+nav -- navigable terrain pixels
+obs -- obstacle pixels
+rock -- rock pixels
+
+Abbreviations:
+ROI -- Regions of interest
+wf -- world frame
+
+"""
+
+__author__ = 'Salman Hashmi'
+__license__ = 'BSD License'
+
+
+import numpy as np
+
+
+# Worldmap channel of each ROI, matching the RGB channels it is drawn in
+OBS_CHANNEL, ROCK_CHANNEL, NAV_CHANNEL = 0, 1, 2
+
+
+class WorldMap():
+    """
+    Create a class to count ROI detections in each worldmap pixel.
+
+    Every detection of an ROI in a pixel increments that pixel's counter,
+    including repeated detections of the same pixel within one frame.
+    Counters of all channels are updated together with a single bincount
+    over flattened (channel, y, x) indexes.
+
+    """
+
+    def __init__(self, world_size=200, num_channels=3, dtype=np.uint32):
+        """
+        Initialize a WorldMap instance.
+
+        Keyword arguments:
+        world_size -- integer length of square world map of 200 x 200 pixels
+        num_channels -- number of ROI channels
+        dtype -- unsigned integer counter type, e.g. np.uint16 to halve
+                 memory on short runs
+
+        """
+        self.world_size = world_size
+        self.shape = world_size, world_size, num_channels
+        # One contiguous world_size x world_size plane per channel
+        self.counts = np.zeros((num_channels, world_size, world_size),
+                               dtype=dtype)
+        self.max_count = np.iinfo(dtype).max
+        self.num_hits = 0  # Total detections counted over all channels
+
+    def update(self, rois_pixpts_wf, channels):
+        """
+        Count detections of several ROIs at once.
+
+        Keyword arguments:
+        rois_pixpts_wf -- sequence of tuples of numpy arrays of integer x,y
+                          pixel points in world frame, one per ROI
+        channels -- worldmap channel of each ROI
+
+        Return value:
+        new_pixs -- list of numpy arrays, one per ROI, of unique flat
+                    y*world_size + x indexes of pixels detected for the
+                    first time in their channel
+
+        """
+        plane_size = self.world_size*self.world_size
+        rois_plane_idxs = [pixpts_wf[1]*self.world_size + pixpts_wf[0]
+                           for pixpts_wf in rois_pixpts_wf]
+
+        # Only the pixels touched by this update can become nonzero
+        new_pixs = [
+            np.unique(plane_idxs[self.counts[channel].reshape(-1)[plane_idxs]
+                                 == 0])
+            for plane_idxs, channel in zip(rois_plane_idxs, channels)
+        ]
+
+        flat_idxs = np.concatenate([
+            channel*plane_size + plane_idxs
+            for plane_idxs, channel in zip(rois_plane_idxs, channels)
+        ])
+        if not len(flat_idxs):
+            return new_pixs
+
+        hits = np.bincount(flat_idxs, minlength=self.counts.size)
+
+        # No counter can overflow before the total number of hits does,
+        # past that saturate rather than wrap around
+        counts = self.counts.reshape(-1)
+        self.num_hits += len(flat_idxs)
+        if self.num_hits > self.max_count:
+            hits = np.minimum(hits, self.max_count - counts)
+        counts += hits.astype(counts.dtype)
+
+        return new_pixs
+
+    def add_counts(self, counts, num_hits):
+        """
+        Add the counters of a partial worldmap of the same shape.
+
+        Counting is additive, so worldmaps built from disjoint sets of
+        frames add up to the worldmap of all frames.
+
+        Keyword arguments:
+        counts -- counters of the partial worldmap
+        num_hits -- total detections counted by the partial worldmap
+
+        """
+        self.num_hits += num_hits
+        if self.num_hits > self.max_count:
+            counts = np.minimum(counts, self.max_count - self.counts)
+        self.counts += counts.astype(self.counts.dtype)
+
+    def layer(self, channel):
+        """Return 2D counters of a channel (a view, not a copy)."""
+        return self.counts[channel]
+
+    def normalized(self, channel, scale=255):
+        """
+        Return a channel scaled such that its mean nonzero value is scale.
+
+        This cleans up obs/nav pixels a bit for plotting since counts keep
+        growing with time spent at a location.
+
+        """
+        layer = self.counts[channel]
+        num_nonzero = np.count_nonzero(layer)
+        if not num_nonzero:
+            return np.zeros(layer.shape, dtype=np.float64)
+        mean_nonzero = layer.sum(dtype=np.float64) / num_nonzero
+        return layer * (scale / mean_nonzero)
+
+    def image(self):
+        """Return counters as a float world_size x world_size x 3 image."""
+        return np.dstack(self.counts).astype(np.float64)
+
+
+class MapStats():
+    """
+    Create a class to track mapping statistics incrementally.
+
+    Navigable pixels of the worldmap only ever go from unmapped to mapped,
+    so the statistics are kept up to date from the pixels newly mapped in
+    each update instead of rescanning the whole worldmap every frame.
+
+    """
+
+    def __init__(self, ground_truth):
+        """
+        Initialize a MapStats instance.
+
+        Keyword arguments:
+        ground_truth -- 2D ground truth worldmap, nonzero where navigable
+
+        """
+        self.ground_truth = (ground_truth > 0).reshape(-1)
+        # Total number of map pixels is static so count it once
+        self.tot_map_pix = int(np.count_nonzero(self.ground_truth))
+        self.tot_nav_pix = 0  # Mapped navigable pixels
+        self.good_nav_pix = 0  # Mapped navigable pixels in ground truth
+
+    def add_nav_pixs(self, new_nav_pixs):
+        """
+        Account for newly mapped navigable pixels.
+
+        Keyword arguments:
+        new_nav_pixs -- unique flat indexes of navigable pixels mapped
+                        for the first time, as returned by WorldMap.update
+
+        """
+        self.tot_nav_pix += len(new_nav_pixs)
+        self.good_nav_pix += int(
+            np.count_nonzero(self.ground_truth[new_nav_pixs])
+        )
+
+    @property
+    def bad_nav_pix(self):
+        """Mapped navigable pixels that are not in ground truth."""
+        return self.tot_nav_pix - self.good_nav_pix
+
+    @property
+    def perc_mapped(self):
+        """Percentage of ground truth map that has been successfully found."""
+        if not self.tot_map_pix:
+            return 0
+        return round(100*self.good_nav_pix / self.tot_map_pix, 1)
+
+    @property
+    def fidelity(self):
+        """Percentage of mapped navigable pixels that are in ground truth."""
+        if not self.tot_nav_pix:
+            return 0
+        return round(100*self.good_nav_pix / self.tot_nav_pix, 1)
+
+
+class SampleLocator():
+    """
+    Create a class to confirm rock sample detections against known positions.
+
+    A sample counts as located once any rock pixel is detected within
+    max_dist of its known position. Detections only accumulate, so each
+    update checks just the rock pixels mapped for the first time against
+    the samples not yet located, and located samples are never rechecked.
+
+    """
+
+    def __init__(self, samples_pos, world_size=200, max_dist=3):
+        """
+        Initialize a SampleLocator instance.
+
+        Keyword arguments:
+        samples_pos -- tuple of numpy arrays of known sample x,y positions
+        world_size -- integer length of square world map of 200 x 200 pixels
+        max_dist -- rock detections closer than this to a sample locate it
+
+        """
+        self.samples_x = np.asarray(samples_pos[0])
+        self.samples_y = np.asarray(samples_pos[1])
+        self.world_size = world_size
+        self.max_dist = max_dist
+        self.located = np.zeros(len(self.samples_x), dtype=bool)
+
+    def add_rock_pixs(self, new_rock_pixs):
+        """
+        Check newly detected rock pixels against samples not yet located.
+
+        Keyword arguments:
+        new_rock_pixs -- unique flat indexes of rock pixels detected for
+                         the first time, as returned by WorldMap.update
+
+        """
+        unlocated = np.flatnonzero(~self.located)
+        if not len(new_rock_pixs) or not len(unlocated):
+            return
+
+        rock_y, rock_x = np.divmod(new_rock_pixs, self.world_size)
+        # Squared distances between every unlocated sample and new pixel
+        sq_dists = ((self.samples_x[unlocated, np.newaxis] - rock_x)**2
+                    + (self.samples_y[unlocated, np.newaxis] - rock_y)**2)
+        self.located[unlocated] = np.any(sq_dists < self.max_dist**2, axis=1)
+
+    @property
+    def samples_located(self):
+        """Number of samples located so far."""
+        return int(np.count_nonzero(self.located))
+
+    def located_pos(self):
+        """Return tuple of x,y positions of located samples."""
+        return self.samples_x[self.located], self.samples_y[self.located]